@@ -0,0 +1,154 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/bench_compilador.py
+# Benchmark for compilador.py: mapping the produtos of a 990-item payload onto PyNFe entities.
+#
+# The float loop mapear_nota_fiscal used before the compiler (kept below as the baseline, ported to
+# PyNFe 0.6.5's NotaFiscalProduto) is compared with compilar_produtos + adicionar_produtos: median time
+# over several runs and peak traced memory, plus the compilation alone. It also checks the totals each
+# path would send: the baseline's summed floats against the sum of its own rounded item values (a
+# mismatch is what SEFAZ rejects with cStat 531/532 and friends), and the vNF PyNFe accumulates from
+# the compiled items against the compiler's own, which match by construction.
+#
+# --comparar-com REV also times compilador.py as it was at that git revision (e.g. the columnar version
+# of 06684f7) against the current one: the compilation, and the compilation plus the per-item Decimal
+# dicts PyNFe's entities are built from, which a columnar compiler only produces on request.
+#
+#   python benchmarks/bench_compilador.py [--itens 990] [--repeticoes 10] [--comparar-com REV] [--json]
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import statistics
+import subprocess
+import tracemalloc
+from decimal import Decimal
+
+DIRETORIO_SERVICO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIRETORIO_SERVICO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from compilador import compilar_produtos  # noqa: E402
+from geradores import gerar_produtos  # noqa: E402
+from main import adicionar_produtos  # noqa: E402
+from pynfe.entidades.fonte_dados import FonteDados  # noqa: E402
+from pynfe.entidades.notafiscal import NotaFiscal, NotaFiscalProduto  # noqa: E402
+
+
+def mapear_float(produtos_details):
+    """The produtos loop of mapear_nota_fiscal before compilador.py, returning (produtos, vNF)."""
+    fonte = FonteDados()
+    produtos_list_pynfe = []
+    for i, prod_data in enumerate(produtos_details):
+        icms_data = prod_data.get("tributos", {}).get("icms", {})
+        pis_data = prod_data.get("tributos", {}).get("pis", {})
+        cofins_data = prod_data.get("tributos", {}).get("cofins", {})
+        produto_pynfe = NotaFiscalProduto(
+            _fonte_dados=fonte, codigo=prod_data.get("codigo_produto", f"PROD{i+1}"), descricao=prod_data.get("descricao"),
+            ncm=prod_data.get("ncm"), cfop=str(prod_data.get("cfop")), unidade_comercial=prod_data.get("unidade_comercial", "UN"),
+            quantidade_comercial=float(prod_data.get("quantidade")),
+            valor_unitario_comercial=float(prod_data.get("valor_unitario")),
+            unidade_tributavel=prod_data.get("unidade_tributavel", prod_data.get("unidade_comercial", "UN")),
+            quantidade_tributavel=float(prod_data.get("quantidade_tributavel", prod_data.get("quantidade"))),
+            valor_unitario_tributavel=float(prod_data.get("valor_unitario_tributavel", prod_data.get("valor_unitario"))),
+            valor_total_bruto=float(prod_data.get("valor_total_bruto", float(prod_data.get("quantidade")) * float(prod_data.get("valor_unitario")))),
+            icms_origem=int(icms_data.get("origem", 0)), icms_modalidade=str(icms_data.get("cst", "00")),
+            icms_modalidade_determinacao_bc=int(icms_data.get("mod_bc", 3)),
+            icms_valor_base_calculo=float(icms_data.get("valor_bc", 0.0)), icms_aliquota=float(icms_data.get("aliquota", 0.0)),
+            icms_valor=float(icms_data.get("valor", 0.0)),
+            pis_modalidade=str(pis_data.get("cst", "01")), pis_valor_base_calculo=float(pis_data.get("valor_bc", 0.0)),
+            pis_aliquota_percentual=float(pis_data.get("aliquota_percentual", 0.0)), pis_valor=float(pis_data.get("valor", 0.0)),
+            cofins_modalidade=str(cofins_data.get("cst", "01")), cofins_valor_base_calculo=float(cofins_data.get("valor_bc", 0.0)),
+            cofins_aliquota_percentual=float(cofins_data.get("aliquota_percentual", 0.0)),
+            cofins_valor=float(cofins_data.get("valor", 0.0)),
+            informacoes_adicionais=prod_data.get("informacoes_adicionais_produto", ""))
+        produtos_list_pynfe.append(produto_pynfe)
+    return produtos_list_pynfe, sum(p.valor_total_bruto for p in produtos_list_pynfe)
+
+
+def mapear_compilado(produtos_details):
+    """compilar_produtos + adicionar_produtos onto a NotaFiscal; returns (nota, compiled produtos)."""
+    compilados = compilar_produtos(produtos_details)
+    nf = NotaFiscal(_fonte_dados=FonteDados())
+    adicionar_produtos(nf, compilados)
+    return nf, compilados
+
+
+def compilador_da_revisao(revisao):
+    """compilador.py as it was at a git revision, loaded as a separate module."""
+    caminho = os.path.relpath(os.path.join(DIRETORIO_SERVICO, "compilador.py"),
+                              subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=DIRETORIO_SERVICO,
+                                                      text=True).strip())
+    fonte = subprocess.check_output(["git", "show", f"{revisao}:{caminho}"], cwd=DIRETORIO_SERVICO, text=True)
+    modulo = types.ModuleType(f"compilador_{revisao}")
+    exec(compile(fonte, f"{revisao}:{caminho}", "exec"), modulo.__dict__)
+    return modulo
+
+
+def compilar_e_listar(compilar):
+    return lambda produtos: list(compilar(produtos).itens())
+
+
+def medir(funcao, argumento, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao(argumento)
+        tempos.append(time.perf_counter() - inicio)
+    tracemalloc.start()
+    funcao(argumento)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"mediana_ms": round(statistics.median(tempos) * 1000, 2), "pico_kib": round(pico / 1024, 1)}
+
+
+def conferir_totais(produtos_details):
+    """vNF as each path would write it, against the sum of the vProd values written for its items."""
+    produtos_float, total_float = mapear_float(produtos_details)
+    itens_float = sum(Decimal(f"{p.valor_total_bruto:.2f}") for p in produtos_float)
+    nf, compilados = mapear_compilado(produtos_details)
+    itens_compilados = sum(item["valor_total_bruto"] for item in compilados.itens())
+    return {
+        "float_legado": {"vNF": f"{total_float:.2f}", "soma_itens": str(itens_float),
+                         "confere": f"{total_float:.2f}" == str(itens_float)},
+        "compilador": {"vNF": str(nf.totais_icms_total_nota), "soma_itens": str(itens_compilados),
+                       "confere": nf.totais_icms_total_nota == compilados.totais["valor_nota"] == itens_compilados},
+    }
+
+
+def benchmark(itens, repeticoes, seed=42, comparar_com=None):
+    produtos = gerar_produtos(itens, seed)
+    resultado = {
+        "itens": itens,
+        "float_legado": medir(mapear_float, produtos, repeticoes),
+        "compilador": medir(mapear_compilado, produtos, repeticoes),
+        "somente_compilacao": medir(compilar_produtos, produtos, repeticoes),
+    }
+    if comparar_com:
+        anterior = compilador_da_revisao(comparar_com).compilar_produtos
+        resultado[f"compilacao_{comparar_com}"] = medir(anterior, produtos, repeticoes)
+        resultado["compilacao_e_itens"] = medir(compilar_e_listar(compilar_produtos), produtos, repeticoes)
+        resultado[f"compilacao_e_itens_{comparar_com}"] = medir(compilar_e_listar(anterior), produtos, repeticoes)
+    resultado["totais"] = conferir_totais(produtos)
+    return resultado
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark do compilador de produtos (mapeamento de 990 itens).")
+    parser.add_argument("--itens", type=int, default=990)
+    parser.add_argument("--repeticoes", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--comparar-com", metavar="REV", help="Também mede a compilação com o compilador.py dessa revisão git")
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON")
+    args = parser.parse_args()
+
+    resultado = benchmark(args.itens, args.repeticoes, args.seed, args.comparar_com)
+    if args.json:
+        print(json.dumps(resultado, indent=2))
+    else:
+        print(f"Mapeamento de {resultado['itens']} produtos:")
+        for nome, medida in resultado.items():
+            if isinstance(medida, dict) and "mediana_ms" in medida:
+                print(f"  {nome:30} {medida['mediana_ms']:8.2f} ms   pico {medida['pico_kib']:9.1f} KiB")
+        for nome, totais in resultado["totais"].items():
+            print(f"  {nome:30} vNF {totais['vNF']}  soma dos itens {totais['soma_itens']}  "
+                  f"{'confere' if totais['confere'] else 'DIVERGE'}")
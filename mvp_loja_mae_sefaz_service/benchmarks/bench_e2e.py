@@ -0,0 +1,301 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/bench_e2e.py
+# End-to-end benchmark of the Python side: main.py's routes behind the production server and the
+# Jinja renderer the Next.js app uses for orçamento and ordem de produção PDFs.
+#
+# The service runs under gunicorn (carga_servidor.iniciar_servidor) with every SEFAZ call sent to the
+# local stub (stub_sefaz.py) through SEFAZ_URL_OVERRIDE, so authorization, receipt and distribution
+# go over mTLS with the stub's configurable delays and cStat (the override is only accepted in
+# homologação, which is the ambiente the generated payloads use). Scenarios:
+#   emissao       POST /api/nfe/generate-transmit, once per --itens value (1..990 produtos)
+#   lote          POST /api/nfe/generate-transmit-batch with --notas-lote notas
+#   danfe         GET /api/nfe/<chave>/danfe: first render of freshly emitted notas, then under load
+#   distribuicao  POST /api/nfe/distribuicao-dfe
+#   parse         POST /api/nfe/parse with a procNFe of --itens-parse items
+#   jinja         src/scripts/render_jinja_template.py --serve (as src/lib/jinjaRenderer.ts runs it),
+#                 both templates, once per --itens value
+# Each result has throughput, p50/p95/p99 latency, errors and RSS (the server's workers, or the
+# renderer process). --saida writes everything as JSON with the commit it ran on; --comparar reads a
+# previous file and flags every scenario whose p95 or throughput got worse by more than --tolerancia.
+#
+#   python benchmarks/bench_e2e.py [--cenarios emissao,jinja] [--itens 1,50,990] [--duracao 10]
+#                                  [--saida resultados.json] [--comparar anterior.json]
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import datetime
+import platform
+import tempfile
+import itertools
+import subprocess
+import http.client
+
+DIRETORIO_BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+DIRETORIO_SERVICO = os.path.dirname(DIRETORIO_BENCHMARKS)
+sys.path.insert(0, DIRETORIO_SERVICO)
+sys.path.insert(0, DIRETORIO_BENCHMARKS)
+from servidor import memoria_do_processo  # noqa: E402
+from stub_sefaz import StubSefaz, SENHA_PFX, OPERACOES, CSTATS_PADRAO, ler_pares  # noqa: E402
+from carga_servidor import iniciar_servidor, preparar_cenario, gerar_carga, resumir, processos_filhos  # noqa: E402
+from geradores import gerar_payload_nfe, gerar_payload_lote, GERADORES_TEMPLATE, TEMPLATES  # noqa: E402
+
+RENDER_SCRIPT = os.path.join(os.path.dirname(DIRETORIO_SERVICO), "src", "scripts", "render_jinja_template.py")
+CENARIOS = ("emissao", "lote", "danfe", "distribuicao", "parse", "jinja")
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def _mib(valor):
+    return round(valor / 2 ** 20, 1)
+
+
+def _rss_workers(processo):
+    return [_mib(memoria_do_processo(pid).get("rss", 0)) for pid in processos_filhos(processo.pid)]
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=DIRETORIO_SERVICO, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _requisitar(conexao, metodo, caminho, corpo=None, headers=None):
+    conexao.request(metodo, caminho, body=corpo, headers=headers or {})
+    resposta = conexao.getresponse()
+    return resposta.status, resposta.read()
+
+
+def registrar_certificado(porta, stub):
+    conexao = http.client.HTTPConnection("127.0.0.1", porta, timeout=60)
+    status, corpo = _requisitar(conexao, "POST", "/api/certificados", json.dumps(
+        {"certificate_base64": stub.credenciais.pfx_base64, "certificate_password": SENHA_PFX}).encode(), JSON_HEADERS)
+    conexao.close()
+    if status != 201:
+        raise RuntimeError(f"Registro do certificado falhou ({status}): {corpo[:200]!r}")
+    return {"certificate_handle": json.loads(corpo)["certificate_handle"]}
+
+
+def medir_rota(processo, porta, cenario, rota, requisicao, args, **extras):
+    gerar_carga(porta, requisicao, args.clientes, min(2, args.duracao)) # warm-up
+    resultado = {"cenario": cenario, "rota": rota, **extras}
+    resultado.update(gerar_carga(porta, requisicao, args.clientes, args.duracao))
+    resultado["rss_mib"] = _rss_workers(processo)
+    return resultado
+
+
+def cenario_emissao(processo, porta, certificado, args):
+    resultados = []
+    for itens in args.itens:
+        corpo = json.dumps(gerar_payload_nfe(itens, certificado=certificado)).encode()
+        resultados.append(medir_rota(processo, porta, "emissao", "/api/nfe/generate-transmit",
+                                     lambda corpo=corpo: ("POST", "/api/nfe/generate-transmit", corpo, JSON_HEADERS),
+                                     args, itens=itens, tamanho_kib=round(len(corpo) / 1024, 1)))
+    return resultados
+
+
+def cenario_lote(processo, porta, certificado, args):
+    corpo = json.dumps(gerar_payload_lote(args.notas_lote, args.itens_lote, certificado=certificado)).encode()
+    return [medir_rota(processo, porta, "lote", "/api/nfe/generate-transmit-batch",
+                       lambda: ("POST", "/api/nfe/generate-transmit-batch", corpo, JSON_HEADERS),
+                       args, notas=args.notas_lote, itens=args.itens_lote)]
+
+
+def cenario_danfe(processo, porta, certificado, args):
+    """Emits --notas-danfe notas and times each one's first DANFE (a render), then loads the cached ones."""
+    conexao = http.client.HTTPConnection("127.0.0.1", porta, timeout=120)
+    urls, primeiras, erros = [], [], 0
+    inicio = time.perf_counter()
+    for seed in range(args.notas_danfe):
+        corpo = json.dumps(gerar_payload_nfe(args.itens_danfe, seed=seed, certificado=certificado)).encode()
+        status, resposta = _requisitar(conexao, "POST", "/api/nfe/generate-transmit", corpo, JSON_HEADERS)
+        url = json.loads(resposta).get("danfe_url") if status == 200 else None
+        if not url:
+            erros += 1
+            continue
+        antes = time.perf_counter()
+        status, _ = _requisitar(conexao, "GET", url)
+        if status == 200:
+            primeiras.append(time.perf_counter() - antes)
+            urls.append(url)
+        else:
+            erros += 1
+    conexao.close()
+    primeira = {"cenario": "danfe", "rota": "/api/nfe/<chave_acesso>/danfe", "fase": "primeira_renderizacao",
+                "itens": args.itens_danfe, **resumir(primeiras, erros, time.perf_counter() - inicio)}
+    if not urls:
+        return [primeira] # Nothing authorized (e.g. --cstat autorizacao=539), nothing to load
+    proxima = itertools.cycle(urls)
+    return [primeira, medir_rota(processo, porta, "danfe", "/api/nfe/<chave_acesso>/danfe",
+                                 lambda: ("GET", next(proxima), None, {}), args, fase="cache", itens=args.itens_danfe)]
+
+
+def cenario_distribuicao(processo, porta, stub, args):
+    return [medir_rota(processo, porta, "distribuicao", "/api/nfe/distribuicao-dfe",
+                       preparar_cenario("distribuicao", porta, stub, None), args)]
+
+
+def cenario_parse(processo, porta, stub, args):
+    return [medir_rota(processo, porta, "parse", "/api/nfe/parse", preparar_cenario("parse", porta, stub, args.itens_parse),
+                       args, itens=args.itens_parse)]
+
+
+def medir_jinja(template, itens, duracao):
+    """Renders through one long-lived --serve process, one request at a time, like jinjaRenderer.ts."""
+    processo = subprocess.Popen([sys.executable, RENDER_SCRIPT, "--serve"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                text=True, encoding="utf-8", bufsize=1)
+    linha = json.dumps({"id": 0, "template": TEMPLATES[template], "data": GERADORES_TEMPLATE[template](itens)},
+                       ensure_ascii=False) + "\n"
+
+    def renderizar():
+        processo.stdin.write(linha)
+        processo.stdin.flush()
+        resposta = json.loads(processo.stdout.readline())
+        if "error" in resposta:
+            raise RuntimeError(resposta["error"])
+        return len(resposta["html"])
+
+    try:
+        inicio = time.perf_counter()
+        tamanho = renderizar() # Loads and compiles the template
+        primeira = time.perf_counter() - inicio
+        latencias = []
+        inicio = time.perf_counter()
+        while time.perf_counter() - inicio < duracao:
+            antes = time.perf_counter()
+            renderizar()
+            latencias.append(time.perf_counter() - antes)
+        resultado = {"cenario": "jinja", "rota": "render_jinja_template.py --serve", "template": template, "itens": itens,
+                     "html_kib": round(tamanho / 1024, 1), "primeira_ms": round(primeira * 1000, 1),
+                     **resumir(latencias, 0, time.perf_counter() - inicio),
+                     "rss_mib": [_mib(memoria_do_processo(processo.pid).get("rss", 0))]}
+    finally:
+        processo.stdin.close()
+        processo.wait(timeout=30)
+    return resultado
+
+
+def cenario_jinja(args):
+    return [medir_jinja(template, itens, args.duracao) for template in GERADORES_TEMPLATE for itens in args.itens]
+
+
+def executar(args):
+    resultados = []
+    cenarios_http = [cenario for cenario in args.cenarios if cenario != "jinja"]
+    if cenarios_http:
+        diretorio = tempfile.mkdtemp(prefix="bench_e2e_")
+        stub = StubSefaz(atraso=args.atraso, atrasos=args.atraso_operacao, cstats=args.cstat, variacao=args.variacao).iniciar()
+        processo = None
+        try:
+            processo, porta, inicializacao = iniciar_servidor(args.workers, args.threads, stub, diretorio)
+            resultados.append({"cenario": "inicializacao", "segundos": round(inicializacao, 2), "rss_mib": _rss_workers(processo)})
+            certificado = registrar_certificado(porta, stub)
+            for cenario in cenarios_http:
+                contexto = stub if cenario in ("distribuicao", "parse") else certificado
+                resultados.extend(globals()[f"cenario_{cenario}"](processo, porta, contexto, args))
+            resultados.append({"cenario": "sefaz_stub", "requisicoes": dict(stub.requisicoes_por_operacao)})
+        finally:
+            if processo is not None:
+                processo.send_signal(signal.SIGTERM)
+                processo.wait(timeout=120)
+            stub.parar()
+            shutil.rmtree(diretorio, ignore_errors=True)
+    if "jinja" in args.cenarios:
+        resultados.extend(cenario_jinja(args))
+    return resultados
+
+
+def _chave(resultado):
+    return tuple(str(resultado.get(campo)) for campo in ("cenario", "rota", "fase", "template", "itens", "notas"))
+
+
+def comparar(resultados, anterior, tolerancia):
+    """Per scenario present in both runs: relative change of p95 and throughput, and whether it regressed."""
+    anteriores = {_chave(r): r for r in anterior.get("resultados", []) if "p95_ms" in r}
+    comparacoes = []
+    for resultado in resultados:
+        antes = anteriores.get(_chave(resultado))
+        if antes is None or "p95_ms" not in resultado or not antes["p95_ms"] or not antes["requisicoes_por_segundo"]:
+            continue
+        variacao_p95 = (resultado["p95_ms"] - antes["p95_ms"]) / antes["p95_ms"] if resultado["p95_ms"] is not None else None
+        variacao_vazao = (resultado["requisicoes_por_segundo"] - antes["requisicoes_por_segundo"]) / antes["requisicoes_por_segundo"]
+        comparacoes.append({"chave": [c for c in _chave(resultado) if c != "None"],
+                            "p95_ms": [antes["p95_ms"], resultado["p95_ms"]],
+                            "requisicoes_por_segundo": [antes["requisicoes_por_segundo"], resultado["requisicoes_por_segundo"]],
+                            "variacao_p95": round(variacao_p95, 3) if variacao_p95 is not None else None,
+                            "variacao_vazao": round(variacao_vazao, 3),
+                            "regressao": (variacao_p95 is None or variacao_p95 > tolerancia) or variacao_vazao < -tolerancia})
+    return comparacoes
+
+
+def _lista_inteiros(valor):
+    return [int(item) for item in valor.split(",")]
+
+
+def imprimir(relatorio):
+    print(f"Commit {relatorio['commit']}, Python {relatorio['python']}, {relatorio['cpus']} CPU(s)")
+    for r in relatorio["resultados"]:
+        if r["cenario"] == "inicializacao":
+            print(f"  inicialização do servidor: {r['segundos']} s, RSS {r['rss_mib']} MiB")
+        elif r["cenario"] == "sefaz_stub":
+            print(f"  requisições ao stub da SEFAZ: {r['requisicoes']}")
+        else:
+            nome = " ".join(str(r[campo]) for campo in ("cenario", "template", "fase") if r.get(campo))
+            if r.get("itens"):
+                nome += f" ({r['itens']} itens)"
+            print(f"  {nome:42} {r['requisicoes_por_segundo']:8.1f} req/s  p50 {r['p50_ms']} ms  p95 {r['p95_ms']} ms  "
+                  f"p99 {r['p99_ms']} ms  erros {r['erros']}" + (f"  RSS {r['rss_mib']} MiB" if r.get("rss_mib") else ""))
+    for c in relatorio.get("comparacao", []):
+        print(f"  {'REGRESSÃO' if c['regressao'] else 'ok':9} {' '.join(c['chave'])}: p95 {c['p95_ms'][0]} -> {c['p95_ms'][1]} ms, "
+              f"{c['requisicoes_por_segundo'][0]} -> {c['requisicoes_por_segundo'][1]} req/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark ponta a ponta das rotas do serviço SEFAZ e do renderizador Jinja.")
+    parser.add_argument("--cenarios", default=",".join(CENARIOS), help=f"Cenários separados por vírgula ({', '.join(CENARIOS)})")
+    parser.add_argument("--itens", type=_lista_inteiros, default=[1, 50, 990], help="Itens por NF-e e por documento Jinja")
+    parser.add_argument("--itens-lote", type=int, default=10, help="Itens por nota do lote")
+    parser.add_argument("--notas-lote", type=int, default=10, help="Notas por lote")
+    parser.add_argument("--itens-danfe", type=int, default=20, help="Itens das notas usadas no cenário danfe")
+    parser.add_argument("--notas-danfe", type=int, default=20, help="Notas emitidas para o cenário danfe")
+    parser.add_argument("--itens-parse", type=int, default=300, help="Itens da procNFe do cenário parse")
+    parser.add_argument("--workers", type=int, default=1, help="Workers do gunicorn")
+    parser.add_argument("--threads", type=int, default=8, help="Threads por worker")
+    parser.add_argument("--clientes", type=int, default=4, help="Clientes simultâneos nas rotas HTTP")
+    parser.add_argument("--duracao", type=float, default=10, help="Segundos de carga por cenário")
+    parser.add_argument("--atraso", type=float, default=0.2, help="Latência simulada do stub da SEFAZ")
+    parser.add_argument("--atraso-operacao", action="append", metavar="OPERACAO=SEGUNDOS",
+                        help=f"Latência de uma operação do stub ({', '.join(OPERACOES)}); pode ser repetido")
+    parser.add_argument("--cstat", action="append", metavar="CAMPO=CSTAT",
+                        help=f"cStat de resposta do stub ({', '.join(CSTATS_PADRAO)}); pode ser repetido")
+    parser.add_argument("--variacao", type=float, default=0.0, help="Variação relativa aleatória das latências do stub")
+    parser.add_argument("--saida", help="Arquivo JSON onde gravar os resultados")
+    parser.add_argument("--comparar", help="Resultados JSON de uma execução anterior, para comparação")
+    parser.add_argument("--tolerancia", type=float, default=0.10, help="Piora relativa de p95 ou vazão tratada como regressão")
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON")
+    args = parser.parse_args()
+    args.cenarios = [cenario.strip() for cenario in args.cenarios.split(",") if cenario.strip()]
+    desconhecidos = set(args.cenarios) - set(CENARIOS)
+    if desconhecidos:
+        parser.error(f"cenários desconhecidos: {', '.join(sorted(desconhecidos))}")
+    args.atraso_operacao = ler_pares(args.atraso_operacao, float)
+    args.cstat = ler_pares(args.cstat)
+
+    relatorio = {"commit": _commit(), "data": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+                 "python": platform.python_version(), "cpus": os.cpu_count(),
+                 "parametros": {nome: valor for nome, valor in vars(args).items() if nome not in ("saida", "comparar", "json")},
+                 "resultados": executar(args)}
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            relatorio["comparacao"] = comparar(relatorio["resultados"], json.load(f), args.tolerancia)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            json.dump(relatorio, f, indent=2, ensure_ascii=False)
+    if args.json:
+        print(json.dumps(relatorio, indent=2, ensure_ascii=False))
+    else:
+        imprimir(relatorio)
+    sys.exit(1 if any(c["regressao"] for c in relatorio.get("comparacao", [])) else 0)
@@ -0,0 +1,170 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/bench_extrator.py
+# Benchmark for extrator.py: a synthetic 990-item procNFe and a batch of distribution documents.
+#
+# For the single nota, the streaming extractor is compared with a full-tree parse (ET.fromstring +
+# findall, what a naive implementation would do): median time over several runs and peak traced
+# memory. The batch run measures documents per second and peak memory for a mix of procNFe,
+# resNFe and resEvento shaped like distribuicao-dfe output (base64 XML per document).
+#
+#   python benchmarks/bench_extrator.py [--itens 990] [--documentos 10000] [--json]
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import statistics
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from extrator import extrair_documento, iterar_documentos, fontes_de_distribuicao  # noqa: E402
+
+NS = "http://www.portalfiscal.inf.br/nfe"
+CHAVE = "35240112345678000195550010000012341000012345"
+
+
+def gerar_proc_nfe(itens, chave=CHAVE):
+    dets = []
+    total = 0
+    for n in range(1, itens + 1):
+        quantidade = 1 + n % 7
+        unitario = 10 + (n % 50) * 1.25
+        total += quantidade * unitario
+        dets.append(
+            f'<det nItem="{n}"><prod><cProd>P{n:05d}</cProd><cEAN>SEM GTIN</cEAN><xProd>Produto sintetico {n}</xProd>'
+            f'<NCM>94036000</NCM><CFOP>5102</CFOP><uCom>UN</uCom><qCom>{quantidade:.4f}</qCom><vUnCom>{unitario:.10f}</vUnCom>'
+            f'<vProd>{quantidade * unitario:.2f}</vProd><cEANTrib>SEM GTIN</cEANTrib><uTrib>UN</uTrib><qTrib>{quantidade:.4f}</qTrib>'
+            f'<vUnTrib>{unitario:.10f}</vUnTrib><indTot>1</indTot></prod><imposto><ICMS><ICMSSN102><orig>0</orig><CSOSN>102</CSOSN>'
+            f'</ICMSSN102></ICMS><PIS><PISOutr><CST>99</CST><vBC>0.00</vBC><pPIS>0.00</pPIS><vPIS>0.00</vPIS></PISOutr></PIS>'
+            f'<COFINS><COFINSOutr><CST>99</CST><vBC>0.00</vBC><pCOFINS>0.00</pCOFINS><vCOFINS>0.00</vCOFINS></COFINSOutr></COFINS>'
+            f'</imposto></det>')
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="{NS}" versao="4.00"><NFe xmlns="{NS}">'
+        f'<infNFe Id="NFe{chave}" versao="4.00"><ide><cUF>35</cUF><natOp>VENDA</natOp><mod>55</mod><serie>1</serie>'
+        f'<nNF>1234</nNF><dhEmi>2024-01-15T10:00:00-03:00</dhEmi><tpNF>1</tpNF></ide>'
+        f'<emit><CNPJ>12345678000195</CNPJ><xNome>Fornecedor Sintetico Ltda</xNome><IE>111111111111</IE></emit>'
+        f'<dest><CNPJ>98765432000198</CNPJ><xNome>Loja Mae Ltda</xNome></dest>{"".join(dets)}'
+        f'<total><ICMSTot><vBC>0.00</vBC><vICMS>0.00</vICMS><vProd>{total:.2f}</vProd><vDesc>0.00</vDesc><vNF>{total:.2f}</vNF></ICMSTot></total>'
+        f'<cobr><fat><nFat>1234</nFat><vOrig>{total:.2f}</vOrig><vLiq>{total:.2f}</vLiq></fat>'
+        f'<dup><nDup>001</nDup><dVenc>2024-02-15</dVenc><vDup>{total / 2:.2f}</vDup></dup>'
+        f'<dup><nDup>002</nDup><dVenc>2024-03-15</dVenc><vDup>{total - round(total / 2, 2):.2f}</vDup></dup></cobr>'
+        f'</infNFe></NFe><protNFe versao="4.00"><infProt><tpAmb>1</tpAmb><chNFe>{chave}</chNFe>'
+        f'<dhRecbto>2024-01-15T10:00:05-03:00</dhRecbto><nProt>135240000000001</nProt><cStat>100</cStat>'
+        f'<xMotivo>Autorizado o uso da NF-e</xMotivo></infProt></protNFe></nfeProc>'
+    ).encode("utf-8")
+
+
+def gerar_res_nfe(chave=CHAVE):
+    return (f'<resNFe xmlns="{NS}" versao="1.01"><chNFe>{chave}</chNFe><CNPJ>12345678000195</CNPJ>'
+            f'<xNome>Fornecedor Sintetico Ltda</xNome><IE>111111111111</IE><dhEmi>2024-01-15T10:00:00-03:00</dhEmi>'
+            f'<tpNF>1</tpNF><vNF>1500.00</vNF><digVal>abc=</digVal><dhRecbto>2024-01-15T10:00:05-03:00</dhRecbto>'
+            f'<nProt>135240000000001</nProt><cSitNFe>1</cSitNFe></resNFe>').encode("utf-8")
+
+
+def gerar_res_evento(chave=CHAVE):
+    return (f'<resEvento xmlns="{NS}" versao="1.01"><cOrgao>35</cOrgao><CNPJ>12345678000195</CNPJ><chNFe>{chave}</chNFe>'
+            f'<dhEvento>2024-01-16T09:00:00-03:00</dhEvento><tpEvento>110111</tpEvento><nSeqEvento>1</nSeqEvento>'
+            f'<xEvento>Cancelamento</xEvento><dhRecbto>2024-01-16T09:00:02-03:00</dhRecbto><nProt>135240000000002</nProt></resEvento>').encode("utf-8")
+
+
+def extrair_arvore_completa(xml_bytes):
+    """Baseline: whole-document parse, the approach the streaming extractor replaces."""
+    root = ET.fromstring(xml_bytes)
+    ns = {"n": NS}
+    produtos = []
+    for det in root.iterfind(".//n:det", ns):
+        prod = det.find("n:prod", ns)
+        produtos.append({campo: prod.findtext(f"n:{tag}", namespaces=ns) for tag, campo in
+                         (("cProd", "codigo"), ("xProd", "descricao"), ("NCM", "ncm"), ("CFOP", "cfop"),
+                          ("uCom", "unidade"), ("qCom", "quantidade"), ("vUnCom", "valorUnitario"), ("vProd", "valorTotal"))})
+    return {"chaveAcesso": root.find(".//n:infNFe", ns).get("Id")[3:], "produtos": produtos,
+            "valorTotal": root.findtext(".//n:ICMSTot/n:vNF", namespaces=ns)}
+
+
+def medir(funcao, argumento, repeticoes):
+    tempos = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao(argumento)
+        tempos.append(time.perf_counter() - inicio)
+    tracemalloc.start()
+    funcao(argumento)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"mediana_ms": round(statistics.median(tempos) * 1000, 2), "pico_kib": round(pico / 1024, 1)}
+
+
+def benchmark_nota(itens, repeticoes):
+    xml_bytes = gerar_proc_nfe(itens)
+    documento = extrair_documento(xml_bytes)
+    assert len(documento["produtos"]) == itens and len(documento["faturas"]) == 2
+    return {
+        "itens": itens,
+        "tamanho_kib": round(len(xml_bytes) / 1024, 1),
+        "iterparse": medir(extrair_documento, xml_bytes, repeticoes),
+        "arvore_completa": medir(extrair_arvore_completa, xml_bytes, repeticoes),
+    }
+
+
+def gerar_lote_distribuicao(quantidade, seed=42):
+    rnd = random.Random(seed)
+    modelos = {}
+    documentos = []
+    for nsu in range(1, quantidade + 1):
+        sorteio = rnd.random()
+        if sorteio < 0.7:
+            chave = ("proc", rnd.randint(1, 20))
+        elif sorteio < 0.9:
+            chave = ("res", 0)
+        else:
+            chave = ("evento", 0)
+        if chave not in modelos:
+            xml_bytes = gerar_proc_nfe(chave[1]) if chave[0] == "proc" else gerar_res_nfe() if chave[0] == "res" else gerar_res_evento()
+            modelos[chave] = base64.b64encode(xml_bytes).decode()
+        documentos.append({"nsu": f"{nsu:015d}", "xml_base64": modelos[chave]})
+    return documentos
+
+
+def _processar_lote(documentos, saida):
+    erros = 0
+    for documento in iterar_documentos(fontes_de_distribuicao(documentos)):
+        erros += "error" in documento
+        saida.write(json.dumps(documento, ensure_ascii=False) + "\n")
+    return erros
+
+
+def benchmark_lote(quantidade):
+    documentos = gerar_lote_distribuicao(quantidade)
+    with open(os.devnull, "w") as saida:
+        inicio = time.perf_counter()
+        erros = _processar_lote(documentos, saida)
+        duracao = time.perf_counter() - inicio
+        # Second pass under tracemalloc, which slows Python down too much to time the same run
+        tracemalloc.start()
+        _processar_lote(documentos, saida)
+        _, pico = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"documentos": quantidade, "erros": erros, "segundos": round(duracao, 2),
+            "documentos_por_segundo": round(quantidade / duracao), "pico_kib": round(pico / 1024, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark do extrator de NF-e.")
+    parser.add_argument("--itens", type=int, default=990)
+    parser.add_argument("--documentos", type=int, default=10000)
+    parser.add_argument("--repeticoes", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON")
+    args = parser.parse_args()
+
+    resultado = {"nota": benchmark_nota(args.itens, args.repeticoes), "lote": benchmark_lote(args.documentos)}
+    if args.json:
+        print(json.dumps(resultado, indent=2))
+    else:
+        nota, lote = resultado["nota"], resultado["lote"]
+        print(f"procNFe com {nota['itens']} itens ({nota['tamanho_kib']} KiB):")
+        for nome in ("iterparse", "arvore_completa"):
+            print(f"  {nome:16} {nota[nome]['mediana_ms']:8.2f} ms   pico {nota[nome]['pico_kib']:9.1f} KiB")
+        print(f"Lote de {lote['documentos']} documentos: {lote['segundos']} s, {lote['documentos_por_segundo']} docs/s, "
+              f"pico {lote['pico_kib']} KiB, {lote['erros']} erros")
@@ -0,0 +1,208 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/carga_servidor.py
+# Load test of the production serving mode (gunicorn.conf.py) with 1..N worker processes.
+#
+# For each worker count a fresh server is started against the stub SEFAZ (stub_sefaz.py), and
+# concurrent clients run one scenario for a fixed time:
+#   parse         POST /api/nfe/parse with a synthetic procNFe (CPU-bound, shows scaling with cores)
+#   distribuicao  POST /api/nfe/distribuicao-dfe through the stub over mTLS (I/O-bound, one new CNPJ
+#                 per request so the NSU back-off never kicks in)
+# Reported per run: server startup time, requests/s, p50/p95/p99 latency, errors, RSS/PSS of every
+# worker, and how long SIGTERM took to drain.
+#
+#   python benchmarks/carga_servidor.py [--cenario parse] [--workers 1,2,4] [--clientes 16] [--duracao 10] [--json]
+import os
+import sys
+import json
+import time
+import random
+import signal
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+import http.client
+import urllib.request
+
+DIRETORIO_SERVICO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIRETORIO_SERVICO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from servidor import memoria_do_processo  # noqa: E402
+from stub_sefaz import StubSefaz, SENHA_PFX  # noqa: E402
+from bench_extrator import gerar_proc_nfe  # noqa: E402
+
+
+def _porta_livre():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def processos_filhos(pid):
+    filhos = []
+    for nome in os.listdir("/proc"):
+        if nome.isdigit():
+            try:
+                with open(f"/proc/{nome}/stat") as f:
+                    if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                        filhos.append(int(nome))
+            except (OSError, IndexError, ValueError):
+                continue
+    return filhos
+
+
+def iniciar_servidor(workers, threads, stub, diretorio):
+    porta = _porta_livre()
+    env = dict(os.environ, SEFAZ_WORKERS=str(workers), SEFAZ_THREADS=str(threads), SEFAZ_BIND=f"127.0.0.1:{porta}",
+               SEFAZ_DATA_DIR=os.path.join(diretorio, f"data_{workers}"), SEFAZ_CA_BUNDLE=stub.credenciais.ca_path,
+               SEFAZ_URL_OVERRIDE=stub.url_base, SEFAZ_DISTRIBUICAO_URL=stub.url, SEFAZ_DANFE_PREFETCH="0",
+               SEFAZ_METRICS_INTERVAL="1")
+    env.pop("SEFAZ_METRICS_DIR", None)
+    env.pop("SEFAZ_CERT_SHARED_DIR", None)
+    log = open(os.path.join(diretorio, f"gunicorn_{workers}.log"), "w")
+    inicio = time.perf_counter()
+    processo = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"], cwd=DIRETORIO_SERVICO,
+                                env=env, stdout=log, stderr=subprocess.STDOUT)
+    while True:
+        if processo.poll() is not None:
+            raise RuntimeError(f"gunicorn saiu com código {processo.returncode}; veja {log.name}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{porta}/health", timeout=1).read()
+            if len(processos_filhos(processo.pid)) >= workers:
+                break
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return processo, porta, time.perf_counter() - inicio
+
+
+def preparar_cenario(cenario, porta, stub, itens):
+    """Returns a function building (metodo, caminho, corpo, headers) for each request."""
+    if cenario == "parse":
+        corpo = gerar_proc_nfe(itens)
+        return lambda: ("POST", "/api/nfe/parse", corpo, {"Content-Type": "application/xml"})
+
+    # Registered once; every worker resolves the handle through the shared certificate spool
+    registro = urllib.request.Request(f"http://127.0.0.1:{porta}/api/certificados", method="POST",
+                                      data=json.dumps({"certificate_base64": stub.credenciais.pfx_base64,
+                                                       "certificate_password": SENHA_PFX}).encode(),
+                                      headers={"Content-Type": "application/json"})
+    handle = json.loads(urllib.request.urlopen(registro).read())["certificate_handle"]
+
+    def distribuicao():
+        corpo = json.dumps({"uf_sigla": "SP", "ambiente": "2", "certificate_handle": handle,
+                            "cnpj_interessado": f"{random.randrange(10 ** 13, 10 ** 14)}"}).encode()
+        return "POST", "/api/nfe/distribuicao-dfe", corpo, {"Content-Type": "application/json"}
+    return distribuicao
+
+
+def resumir(latencias, erros, decorrido):
+    """Throughput and latency percentiles (ms) of one run."""
+    latencias = sorted(latencias)
+
+    def percentil(p):
+        return round(latencias[min(len(latencias) - 1, int(len(latencias) * p))] * 1000, 1) if latencias else None
+    return {"requisicoes": len(latencias), "erros": erros, "requisicoes_por_segundo": round(len(latencias) / decorrido, 1),
+            "p50_ms": percentil(0.50), "p95_ms": percentil(0.95), "p99_ms": percentil(0.99),
+            "media_ms": round(statistics.mean(latencias) * 1000, 1) if latencias else None}
+
+
+def gerar_carga(porta, requisicao, clientes, duracao):
+    latencias = []
+    erros = [0]
+    lock = threading.Lock()
+    fim = time.perf_counter() + duracao
+
+    def cliente():
+        conexao = http.client.HTTPConnection("127.0.0.1", porta, timeout=120)
+        minhas = []
+        while time.perf_counter() < fim:
+            metodo, caminho, corpo, headers = requisicao()
+            inicio = time.perf_counter()
+            try:
+                conexao.request(metodo, caminho, body=corpo, headers=headers)
+                resposta = conexao.getresponse()
+                resposta.read()
+                ok = resposta.status < 400
+            except (OSError, http.client.HTTPException):
+                conexao.close()
+                conexao = http.client.HTTPConnection("127.0.0.1", porta, timeout=120)
+                ok = False
+            if ok:
+                minhas.append(time.perf_counter() - inicio)
+            else:
+                with lock:
+                    erros[0] += 1
+        conexao.close()
+        with lock:
+            latencias.extend(minhas)
+
+    inicio = time.perf_counter()
+    threads = [threading.Thread(target=cliente) for _ in range(clientes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return resumir(latencias, erros[0], time.perf_counter() - inicio)
+
+
+def executar(workers, args, stub, diretorio):
+    processo, porta, inicializacao = iniciar_servidor(workers, args.threads, stub, diretorio)
+    try:
+        requisicao = preparar_cenario(args.cenario, porta, stub, args.itens)
+        gerar_carga(porta, requisicao, args.clientes, min(2, args.duracao)) # warm-up
+        resultado = gerar_carga(porta, requisicao, args.clientes, args.duracao)
+        memoria = [memoria_do_processo(pid) for pid in processos_filhos(processo.pid)]
+        resultado.update({
+            "workers": workers,
+            "inicializacao_s": round(inicializacao, 2),
+            "rss_mib_por_worker": [round(m.get("rss", 0) / 2 ** 20, 1) for m in memoria],
+            "pss_mib_por_worker": [round(m.get("pss", 0) / 2 ** 20, 1) for m in memoria],
+        })
+    finally:
+        inicio = time.perf_counter()
+        processo.send_signal(signal.SIGTERM)
+        processo.wait(timeout=120)
+        resultado["drenagem_s"] = round(time.perf_counter() - inicio, 2)
+    return resultado
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de carga do modo de produção (gunicorn) com 1..N workers.")
+    parser.add_argument("--cenario", choices=("parse", "distribuicao"), default="parse")
+    parser.add_argument("--workers", default=None, help="Quantidades de workers separadas por vírgula (padrão: 1, 2, 4... até o nº de CPUs)")
+    parser.add_argument("--threads", type=int, default=8, help="Threads por worker")
+    parser.add_argument("--clientes", type=int, default=16, help="Clientes simultâneos")
+    parser.add_argument("--duracao", type=float, default=10, help="Segundos de carga por rodada")
+    parser.add_argument("--itens", type=int, default=300, help="Itens da procNFe do cenário parse")
+    parser.add_argument("--atraso-sefaz", type=float, default=0.2, help="Latência simulada do stub da SEFAZ")
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON")
+    args = parser.parse_args()
+
+    if args.workers:
+        contagens = [int(n) for n in args.workers.split(",")]
+    else:
+        contagens = [1]
+        while contagens[-1] * 2 <= (os.cpu_count() or 1):
+            contagens.append(contagens[-1] * 2)
+
+    diretorio = tempfile.mkdtemp(prefix="carga_sefaz_")
+    stub = StubSefaz(atraso=args.atraso_sefaz).iniciar()
+    try:
+        resultados = [executar(workers, args, stub, diretorio) for workers in contagens]
+    finally:
+        stub.parar()
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({"cenario": args.cenario, "cpus": os.cpu_count(), "clientes": args.clientes,
+                          "resultados": resultados}, indent=2))
+    else:
+        print(f"Cenário {args.cenario}, {args.clientes} clientes, {os.cpu_count()} CPU(s)")
+        base = resultados[0]["requisicoes_por_segundo"] or 1
+        for r in resultados:
+            print(f"  {r['workers']:2} worker(s): {r['requisicoes_por_segundo']:8.1f} req/s ({r['requisicoes_por_segundo'] / base:4.2f}x)  "
+                  f"p50 {r['p50_ms']} ms  p95 {r['p95_ms']} ms  p99 {r['p99_ms']} ms  erros {r['erros']}  início {r['inicializacao_s']} s  "
+                  f"drenagem {r['drenagem_s']} s  RSS {r['rss_mib_por_worker']} MiB  PSS {r['pss_mib_por_worker']} MiB")
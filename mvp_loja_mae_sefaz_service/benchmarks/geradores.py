@@ -0,0 +1,172 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/geradores.py
+# Synthetic payloads for the end-to-end benchmarks (bench_e2e.py), deterministic for a given seed.
+#
+#   nfe              POST /api/nfe/generate-transmit body with 1..990 produtos (gerar_produtos, also used by
+#                    bench_compilador.py)
+#   lote             POST /api/nfe/generate-transmit-batch body
+#   orcamento        context of src/templates/orcamento_pdf_template.html
+#   ordem_producao   context of src/templates/ordem_producao_pdf_template.html
+# The template contexts have the shape the Next.js routes build (src/app/api/orcamentos/[id]/pdf and
+# src/app/api/ordem-producao/[id]/pdf), including the dates they pre-format as pt-BR strings.
+#
+#   python benchmarks/geradores.py nfe --itens 990 > payload.json
+import os
+import sys
+import json
+import random
+import argparse
+import datetime
+from decimal import Decimal, ROUND_HALF_EVEN
+
+MAX_ITENS = 990
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "src", "templates")
+TEMPLATES = {
+    "orcamento": os.path.join(TEMPLATES_DIR, "orcamento_pdf_template.html"),
+    "ordem_producao": os.path.join(TEMPLATES_DIR, "ordem_producao_pdf_template.html"),
+}
+
+EMITENTE = {
+    "cnpj": "00000000000191", "nome_razao": "LOJA MAE LTDA", "nome_fantasia": "Loja Mãe", "logradouro": "Rua das Flores",
+    "numero": "100", "bairro": "Centro", "municipio_nome": "São Paulo", "municipio_codigo_ibge": "3550308", "uf_sigla": "SP",
+    "cep": "01001000", "telefone": "1130000000", "inscricao_estadual": "111111111111", "regime_tributario_codigo": "3",
+}
+NOMES = ("Ana Souza", "Bruno Lima", "Carla Mendes", "Diego Rocha", "Elisa Prado", "Fábio Nunes", "Gabriela Castro")
+PRODUTOS = ("Cortina blackout", "Persiana rolô", "Cortina de linho", "Trilho suíço", "Varão de alumínio", "Papel de parede")
+CENTAVO = Decimal("0.01")
+
+
+def _valor(base, aliquota):
+    return float((Decimal(repr(base)) * Decimal(repr(aliquota)) / 100).quantize(CENTAVO, rounding=ROUND_HALF_EVEN))
+
+
+def gerar_produtos(itens, seed=42):
+    """
+    Synthetic produtos shaped like the store's payloads: JSON floats, fractional quantities, tributos filled in,
+    and valor_total_bruto left out of every other item (the service computes it).
+    """
+    aleatorio = random.Random(seed)
+    produtos = []
+    for n in range(1, itens + 1):
+        quantidade = round(aleatorio.uniform(0.1, 20), 3)
+        unitario = round(aleatorio.uniform(0.5, 500), 2)
+        total = float((Decimal(repr(quantidade)) * Decimal(repr(unitario))).quantize(CENTAVO, rounding=ROUND_HALF_EVEN))
+        produtos.append({
+            "codigo_produto": f"P{n:05d}", "descricao": f"Produto sintetico {n}", "ncm": "94036000", "cfop": "5102",
+            "unidade_comercial": "UN", "quantidade": quantidade, "valor_unitario": unitario,
+            "tributos": {
+                "icms": {"origem": "0", "cst": "00", "mod_bc": "3", "valor_bc": total, "aliquota": 18, "valor": _valor(total, 18)},
+                "pis": {"cst": "01", "valor_bc": total, "aliquota_percentual": 1.65, "valor": _valor(total, 1.65)},
+                "cofins": {"cst": "01", "valor_bc": total, "aliquota_percentual": 7.6, "valor": _valor(total, 7.6)},
+            },
+        })
+        if n % 2:
+            produtos[-1]["valor_total_bruto"] = total
+    return produtos
+
+
+def _id(aleatorio):
+    return "".join(aleatorio.choice("0123456789abcdefghijklmnopqrstuvwxyz") for _ in range(25))
+
+
+def _destinatario(aleatorio):
+    return {"cpf_cnpj": f"{aleatorio.randrange(10 ** 10, 10 ** 11)}", "nome_razao": aleatorio.choice(NOMES),
+            "logradouro": "Avenida Paulista", "numero": str(aleatorio.randrange(1, 3000)), "bairro": "Bela Vista",
+            "municipio_nome": "São Paulo", "municipio_codigo_ibge": "3550308", "uf_sigla": "SP", "cep": "01310100",
+            "email": "cliente@example.com", "indicador_ie_codigo": "9"}
+
+
+def _nota(itens, aleatorio):
+    return {
+        "destinatario": _destinatario(aleatorio),
+        "produtos": gerar_produtos(itens, aleatorio.randrange(2 ** 32)),
+        "nota_fiscal_info": {"natureza_operacao": "VENDA DE MERCADORIA", "modelo_documento_fiscal": "55", "serie_nf": "1",
+                             "data_emissao": datetime.datetime.now().astimezone().isoformat(timespec="seconds"),
+                             "finalidade_emissao_codigo": "1", "tipo_operacao_codigo": "1", "presenca_comprador_codigo": "1"},
+    }
+
+
+def gerar_payload_nfe(itens, seed=42, certificado=None, serie="1", ambiente="2"):
+    """generate-transmit body; certificado is a dict with certificate_handle or certificate_base64/certificate_password."""
+    if not 1 <= itens <= MAX_ITENS:
+        raise ValueError(f"itens deve estar entre 1 e {MAX_ITENS}")
+    payload = {"emitente": EMITENTE, "ambiente": ambiente, "current_nfe_series": serie, **_nota(itens, random.Random(seed))}
+    payload.update(certificado or {})
+    return payload
+
+
+def gerar_payload_lote(notas, itens, seed=42, certificado=None, serie="1", ambiente="2"):
+    aleatorio = random.Random(seed)
+    payload = {"emitente": EMITENTE, "ambiente": ambiente, "current_nfe_series": serie,
+               "notas": [_nota(itens, aleatorio) for _ in range(notas)]}
+    payload.update(certificado or {})
+    return payload
+
+
+def _data_pt_br(data):
+    return data.strftime("%d/%m/%Y")
+
+
+def gerar_orcamento(itens, seed=42):
+    aleatorio = random.Random(seed)
+    linhas = []
+    for _ in range(itens):
+        altura, largura = round(aleatorio.uniform(0.5, 3.2), 2), round(aleatorio.uniform(0.4, 6), 2)
+        metragem = round(altura * largura, 2)
+        preco_unitario = round(aleatorio.uniform(40, 400), 2)
+        linhas.append({"id": _id(aleatorio), "descricao": f"{aleatorio.choice(PRODUTOS)} sob medida",
+                       "tipoProduto": aleatorio.choice(("CORTINA", "PERSIANA", "ACESSORIO")), "altura": altura,
+                       "largura": largura, "metragem": metragem, "precoUnitario": preco_unitario,
+                       "precoFinal": round(metragem * preco_unitario, 2)})
+    subtotal = round(sum(linha["precoFinal"] for linha in linhas), 2)
+    desconto = round(subtotal * 0.05, 2) if aleatorio.random() < 0.5 else 0
+    return {"orcamento": {
+        "id": _id(aleatorio), "status": "AGUARDANDO APROVACAO", "createdAt": _data_pt_br(datetime.date.today()),
+        "cliente": {"nome": aleatorio.choice(NOMES), "email": "cliente@example.com", "telefone": "11999990000"},
+        "vendedor": {"name": aleatorio.choice(NOMES), "email": "vendedor@example.com"},
+        "itens": linhas, "subtotal": subtotal, "desconto": desconto, "valorDesconto": desconto,
+        "valorTotal": round(subtotal - desconto, 2), "observacoes": "Instalação incluída. Prazo de 15 dias úteis.",
+    }}
+
+
+def gerar_ordem_producao(itens, seed=42):
+    aleatorio = random.Random(seed)
+    cliente = {"nome": aleatorio.choice(NOMES), "cpfCnpj": "12345678909", "email": "cliente@example.com",
+               "telefone": "11999990000", "enderecoCompleto": "Avenida Paulista, 1000 - Bela Vista, São Paulo/SP"}
+    vendedor = {"name": aleatorio.choice(NOMES), "email": "vendedor@example.com"}
+    responsavel = {"name": aleatorio.choice(NOMES), "email": "producao@example.com"}
+    ordem_id = _id(aleatorio)
+    hoje = datetime.date.today()
+    return {
+        "ordem": {"id": ordem_id, "idCurto": ordem_id[:8], "status": "EM_PRODUCAO", "statusFormatado": "EM PRODUCAO",
+                  "dataCriacaoFormatada": _data_pt_br(hoje),
+                  "dataPrevistaEntregaFormatada": _data_pt_br(hoje + datetime.timedelta(days=15)),
+                  "observacoesGerais": "Conferir medidas antes do corte.", "responsavel": responsavel,
+                  "orcamento": {"id": _id(aleatorio), "cliente": cliente, "vendedor": vendedor}},
+        "cliente": cliente,
+        "vendedor": vendedor,
+        "responsavelProducao": responsavel,
+        "itens": [{"id": _id(aleatorio), "descricao": f"{aleatorio.choice(PRODUTOS)} sob medida",
+                   "quantidadeFormatada": f"{aleatorio.randrange(1, 12)}", "unidade": aleatorio.choice(("UN", "M2", "M")),
+                   "observacoes": aleatorio.choice((None, "Bainha dupla", "Lado esquerdo"))} for _ in range(itens)],
+        "dataGeracao": datetime.datetime.now().strftime("%d/%m/%Y %H:%M"),
+    }
+
+
+GERADORES_TEMPLATE = {"orcamento": gerar_orcamento, "ordem_producao": gerar_ordem_producao}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gera payloads sintéticos para os benchmarks.")
+    parser.add_argument("tipo", choices=("nfe", "lote", "orcamento", "ordem_producao"))
+    parser.add_argument("--itens", type=int, default=10, help=f"Itens por nota ou documento (NF-e: 1 a {MAX_ITENS})")
+    parser.add_argument("--notas", type=int, default=10, help="Notas do lote")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    if args.tipo == "nfe":
+        resultado = gerar_payload_nfe(args.itens, args.seed)
+    elif args.tipo == "lote":
+        resultado = gerar_payload_lote(args.notas, args.itens, args.seed)
+    else:
+        resultado = GERADORES_TEMPLATE[args.tipo](args.itens, args.seed)
+    json.dump(resultado, sys.stdout, ensure_ascii=False)
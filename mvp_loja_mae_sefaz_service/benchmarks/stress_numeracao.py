@@ -0,0 +1,120 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/stress_numeracao.py
+# Concurrency stress test for numeracao.py: several processes, each with several threads, reserve
+# numbers (single notas and batch ranges) on one SQLite file and settle them the way the emission
+# routes do (authorized, rejected, mapping error, unknown outcome). Afterwards it checks that:
+#   - no number was confirmed twice (duplicidade);
+#   - every number up to the series' high-water mark is accounted for (no gaps): utilizado,
+#     queued for inutilização, or still free for the next reservation.
+# Exits with status 1 if either check fails.
+#
+#   python benchmarks/stress_numeracao.py [--processos 4] [--threads 8] [--operacoes 200] [--json]
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from numeracao import NumeradorNFe, NumeracaoStore, agrupar_faixas  # noqa: E402
+
+CNPJ = "12345678000195"
+MODELO = "55"
+SERIE = "1"
+
+
+def trabalhador(db_path, threads, operacoes, seed):
+    numerador = NumeradorNFe(store=NumeracaoStore(db_path))
+    confirmados = []
+    lock = threading.Lock()
+
+    def executar(indice):
+        rnd = random.Random(seed * 1000 + indice)
+        meus = []
+        for _ in range(operacoes):
+            quantidade = 1 if rnd.random() < 0.8 else rnd.randint(2, 50)
+            for numero in numerador.reservar(CNPJ, MODELO, SERIE, quantidade=quantidade):
+                desfecho = rnd.random()
+                if desfecho < 0.7:
+                    numerador.registrar_retorno(CNPJ, MODELO, SERIE, numero, "100", chave_acesso=f"chave-{numero}")
+                    meus.append(numero)
+                elif desfecho < 0.85:
+                    numerador.registrar_retorno(CNPJ, MODELO, SERIE, numero, "225", motivo="Rejeição simulada")
+                elif desfecho < 0.95:
+                    numerador.devolver(CNPJ, MODELO, SERIE, numero, motivo="erro de mapeamento simulado")
+                else:
+                    numerador.marcar_para_inutilizacao(CNPJ, MODELO, SERIE, numero, motivo="timeout simulado")
+        with lock:
+            confirmados.extend(meus)
+
+    workers = [threading.Thread(target=executar, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return confirmados
+
+
+def verificar(db_path, confirmados):
+    conn = sqlite3.connect(db_path)
+    ultimo = conn.execute("SELECT ultimo_numero FROM numeracao_serie WHERE cnpj = ? AND modelo = ? AND serie = ?",
+                          (CNPJ, MODELO, SERIE)).fetchone()[0]
+    por_status = {}
+    for status, numero in conn.execute("SELECT status, numero FROM numeracao_numero WHERE cnpj = ? AND modelo = ? AND serie = ?",
+                                       (CNPJ, MODELO, SERIE)):
+        por_status.setdefault(status, set()).add(numero)
+    conn.close()
+
+    duplicados = len(confirmados) - len(set(confirmados))
+    registrados = set().union(*por_status.values()) if por_status else set()
+    lacunas = sorted(set(range(1, ultimo + 1)) - registrados)
+    return {
+        "ultimo_numero": ultimo,
+        "confirmados": len(confirmados),
+        "duplicados": duplicados,
+        "confirmados_sem_registro": len(set(confirmados) - por_status.get("utilizado", set())),
+        "reservas_pendentes": len(por_status.get("reservado", ())),
+        "livres": len(por_status.get("livre", ())),
+        "a_inutilizar": len(por_status.get("inutilizar", ())),
+        "lacunas": agrupar_faixas(lacunas),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de concorrência do numerador de NF-e.")
+    parser.add_argument("--processos", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--operacoes", type=int, default=200, help="Reservas por thread")
+    parser.add_argument("--json", action="store_true", help="Imprime o resultado em JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "numeracao.sqlite3")
+        NumeracaoStore(db_path) # create the schema before the workers race for it
+        inicio = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.processos) as pool:
+            futuros = [pool.submit(trabalhador, db_path, args.threads, args.operacoes, p) for p in range(args.processos)]
+            confirmados = [numero for futuro in futuros for numero in futuro.result()]
+        duracao = time.perf_counter() - inicio
+        resultado = verificar(db_path, confirmados)
+
+    reservas = args.processos * args.threads * args.operacoes
+    resultado.update({"processos": args.processos, "threads": args.threads, "reservas": reservas,
+                      "segundos": round(duracao, 2), "reservas_por_segundo": round(reservas / duracao)})
+    ok = not resultado["duplicados"] and not resultado["lacunas"] and not resultado["confirmados_sem_registro"] \
+        and not resultado["reservas_pendentes"]
+    resultado["ok"] = ok
+    if args.json:
+        print(json.dumps(resultado, indent=2))
+    else:
+        print(f"{reservas} reservas em {resultado['segundos']} s ({resultado['reservas_por_segundo']}/s) "
+              f"com {args.processos} processos x {args.threads} threads")
+        print(f"último número {resultado['ultimo_numero']}: {resultado['confirmados']} utilizados, {resultado['livres']} livres, "
+              f"{resultado['a_inutilizar']} a inutilizar")
+        print(f"duplicados: {resultado['duplicados']}, lacunas: {resultado['lacunas'] or 'nenhuma'}, "
+              f"reservas pendentes: {resultado['reservas_pendentes']} -> {'OK' if ok else 'FALHOU'}")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,350 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/benchmarks/stub_sefaz.py
+# Local stand-in for the SEFAZ web services, for load tests and benchmarks.
+#
+# Serves HTTPS with client-certificate authentication like the real authorizers. A throwaway CA,
+# server certificate and A1-style client PFX are generated on start, so the service can be pointed
+# at the stub with SEFAZ_CA_BUNDLE + SEFAZ_URL_OVERRIDE and register the PFX like a real certificate.
+# The operation is told from the message itself, so any path works:
+#   autorizacao   enviNFe (NFeAutorizacao4): indSinc=1 answers protNFe at once, otherwise a recibo (103)
+#   retorno       consReciNFe (NFeRetAutorizacao4): the protNFe of every nota sent with that recibo
+#   status        consStatServ (NFeStatusServico4)
+#   distribuicao  distDFeInt (NFeDistribuicaoDFe): distNSU pages of resNFe documents
+# Each operation answers after its own delay (the authorizer's latency, optionally with jitter) and
+# with a configurable cStat: "autorizacao" for every protNFe, "lote" for retEnviNFe/retConsReciNFe,
+# "status" and "distribuicao" for theirs. A roteiro (operation -> list of cStats) scripts the next
+# answers of an operation one request at a time, falling back to the configured cStat once used up,
+# e.g. {"distribuicao": ["138", "656"]} for a consumo indevido on the second page. Distribution serves
+# documentos_por_pagina documents per page; with max_nsu it stops there (maxNSU, then 137), otherwise
+# every page is the last one.
+#
+#   python benchmarks/stub_sefaz.py [--porta 8443] [--atraso 0.2] [--atraso-operacao autorizacao=0.8]
+#                                   [--cstat autorizacao=539] [--variacao 0.2] [--max-nsu 50]
+import os
+import ssl
+import gzip
+import re
+import time
+import base64
+import random
+import shutil
+import argparse
+import datetime
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+
+NFE_NS = "http://www.portalfiscal.inf.br/nfe"
+SOAP_NS = "http://www.w3.org/2003/05/soap-envelope"
+DISTRIBUICAO_WSDL_NS = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeDistribuicaoDFe"
+AUTORIZACAO_WSDL_NS = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeAutorizacao4"
+RET_AUTORIZACAO_WSDL_NS = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeRetAutorizacao4"
+STATUS_WSDL_NS = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeStatusServico4"
+SENHA_PFX = "1234"
+CNPJ_CERTIFICADO = "00000000000191"
+
+OPERACOES = ("autorizacao", "retorno", "status", "distribuicao")
+# Message root -> operation
+RAIZES = {"<enviNFe": "autorizacao", "<consReciNFe": "retorno", "<consStatServ": "status", "<distDFeInt": "distribuicao"}
+CSTATS_PADRAO = {"autorizacao": "100", "lote": "104", "status": "107", "distribuicao": "138"}
+MOTIVOS = {
+    "100": "Autorizado o uso da NF-e",
+    "103": "Lote recebido com sucesso",
+    "104": "Lote processado",
+    "106": "Lote não localizado",
+    "107": "Serviço em Operação",
+    "108": "Serviço Paralisado Momentaneamente (curto prazo)",
+    "137": "Nenhum documento localizado para o destinatário",
+    "138": "Documento localizado para o destinatário",
+    "204": "Rejeição: Duplicidade de NF-e",
+    "539": "Rejeição: Duplicidade de NF-e com diferença na Chave de Acesso",
+    "656": "Rejeição: Consumo Indevido",
+}
+
+
+def _chave():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def _certificado(nome, chave_publica, emissor, chave_emissor, ca=False, dns=None):
+    agora = datetime.datetime.now(datetime.timezone.utc)
+    builder = (x509.CertificateBuilder()
+               .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, nome)]))
+               .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, emissor)]))
+               .public_key(chave_publica)
+               .serial_number(x509.random_serial_number())
+               .not_valid_before(agora - datetime.timedelta(minutes=5))
+               .not_valid_after(agora + datetime.timedelta(days=7))
+               .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+    if dns:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(dns)]), critical=False)
+    return builder.sign(chave_emissor, hashes.SHA256())
+
+
+class Credenciais:
+    """Throwaway CA, server certificate and client PFX, written to a temporary directory."""
+
+    def __init__(self):
+        self.diretorio = tempfile.mkdtemp(prefix="stub_sefaz_")
+        chave_ca = _chave()
+        ca = _certificado("Stub SEFAZ CA", chave_ca.public_key(), "Stub SEFAZ CA", chave_ca, ca=True)
+        chave_servidor = _chave()
+        servidor = _certificado("localhost", chave_servidor.public_key(), "Stub SEFAZ CA", chave_ca, dns="localhost")
+        chave_cliente = _chave()
+        cliente = _certificado(f"LOJA MAE LTDA:{CNPJ_CERTIFICADO}", chave_cliente.public_key(), "Stub SEFAZ CA", chave_ca)
+
+        self.ca_path = os.path.join(self.diretorio, "ca.pem")
+        self.servidor_path = os.path.join(self.diretorio, "servidor.pem")
+        with open(self.ca_path, "wb") as f:
+            f.write(ca.public_bytes(serialization.Encoding.PEM))
+        with open(self.servidor_path, "wb") as f:
+            f.write(servidor.public_bytes(serialization.Encoding.PEM) + chave_servidor.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        self.pfx = pkcs12.serialize_key_and_certificates(b"a1", chave_cliente, cliente, [ca],
+                                                         serialization.BestAvailableEncryption(SENHA_PFX.encode()))
+        self.pfx_base64 = base64.b64encode(self.pfx).decode()
+        self.pfx_path = os.path.join(self.diretorio, "cliente.pfx")
+        with open(self.pfx_path, "wb") as f:
+            f.write(self.pfx)
+
+    def remover(self):
+        shutil.rmtree(self.diretorio, ignore_errors=True)
+
+
+def _envelope(operacao, wsdl_ns, conteudo):
+    return (f'<soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body><{operacao}Response xmlns="{wsdl_ns}">'
+            f'<{operacao}Result>{conteudo}</{operacao}Result></{operacao}Response></soap:Body></soap:Envelope>').encode()
+
+
+def _envelope_v4(wsdl_ns, conteudo):
+    return (f'<soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body><nfeResultMsg xmlns="{wsdl_ns}">{conteudo}'
+            f'</nfeResultMsg></soap:Body></soap:Envelope>').encode()
+
+
+def _motivo(cstat):
+    return MOTIVOS.get(cstat, "Rejeição: resposta configurada no stub")
+
+
+def _agora():
+    return datetime.datetime.now(datetime.timezone.utc).astimezone().isoformat(timespec="seconds")
+
+
+def _campo(corpo, tag, padrao=""):
+    inicio = corpo.find(f"<{tag}>")
+    return corpo[inicio + len(tag) + 2:corpo.find(f"</{tag}>", inicio)] if inicio >= 0 else padrao
+
+
+def protocolo(chave, cstat, tp_amb="2"):
+    autorizado = cstat in ("100", "150")
+    return (f'<protNFe versao="4.00"><infProt><tpAmb>{tp_amb}</tpAmb><verAplic>STUB-1.0</verAplic><chNFe>{chave}</chNFe>'
+            f'<dhRecbto>{_agora()}</dhRecbto>' + (f'<nProt>1{chave[-14:]}</nProt>' if autorizado else '')
+            + f'<cStat>{cstat}</cStat><xMotivo>{_motivo(cstat)}</xMotivo></infProt></protNFe>')
+
+
+def resposta_autorizacao(chaves, cstat_lote="104", cstat_nota="100", sincrono=True, recibo=None, tp_amb="2", c_uf="35"):
+    """retEnviNFe: with the protNFe of each nota when processed synchronously, or the recibo (103) otherwise."""
+    if not sincrono and cstat_lote == "104":
+        cstat_lote, conteudo = "103", f"<infRec><nRec>{recibo}</nRec><tMed>1</tMed></infRec>"
+    else:
+        conteudo = "".join(protocolo(chave, cstat_nota, tp_amb) for chave in chaves) if cstat_lote == "104" else ""
+    return _envelope_v4(AUTORIZACAO_WSDL_NS,
+                        f'<retEnviNFe xmlns="{NFE_NS}" versao="4.00"><tpAmb>{tp_amb}</tpAmb><verAplic>STUB-1.0</verAplic>'
+                        f'<cStat>{cstat_lote}</cStat><xMotivo>{_motivo(cstat_lote)}</xMotivo><cUF>{c_uf}</cUF>'
+                        f'<dhRecbto>{_agora()}</dhRecbto>{conteudo}</retEnviNFe>')
+
+
+def resposta_retorno(recibo, chaves, cstat_lote="104", cstat_nota="100", tp_amb="2", c_uf="35"):
+    """retConsReciNFe for a recibo; chaves None means the recibo is unknown (106)."""
+    if chaves is None:
+        cstat_lote = "106"
+    protocolos = "".join(protocolo(chave, cstat_nota, tp_amb) for chave in chaves) if cstat_lote == "104" else ""
+    return _envelope_v4(RET_AUTORIZACAO_WSDL_NS,
+                        f'<retConsReciNFe xmlns="{NFE_NS}" versao="4.00"><tpAmb>{tp_amb}</tpAmb><verAplic>STUB-1.0</verAplic>'
+                        f'<nRec>{recibo}</nRec><cStat>{cstat_lote}</cStat><xMotivo>{_motivo(cstat_lote)}</xMotivo>'
+                        f'<cUF>{c_uf}</cUF><dhRecbto>{_agora()}</dhRecbto>{protocolos}</retConsReciNFe>')
+
+
+def resposta_status(cstat="107", tp_amb="2", c_uf="35"):
+    return _envelope_v4(STATUS_WSDL_NS,
+                        f'<retConsStatServ xmlns="{NFE_NS}" versao="4.00"><tpAmb>{tp_amb}</tpAmb><verAplic>STUB-1.0</verAplic>'
+                        f'<cStat>{cstat}</cStat><xMotivo>{_motivo(cstat)}</xMotivo><cUF>{c_uf}</cUF>'
+                        f'<dhRecbto>{_agora()}</dhRecbto><tMed>1</tMed></retConsStatServ>')
+
+
+def resposta_distribuicao(ult_nsu, documentos=3, cstat="138", max_nsu=None):
+    if cstat != "138":
+        documentos = 0 # 137 (nothing new), 656 (consumo indevido)...
+    docs = []
+    for nsu in range(ult_nsu + 1, ult_nsu + documentos + 1):
+        res_nfe = (f'<resNFe xmlns="{NFE_NS}" versao="1.01"><chNFe>35240112345678000195550010{nsu:018d}</chNFe>'
+                   f'<CNPJ>12345678000195</CNPJ><xNome>Fornecedor Stub</xNome><dhEmi>2024-01-15T10:00:00-03:00</dhEmi>'
+                   f'<tpNF>1</tpNF><vNF>100.00</vNF><cSitNFe>1</cSitNFe></resNFe>')
+        docs.append(f'<docZip NSU="{nsu:015d}" schema="resNFe_v1.01.xsd">'
+                    f'{base64.b64encode(gzip.compress(res_nfe.encode())).decode()}</docZip>')
+    ultimo = ult_nsu + documentos
+    max_nsu = ultimo if max_nsu is None else max_nsu
+    return _envelope("nfeDistDFeInteresse", DISTRIBUICAO_WSDL_NS,
+                     f'<retDistDFeInt xmlns="{NFE_NS}" versao="1.01"><tpAmb>2</tpAmb><cStat>{cstat}</cStat>'
+                     f'<xMotivo>{_motivo(cstat)}</xMotivo><dhResp>{datetime.datetime.now().isoformat()}</dhResp>'
+                     f'<ultNSU>{ultimo:015d}</ultNSU><maxNSU>{max_nsu:015d}</maxNSU>'
+                     f'<loteDistDFeInt>{"".join(docs)}</loteDistDFeInt></retDistDFeInt>')
+
+
+class StubSefaz:
+    def __init__(self, porta=0, atraso=0.2, atrasos=None, cstats=None, variacao=0.0, roteiro=None, max_nsu=None,
+                 documentos_por_pagina=3):
+        self.atraso = atraso
+        self.atrasos = dict(atrasos or {}) # operation -> seconds, overriding atraso
+        self.cstats = dict(CSTATS_PADRAO, **(cstats or {}))
+        self.variacao = variacao # Each delay is drawn from atraso * (1 +- variacao)
+        self.roteiro = {campo: list(cstats) for campo, cstats in (roteiro or {}).items()}
+        self.max_nsu = max_nsu
+        self.documentos_por_pagina = documentos_por_pagina
+        self.consultas_nsu = [] # ultNSU of every distribution request, in order
+        self.credenciais = Credenciais()
+        self.requisicoes = 0
+        self.conexoes = 0 # TLS connections accepted, so one client-auth handshake each
+        self.requisicoes_por_operacao = dict.fromkeys(OPERACOES, 0)
+        self.recibos = {} # nRec -> chaves sent in that lote
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.conexoes += 1
+
+            def do_POST(self):
+                corpo = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8", "replace")
+                operacao = next((operacao for raiz, operacao in RAIZES.items() if raiz in corpo), None)
+                with stub._lock:
+                    stub.requisicoes += 1
+                    if operacao:
+                        stub.requisicoes_por_operacao[operacao] += 1
+                time.sleep(stub.atraso_de(operacao))
+                if operacao is None:
+                    self._responder(500, f'<soap:Envelope xmlns:soap="{SOAP_NS}"><soap:Body><soap:Fault><soap:Reason>'
+                                         f'<soap:Text>Operação não reconhecida</soap:Text></soap:Reason></soap:Fault>'
+                                         f'</soap:Body></soap:Envelope>'.encode())
+                    return
+                self._responder(200, stub.responder(operacao, corpo))
+
+            def _responder(self, status, resposta):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/soap+xml; charset=utf-8")
+                self.send_header("Content-Length", str(len(resposta)))
+                self.end_headers()
+                self.wfile.write(resposta)
+
+            def log_message(self, *args):
+                pass
+
+        self.servidor = ThreadingHTTPServer(("localhost", porta), Handler)
+        self.servidor.daemon_threads = True
+        contexto = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        contexto.load_cert_chain(self.credenciais.servidor_path)
+        contexto.load_verify_locations(self.credenciais.ca_path)
+        contexto.verify_mode = ssl.CERT_REQUIRED
+        self.servidor.socket = contexto.wrap_socket(self.servidor.socket, server_side=True)
+
+    def atraso_de(self, operacao):
+        atraso = self.atrasos.get(operacao, self.atraso)
+        return max(0.0, atraso * (1 + random.uniform(-self.variacao, self.variacao))) if self.variacao else atraso
+
+    def cstat(self, campo):
+        """The next scripted cStat for campo, or the configured one."""
+        with self._lock:
+            roteiro = self.roteiro.get(campo)
+            return roteiro.pop(0) if roteiro else self.cstats[campo]
+
+    def responder(self, operacao, corpo):
+        tp_amb = _campo(corpo, "tpAmb", "2")
+        c_uf = _campo(corpo, "cUF") or _campo(corpo, "cUFAutor", "35")
+        if operacao == "autorizacao":
+            chaves = re.findall(r'Id="NFe(\d{44})"', corpo)
+            c_uf = chaves[0][:2] if chaves else c_uf
+            sincrono = _campo(corpo, "indSinc") == "1"
+            recibo = None
+            if not sincrono:
+                recibo = f"{c_uf}{random.randrange(10 ** 12, 10 ** 13)}"
+                with self._lock:
+                    self.recibos[recibo] = chaves
+            return resposta_autorizacao(chaves, self.cstat("lote"), self.cstat("autorizacao"), sincrono, recibo, tp_amb, c_uf)
+        if operacao == "retorno":
+            recibo = _campo(corpo, "nRec")
+            with self._lock:
+                chaves = self.recibos.pop(recibo, None)
+            return resposta_retorno(recibo, chaves, self.cstat("lote"), self.cstat("autorizacao"), tp_amb, recibo[:2] or c_uf)
+        if operacao == "status":
+            return resposta_status(self.cstat("status"), tp_amb, c_uf)
+        ult_nsu = int(_campo(corpo, "ultNSU", "0") or 0)
+        with self._lock:
+            self.consultas_nsu.append(ult_nsu)
+        cstat = self.cstat("distribuicao")
+        documentos = self.documentos_por_pagina
+        if self.max_nsu is not None:
+            documentos = min(documentos, max(0, self.max_nsu - ult_nsu))
+            if not documentos and cstat == "138":
+                cstat = "137"
+        return resposta_distribuicao(ult_nsu, documentos, cstat, self.max_nsu)
+
+    @property
+    def url_base(self):
+        """For SEFAZ_URL_OVERRIDE: every call the service makes lands here, whatever its path."""
+        return f"https://localhost:{self.servidor.server_address[1]}"
+
+    @property
+    def url(self):
+        return f"{self.url_base}/ws"
+
+    def iniciar(self):
+        threading.Thread(target=self.servidor.serve_forever, name="stub-sefaz", daemon=True).start()
+        return self
+
+    def parar(self):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+        self.credenciais.remover()
+
+
+def ler_pares(pares, conversao=str):
+    resultado = {}
+    for par in pares or ():
+        operacao, _, valor = par.partition("=")
+        resultado[operacao.strip()] = conversao(valor)
+    return resultado
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub local dos web services da SEFAZ (HTTPS com certificado de cliente).")
+    parser.add_argument("--porta", type=int, default=8443)
+    parser.add_argument("--atraso", type=float, default=0.2, help="Segundos de espera antes de cada resposta")
+    parser.add_argument("--atraso-operacao", action="append", metavar="OPERACAO=SEGUNDOS",
+                        help=f"Atraso de uma operação ({', '.join(OPERACOES)}); pode ser repetido")
+    parser.add_argument("--cstat", action="append", metavar="CAMPO=CSTAT",
+                        help=f"cStat de resposta ({', '.join(CSTATS_PADRAO)}); pode ser repetido")
+    parser.add_argument("--variacao", type=float, default=0.0, help="Variação relativa aleatória dos atrasos (0.2 = ±20%%)")
+    parser.add_argument("--max-nsu", type=int, help="Último NSU disponível na distribuição (padrão: sem limite)")
+    parser.add_argument("--documentos-por-pagina", type=int, default=3, help="Documentos por página de distribuição")
+    args = parser.parse_args()
+
+    stub = StubSefaz(args.porta, args.atraso, ler_pares(args.atraso_operacao, float), ler_pares(args.cstat), args.variacao,
+                     max_nsu=args.max_nsu, documentos_por_pagina=args.documentos_por_pagina)
+    print(f"SEFAZ_URL_OVERRIDE={stub.url_base}")
+    print(f"SEFAZ_DISTRIBUICAO_URL={stub.url}")
+    print(f"SEFAZ_CA_BUNDLE={stub.credenciais.ca_path}")
+    print(f"Certificado do cliente: {stub.credenciais.pfx_path} (senha {SENHA_PFX})")
+    try:
+        stub.servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.credenciais.remover()
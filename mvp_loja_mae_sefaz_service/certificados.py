@@ -0,0 +1,347 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/certificados.py
+# In-memory registry of A1 certificates (PFX) used by the SEFAZ service.
+#
+# A PFX is decoded and decrypted once, when it is registered, and the caller gets back an opaque
+# handle. Emission and distribution requests reference that handle instead of shipping the whole
+# certificate_base64 on every call. Key and certificate material live in an LRU cache with a TTL;
+# the files PyNFe and the HTTPS client need are written once per certificate to tmpfs with 0600
+# permissions and removed again on eviction.
+#
+# The registry is per process. When several worker processes serve the same handles, set
+# SEFAZ_CERT_SHARED_DIR (a tmpfs directory): registered PFXs are also written there, encrypted with a
+# key derived from SEFAZ_CERT_HANDLE_SECRET, and a worker that does not know a handle loads it from
+# there on first use. With a fixed SEFAZ_CERT_HANDLE_SECRET and a SEFAZ_CERT_SHARED_DIR kept across
+# restarts, handles (and so queued emission jobs) also outlive the server until their TTL expires.
+#
+# An emission reads a certificate's files after resolving it (the HTTPS session loads the PEMs, PyNFe
+# gets the PFX path), and another request may evict the entry in between. Code running inside
+# certificados_reservados() holds a reservation on every entry it resolves: an entry evicted while
+# reserved leaves the registry at once, but its directory is only removed when the last reservation ends.
+import os
+import atexit
+import base64
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+
+logger = logging.getLogger(__name__)
+
+CERT_CACHE_MAX_ENTRIES = int(os.environ.get("SEFAZ_CERT_CACHE_MAX_ENTRIES", 64))
+CERT_CACHE_TTL_SECONDS = int(os.environ.get("SEFAZ_CERT_CACHE_TTL_SECONDS", 8 * 3600))
+# Handles are HMACs of the PFX digest; without a configured secret they are only valid for this process
+CERT_HANDLE_SECRET = os.environ.get("SEFAZ_CERT_HANDLE_SECRET", "").encode() or os.urandom(32)
+CERT_SHARED_DIR = os.environ.get("SEFAZ_CERT_SHARED_DIR")
+
+
+class CertificateError(Exception):
+    """Raised when a PFX cannot be decoded or decrypted."""
+
+
+class CertificadoRegistrado:
+    def __init__(self, handle, fingerprint_sha256, pfx_digest, senha, private_key, certificate,
+                 directory, expires_at):
+        self.handle = handle
+        self.fingerprint_sha256 = fingerprint_sha256
+        self.pfx_digest = pfx_digest
+        self.senha = senha
+        self.private_key = private_key
+        self.certificate = certificate
+        self.directory = directory
+        self.pfx_path = os.path.join(directory, "certificado.pfx")
+        self.cert_pem_path = os.path.join(directory, "certificado.pem")
+        self.key_pem_path = os.path.join(directory, "chave.pem")
+        self.expires_at = expires_at
+        self.reservas = 0 # certificados_reservados() blocks using the files
+        self.descartado = False
+
+    @property
+    def titular(self):
+        attributes = self.certificate.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+        return attributes[0].value if attributes else self.certificate.subject.rfc4514_string()
+
+    @property
+    def valido_ate(self):
+        return self.certificate.not_valid_after_utc if hasattr(self.certificate, "not_valid_after_utc") \
+            else self.certificate.not_valid_after.replace(tzinfo=timezone.utc)
+
+    def is_expired(self, now=None):
+        return (now or time.time()) >= self.expires_at
+
+    def to_dict(self):
+        return {
+            "certificate_handle": self.handle,
+            "fingerprint_sha256": self.fingerprint_sha256,
+            "titular": self.titular,
+            "valido_ate": self.valido_ate.isoformat(),
+            "expira_em": datetime.fromtimestamp(self.expires_at, tz=timezone.utc).isoformat(),
+        }
+
+
+def _secure_base_dir():
+    # Prefer tmpfs so decrypted key material never touches a disk
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _write_private_file(path, content):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(content)
+
+
+_reservas_atuais = contextvars.ContextVar("reservas_certificados", default=None)
+
+
+@contextmanager
+def certificados_reservados():
+    """
+    Keeps the files of every certificate resolved inside the block on disk until the block exits, even if
+    the entry is evicted or removed meanwhile. Also usable as a decorator.
+    """
+    reservas = [] # (registry, entry)
+    token = _reservas_atuais.set(reservas)
+    try:
+        yield
+    finally:
+        _reservas_atuais.reset(token)
+        for registry, entry in reservas:
+            registry._liberar(entry)
+
+
+class SharedCertificateSpool:
+    """PFXs shared between the worker processes of one server, one encrypted file per handle."""
+
+    def __init__(self, directory, secret=CERT_HANDLE_SECRET):
+        self.directory = directory
+        self._fernet = Fernet(base64.urlsafe_b64encode(hmac.new(secret, b"spool", hashlib.sha256).digest()))
+
+    def _path(self, handle):
+        return os.path.join(self.directory, f"{handle}.pfx.enc")
+
+    def save(self, handle, pfx_bytes, senha, expires_at):
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        token = self._fernet.encrypt(json.dumps({"pfx": base64.b64encode(pfx_bytes).decode(), "senha": senha,
+                                                 "expires_at": expires_at}).encode())
+        tmp_path = f"{self._path(handle)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        _write_private_file(tmp_path, token)
+        os.replace(tmp_path, self._path(handle))
+
+    def load(self, handle):
+        """Returns (pfx_bytes, senha, expires_at), or None if the handle is not in the spool or has expired."""
+        try:
+            with open(self._path(handle), "rb") as f:
+                entry = json.loads(self._fernet.decrypt(f.read()))
+        except FileNotFoundError:
+            return None
+        except (InvalidToken, ValueError) as e:
+            logger.warning(f"Ignoring unreadable shared certificate {handle[:16]}...: {e}")
+            return None
+        if entry["expires_at"] <= time.time():
+            self.remove(handle)
+            return None
+        return base64.b64decode(entry["pfx"]), entry["senha"], entry["expires_at"]
+
+    def remove(self, handle):
+        try:
+            os.remove(self._path(handle))
+        except FileNotFoundError:
+            pass
+
+
+class CertificateRegistry:
+    def __init__(self, max_entries=CERT_CACHE_MAX_ENTRIES, ttl_seconds=CERT_CACHE_TTL_SECONDS, shared_dir=CERT_SHARED_DIR):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict() # handle -> CertificadoRegistrado, least recently used first
+        self._lock = threading.Lock()
+        self._base_dir = None
+        self.spool = SharedCertificateSpool(shared_dir) if shared_dir else None
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_base_dir(self):
+        if self._base_dir is None:
+            self._base_dir = tempfile.mkdtemp(prefix="sefaz_certs_", dir=_secure_base_dir())
+            os.chmod(self._base_dir, 0o700)
+        return self._base_dir
+
+    def register(self, pfx_bytes, senha, expires_at=None):
+        """Registers a PFX (raw bytes) and returns its CertificadoRegistrado, reusing a cached entry if present."""
+        pfx_digest = hashlib.sha256(pfx_bytes).hexdigest()
+        handle = hmac.new(CERT_HANDLE_SECRET, pfx_digest.encode(), hashlib.sha256).hexdigest()
+        with self._lock:
+            self._purge_expired_locked()
+            entry = self._entries.get(handle)
+            if entry is not None and hmac.compare_digest(entry.senha.encode(), (senha or "").encode()):
+                self._entries.move_to_end(handle)
+                self.hits += 1
+                return self._reservar_locked(entry)
+            self.misses += 1
+
+        try:
+            private_key, certificate, additional = pkcs12.load_key_and_certificates(
+                pfx_bytes, senha.encode() if senha else None)
+        except Exception as e:
+            raise CertificateError(f"Não foi possível abrir o certificado PFX: {e}") from e
+        if private_key is None or certificate is None:
+            raise CertificateError("O PFX não contém chave privada e certificado.")
+
+        fingerprint = certificate.fingerprint(hashes.SHA256()).hex()
+        directory = tempfile.mkdtemp(prefix=f"{fingerprint[:12]}_", dir=self._ensure_base_dir())
+        shared = expires_at is not None # loaded from the spool, which already has it
+        expires_at = expires_at or time.time() + self.ttl_seconds
+        entry = CertificadoRegistrado(handle, fingerprint, pfx_digest, senha or "", private_key, certificate,
+                                      directory, expires_at)
+        try:
+            _write_private_file(entry.pfx_path, pfx_bytes)
+            chain = [certificate] + list(additional or [])
+            _write_private_file(entry.cert_pem_path,
+                                b"".join(c.public_bytes(serialization.Encoding.PEM) for c in chain))
+            _write_private_file(entry.key_pem_path, private_key.private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption()))
+        except Exception:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        with self._lock:
+            previous = self._entries.get(handle)
+            if previous is not None and hmac.compare_digest(previous.senha.encode(), entry.senha.encode()):
+                # Another thread registered the same PFX first; its files may already be in use
+                shutil.rmtree(directory, ignore_errors=True)
+                self._entries.move_to_end(handle)
+                return self._reservar_locked(previous)
+            self._entries.pop(handle, None)
+            if previous is not None:
+                self._discard_locked(previous)
+            self._entries[handle] = entry
+            self._reservar_locked(entry)
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._discard_locked(evicted)
+        if self.spool is not None and not shared:
+            self.spool.save(handle, pfx_bytes, entry.senha, expires_at)
+        logger.info(f"Certificate {fingerprint[:16]}... registered ({entry.titular}).")
+        return entry
+
+    def register_base64(self, cert_base64, senha):
+        try:
+            pfx_bytes = base64.b64decode(cert_base64, validate=False)
+        except Exception as e:
+            raise CertificateError(f"certificate_base64 inválido: {e}") from e
+        return self.register(pfx_bytes, senha)
+
+    def get(self, handle):
+        """Returns the registered certificate for a handle, or None if unknown or expired."""
+        with self._lock:
+            self._purge_expired_locked()
+            entry = self._entries.get(handle)
+            if entry is not None:
+                self._entries.move_to_end(handle)
+                self.hits += 1
+                return self._reservar_locked(entry)
+            self.misses += 1
+        # Possibly registered by another worker process
+        shared = self.spool.load(handle) if self.spool is not None else None
+        if shared is None:
+            return None
+        pfx_bytes, senha, expires_at = shared
+        entry = self.register(pfx_bytes, senha, expires_at=expires_at)
+        return entry if entry.handle == handle else None
+
+    def remove(self, handle):
+        if self.spool is not None:
+            self.spool.remove(handle)
+        with self._lock:
+            entry = self._entries.pop(handle, None)
+            if entry is not None:
+                self._discard_locked(entry)
+            return entry is not None
+
+    def clear(self):
+        with self._lock:
+            while self._entries:
+                _, entry = self._entries.popitem()
+                self._discard_locked(entry)
+            if self._base_dir:
+                shutil.rmtree(self._base_dir, ignore_errors=True)
+                self._base_dir = None
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "ttl_seconds": self.ttl_seconds, "hits": self.hits, "misses": self.misses}
+
+    def _purge_expired_locked(self):
+        now = time.time()
+        for handle in [h for h, e in self._entries.items() if e.is_expired(now)]:
+            self._discard_locked(self._entries.pop(handle))
+
+    def _reservar_locked(self, entry):
+        reservas = _reservas_atuais.get()
+        if reservas is not None:
+            entry.reservas += 1
+            reservas.append((self, entry))
+        return entry
+
+    def _liberar(self, entry):
+        with self._lock:
+            entry.reservas -= 1
+            if entry.reservas == 0 and entry.descartado:
+                shutil.rmtree(entry.directory, ignore_errors=True)
+
+    def _discard_locked(self, entry):
+        entry.descartado = True
+        if entry.reservas == 0: # Otherwise the last reservation removes the files
+            shutil.rmtree(entry.directory, ignore_errors=True)
+        logger.info(f"Certificate {entry.fingerprint_sha256[:16]}... evicted from registry.")
+
+
+registry = CertificateRegistry()
+atexit.register(registry.clear)
+
+
+def motivo_handle_nao_retomavel(handle):
+    """Why a handle saved by a previous server run cannot be resolved by this one, or None if it can."""
+    if not handle:
+        return "sem certificate_handle"
+    if registry.spool is None:
+        return "SEFAZ_CERT_SHARED_DIR não configurado; certificados registrados não sobrevivem a um reinício"
+    if registry.spool.load(handle) is None:
+        return ("certificado ausente ou expirado em SEFAZ_CERT_SHARED_DIR; retomar exige o mesmo "
+                "SEFAZ_CERT_HANDLE_SECRET e o diretório preservado entre reinícios")
+    return None
+
+
+def resolve_certificate(payload):
+    """
+    Resolves the certificate for a request payload: either a previously registered
+    certificate_handle or an inline certificate_base64 + certificate_password (registered on the fly).
+    Returns (entry, error_message).
+    """
+    handle = payload.get("certificate_handle")
+    if handle:
+        entry = registry.get(handle)
+        if entry is None:
+            return None, "certificate_handle desconhecido ou expirado; registre o certificado novamente"
+        return entry, None
+    cert_base64 = payload.get("certificate_base64")
+    cert_pass = payload.get("certificate_password")
+    if not cert_base64 or cert_pass is None:
+        return None, "Informe certificate_handle ou certificate_base64 e certificate_password"
+    return registry.register_base64(cert_base64, cert_pass), None
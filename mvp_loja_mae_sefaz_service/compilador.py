@@ -0,0 +1,280 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/compilador.py
+# Schema-driven compiler for the produtos array of an emission payload.
+#
+# The whole array is validated in one call against CAMPOS_PRODUTO and every problem is reported at
+# once, as {"item", "campo", "erro"}, instead of failing on the first bad field. Numbers are read as
+# decimal text (a JSON float goes through its shortest repr, so 10.1 stays 10.1) into Decimal,
+# quantized to the precision of the NF-e layout: 4 places for quantities, 10 for unit prices, 2 for
+# money and 4 for rates. Item values left out are computed with the same Decimal arithmetic, and the
+# header totals (vProd, vBC, vICMS, vPIS, vCOFINS, vFrete, vSeg, vDesc, vOutro, vIPI) are sums of the
+# quantized item values, so they always match the items that go into the XML and never drift the way
+# summed binary floats do (cStat 531/532 and friends). vNF follows the layout's formula over those
+# totals: vProd - vDesc + vFrete + vSeg + vOutro + vIPI (ICMS ST and II are not emitted by this service).
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+
+MAX_ITENS_NFE = 990 # det is limited to 990 occurrences per NF-e
+TOLERANCIA = Decimal("0.01") # SEFAZ accepts a one-centavo difference on computed values
+
+# Half-even, as in ABNT NBR 5891
+ARREDONDAMENTO = ROUND_HALF_EVEN
+
+TEXTO = "texto"
+DECIMAL = "decimal"
+
+CASAS_QUANTIDADE = 4
+CASAS_VALOR_UNITARIO = 10
+CASAS_VALOR = 2
+CASAS_ALIQUOTA = 4
+
+NCM_RE = re.compile(r"^(\d{2}|\d{8})$")
+CFOP_RE = re.compile(r"^\d{4}$")
+CST_IPI_RE = re.compile(r"^(00|49|50|99|0[1-5]|5[1-5])$")
+CST_IPI_TRIBUTADO = ("00", "49", "50", "99") # IPITrib; the others are IPINT, which carries no value
+
+
+class ProdutosInvalidos(ValueError):
+    """Raised with every problem found in a produtos array; erros is a list of {"item", "campo", "erro"}."""
+
+    def __init__(self, erros):
+        self.erros = erros
+        super().__init__(f"{len(erros)} erro(s) em produtos: " + "; ".join(
+            f"item {e['item']}, {e['campo']}: {e['erro']}" if e["item"] else f"{e['campo']}: {e['erro']}"
+            for e in erros[:5]) + ("; ..." if len(erros) > 5 else ""))
+
+
+class Campo:
+    """One field of the schema: where to read it (with fallbacks), its type and its constraints."""
+
+    __slots__ = ("nome", "caminhos", "tipo", "obrigatorio", "padrao", "casas", "minimo", "positivo", "formato",
+                 "tamanho_maximo", "rotulo")
+
+    def __init__(self, nome, *caminhos, tipo=TEXTO, obrigatorio=False, padrao=None, casas=0, minimo=None,
+                 positivo=False, formato=None, tamanho_maximo=None):
+        self.nome = nome
+        self.caminhos = tuple(tuple(caminho.split(".")) for caminho in (caminhos or (nome,)))
+        self.tipo = tipo
+        self.obrigatorio = obrigatorio
+        self.padrao = padrao
+        self.casas = casas
+        self.minimo = minimo
+        self.positivo = positivo
+        self.formato = formato
+        self.tamanho_maximo = tamanho_maximo
+        self.rotulo = (caminhos or (nome,))[0]
+
+
+# A fallback path always names another field of the schema, which validates (and reports) that value itself
+CAMPOS_PRODUTO = (
+    Campo("codigo", "codigo_produto", padrao="PROD{item}"),
+    Campo("descricao", obrigatorio=True, tamanho_maximo=120),
+    Campo("ncm", obrigatorio=True, formato=NCM_RE),
+    Campo("cfop", obrigatorio=True, formato=CFOP_RE),
+    Campo("unidade_comercial", padrao="UN"),
+    Campo("unidade_tributavel", "unidade_tributavel", "unidade_comercial", padrao="UN"),
+    Campo("informacoes_adicionais", "informacoes_adicionais_produto", padrao=""),
+    Campo("quantidade", tipo=DECIMAL, casas=CASAS_QUANTIDADE, obrigatorio=True, positivo=True),
+    Campo("valor_unitario", tipo=DECIMAL, casas=CASAS_VALOR_UNITARIO, obrigatorio=True, minimo=0),
+    Campo("quantidade_tributavel", "quantidade_tributavel", "quantidade", tipo=DECIMAL, casas=CASAS_QUANTIDADE,
+          positivo=True),
+    Campo("valor_unitario_tributavel", "valor_unitario_tributavel", "valor_unitario", tipo=DECIMAL,
+          casas=CASAS_VALOR_UNITARIO, minimo=0),
+    Campo("valor_total_bruto", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("valor_frete", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("valor_seguro", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("valor_desconto", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("valor_outras_despesas", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("icms_origem", "tributos.icms.origem", padrao="0"),
+    Campo("icms_cst", "tributos.icms.cst", padrao="00"),
+    Campo("icms_mod_bc", "tributos.icms.mod_bc", padrao="3"),
+    Campo("icms_valor_bc", "tributos.icms.valor_bc", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("icms_aliquota", "tributos.icms.aliquota", tipo=DECIMAL, casas=CASAS_ALIQUOTA, minimo=0),
+    Campo("icms_valor", "tributos.icms.valor", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("pis_cst", "tributos.pis.cst", padrao="01"),
+    Campo("pis_valor_bc", "tributos.pis.valor_bc", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("pis_aliquota", "tributos.pis.aliquota_percentual", tipo=DECIMAL, casas=CASAS_ALIQUOTA, minimo=0),
+    Campo("pis_valor", "tributos.pis.valor", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("cofins_cst", "tributos.cofins.cst", padrao="01"),
+    Campo("cofins_valor_bc", "tributos.cofins.valor_bc", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("cofins_aliquota", "tributos.cofins.aliquota_percentual", tipo=DECIMAL, casas=CASAS_ALIQUOTA, minimo=0),
+    Campo("cofins_valor", "tributos.cofins.valor", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    # IPI is optional: without a CST the item has no IPI group
+    Campo("ipi_cst", "tributos.ipi.cst", padrao="", formato=CST_IPI_RE),
+    Campo("ipi_classe_enquadramento", "tributos.ipi.classe_enquadramento", padrao="999", tamanho_maximo=3),
+    Campo("ipi_valor_bc", "tributos.ipi.valor_bc", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+    Campo("ipi_aliquota", "tributos.ipi.aliquota", tipo=DECIMAL, casas=CASAS_ALIQUOTA, minimo=0),
+    Campo("ipi_valor", "tributos.ipi.valor", tipo=DECIMAL, casas=CASAS_VALOR, minimo=0),
+)
+
+# (valor, base de cálculo, alíquota) of each tributo; valor is computed when the payload leaves it out
+TRIBUTOS = (("icms_valor", "icms_valor_bc", "icms_aliquota"),
+            ("pis_valor", "pis_valor_bc", "pis_aliquota"),
+            ("cofins_valor", "cofins_valor_bc", "cofins_aliquota"),
+            ("ipi_valor", "ipi_valor_bc", "ipi_aliquota"))
+# Per-item values that enter vNF as they are (vFrete, vSeg, vDesc, vOutro); zero when left out
+VALORES_ACESSORIOS = ("valor_frete", "valor_seguro", "valor_desconto", "valor_outras_despesas")
+
+# The quantum of each precision, built once instead of on every conversion
+QUANTUM = {casas: Decimal(1).scaleb(-casas) for casas in (CASAS_QUANTIDADE, CASAS_VALOR_UNITARIO, CASAS_VALOR, CASAS_ALIQUOTA)}
+CENTAVO = QUANTUM[CASAS_VALOR]
+ZERO = Decimal(0).quantize(CENTAVO)
+
+
+def para_decimal(valor, casas):
+    """Reads a JSON number or decimal string as a Decimal with `casas` places (rounded half-even)."""
+    if isinstance(valor, bool):
+        raise ValueError("não é um número")
+    texto = repr(valor) if isinstance(valor, float) else str(valor).strip()
+    try:
+        numero = Decimal(texto)
+    except InvalidOperation:
+        raise ValueError("não é um número") from None
+    if not numero.is_finite():
+        raise ValueError("não é um número")
+    try:
+        return numero.quantize(QUANTUM.get(casas) or Decimal(1).scaleb(-casas), rounding=ARREDONDAMENTO)
+    except InvalidOperation:
+        raise OverflowError("fora do intervalo suportado") from None
+
+
+class ProdutosCompilados:
+    """Validated produtos: one dict per item (Decimal for numeric fields) and the header totals."""
+
+    def __init__(self, itens, totais):
+        self._itens = itens
+        self.totais = totais
+
+    def __len__(self):
+        return len(self._itens)
+
+    def itens(self):
+        """One dict per item, with Decimal values, in the order of the payload."""
+        return iter(self._itens)
+
+
+def _ler(item, caminho):
+    if len(caminho) == 1: # Most fields sit at the top of the item, which is always a dict here
+        return item.get(caminho[0])
+    objeto = item
+    for chave in caminho:
+        if not isinstance(objeto, dict):
+            return None
+        objeto = objeto.get(chave)
+    return objeto
+
+
+def compilar_produtos(produtos):
+    """
+    Validates a produtos array and computes its item and header totals.
+    Returns ProdutosCompilados, or raises ProdutosInvalidos listing every invalid field of every item.
+    """
+    if not isinstance(produtos, list) or not produtos:
+        raise ProdutosInvalidos([{"item": None, "campo": "produtos", "erro": "deve ser uma lista não vazia"}])
+    if len(produtos) > MAX_ITENS_NFE:
+        raise ProdutosInvalidos([{"item": None, "campo": "produtos",
+                                  "erro": f"{len(produtos)} itens; uma NF-e aceita no máximo {MAX_ITENS_NFE}"}])
+
+    itens = []
+    erros = []
+    for numero, produto in enumerate(produtos, start=1):
+        if not isinstance(produto, dict):
+            erros.append({"item": numero, "campo": "produtos", "erro": "deve ser um objeto"})
+            continue
+        erros_do_item = []
+        item = {campo.nome: _compilar_campo(campo, produto, numero, erros_do_item) for campo in CAMPOS_PRODUTO}
+        if not erros_do_item: # The computed checks would be meaningless on fields that already failed
+            _calcular_item(item, numero, erros_do_item)
+        erros.extend(erros_do_item)
+        itens.append(item)
+    if erros:
+        raise ProdutosInvalidos(erros)
+
+    totais = {
+        "valor_produtos": sum((item["valor_total_bruto"] for item in itens), ZERO),
+        "icms_base_calculo": sum((item["icms_valor_bc"] for item in itens), ZERO),
+        "icms_valor": sum((item["icms_valor"] for item in itens), ZERO),
+        "pis_valor": sum((item["pis_valor"] for item in itens), ZERO),
+        "cofins_valor": sum((item["cofins_valor"] for item in itens), ZERO),
+        "ipi_valor": sum((item["ipi_valor"] for item in itens), ZERO),
+        **{nome: sum((item[nome] for item in itens), ZERO) for nome in VALORES_ACESSORIOS},
+    }
+    totais["valor_nota"] = (totais["valor_produtos"] - totais["valor_desconto"] + totais["valor_frete"]
+                            + totais["valor_seguro"] + totais["valor_outras_despesas"] + totais["ipi_valor"])
+    return ProdutosCompilados(itens, totais)
+
+
+def _compilar_campo(campo, produto, numero, erros):
+    """The field's value for one item; None for an absent number, which _calcular_item fills in."""
+    (caminho, *alternativas) = campo.caminhos
+    valor = _ler(produto, caminho)
+    if valor is None or valor == "":
+        for alternativa in alternativas:
+            valor = _ler(produto, alternativa)
+            if valor not in (None, ""):
+                # e.g. quantidade_tributavel falling back to quantidade: converted with this field's settings,
+                # errors are left to the field the value belongs to, so they are not reported twice
+                try:
+                    return _converter(campo, valor)
+                except (ValueError, OverflowError):
+                    return None
+        if campo.obrigatorio:
+            erros.append({"item": numero, "campo": campo.rotulo, "erro": "obrigatório"})
+            return None
+        return None if campo.tipo == DECIMAL else campo.padrao.format(item=numero)
+    try:
+        return _converter(campo, valor)
+    except OverflowError as e:
+        erros.append({"item": numero, "campo": campo.rotulo, "erro": str(e)})
+    except ValueError as e:
+        erros.append({"item": numero, "campo": campo.rotulo, "erro": f"{e}: {valor!r}" if campo.tipo == DECIMAL else str(e)})
+    return None
+
+
+def _converter(campo, valor):
+    if campo.tipo != DECIMAL:
+        texto = str(valor).strip()
+        if campo.formato is not None and not campo.formato.match(texto):
+            raise ValueError(f"formato inválido: {texto!r}")
+        if campo.tamanho_maximo is not None and len(texto) > campo.tamanho_maximo:
+            raise ValueError(f"mais de {campo.tamanho_maximo} caracteres")
+        return texto
+    numero = para_decimal(valor, campo.casas)
+    if campo.positivo and numero <= 0:
+        raise ValueError("deve ser maior que zero")
+    if campo.minimo is not None and numero < campo.minimo:
+        raise ValueError(f"deve ser maior ou igual a {campo.minimo}")
+    return numero
+
+
+def _calcular_item(item, numero, erros):
+    """Fills the derived values (vProd and tributo values) of one item and checks the ones the payload gave."""
+    calculado = (item["quantidade"] * item["valor_unitario"]).quantize(CENTAVO, rounding=ARREDONDAMENTO)
+    if item["valor_total_bruto"] is None:
+        item["valor_total_bruto"] = calculado
+    elif abs(item["valor_total_bruto"] - calculado) > TOLERANCIA:
+        erros.append({"item": numero, "campo": "valor_total_bruto",
+                      "erro": f"{item['valor_total_bruto']} difere de quantidade x valor_unitario ({calculado})"})
+    for nome_valor, nome_base, nome_aliquota in TRIBUTOS:
+        if item[nome_base] is None:
+            item[nome_base] = ZERO
+        if item[nome_aliquota] is None:
+            item[nome_aliquota] = Decimal(0).quantize(QUANTUM[CASAS_ALIQUOTA])
+        calculado = (item[nome_base] * item[nome_aliquota] / 100).quantize(CENTAVO, rounding=ARREDONDAMENTO)
+        if item[nome_valor] is None:
+            item[nome_valor] = calculado
+        elif item[nome_aliquota] and abs(item[nome_valor] - calculado) > TOLERANCIA:
+            erros.append({"item": numero, "campo": f"tributos.{nome_valor.split('_')[0]}.valor",
+                          "erro": f"{item[nome_valor]} difere de valor_bc x alíquota ({calculado})"})
+    for nome in VALORES_ACESSORIOS:
+        if item[nome] is None:
+            item[nome] = ZERO
+    if item["valor_desconto"] > item["valor_total_bruto"]:
+        erros.append({"item": numero, "campo": "valor_desconto",
+                      "erro": f"{item['valor_desconto']} maior que o valor do item ({item['valor_total_bruto']})"})
+    # PyNFe writes IPITrib only with base, alíquota and valor all set; any other IPI value would be counted in
+    # vNF without appearing in the item
+    if item["ipi_valor"] and item["ipi_cst"] not in CST_IPI_TRIBUTADO:
+        erros.append({"item": numero, "campo": "tributos.ipi.cst",
+                      "erro": f"IPI com valor exige CST tributado ({', '.join(CST_IPI_TRIBUTADO)})"})
+    elif item["ipi_valor"] and not (item["ipi_valor_bc"] and item["ipi_aliquota"]):
+        erros.append({"item": numero, "campo": "tributos.ipi.valor", "erro": "IPI com valor exige valor_bc e alíquota"})
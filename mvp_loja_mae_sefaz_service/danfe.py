@@ -0,0 +1,166 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/danfe.py
+# DANFE generation decoupled from the authorization path.
+#
+# The authorized XML of every emitted NF-e is kept on disk by chave de acesso. PDFs are rendered
+# on demand by a dedicated process pool (GerarDanfe is CPU-bound and would otherwise hold Flask
+# request threads), and cached on disk content-addressed by chave + SHA-256 of the XML, with a
+# size-bounded LRU eviction policy. Re-downloads are served straight from the cache. The pool starts
+# its processes from a forkserver, since forking a gunicorn gthread worker could copy locks held by
+# its other threads.
+import os
+import re
+import hashlib
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("SEFAZ_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+XML_DIR = os.path.join(DATA_DIR, "xml")
+DANFE_CACHE_DIR = os.environ.get("SEFAZ_DANFE_CACHE_DIR", os.path.join(DATA_DIR, "danfe"))
+DANFE_CACHE_MAX_BYTES = int(os.environ.get("SEFAZ_DANFE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+DANFE_WORKERS = int(os.environ.get("SEFAZ_DANFE_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+DANFE_TIMEOUT_SECONDS = float(os.environ.get("SEFAZ_DANFE_TIMEOUT", 60))
+
+CHAVE_ACESSO_RE = re.compile(r"^\d{44}$")
+
+
+def _render_danfe(xml_bytes):
+    # Runs inside the worker processes
+    from pynfe.utils.danfe import GerarDanfe
+    return GerarDanfe(xml=xml_bytes).gerar_danfe()
+
+
+def _write_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+class DanfeService:
+    def __init__(self, xml_dir=XML_DIR, cache_dir=DANFE_CACHE_DIR, max_bytes=DANFE_CACHE_MAX_BYTES,
+                 workers=DANFE_WORKERS):
+        self.xml_dir = xml_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._executor = None
+        self._in_flight = {} # cache key -> Future, so concurrent requests share one render
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _pool(self):
+        # Created lazily so the pool is started in the process that serves requests, not before a fork;
+        # called with self._lock held
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        return self._executor
+
+    def salvar_xml_autorizado(self, chave_acesso, xml_autorizado):
+        if not chave_acesso or not xml_autorizado:
+            return
+        os.makedirs(self.xml_dir, exist_ok=True)
+        if isinstance(xml_autorizado, str):
+            xml_autorizado = xml_autorizado.encode("utf-8")
+        _write_atomic(os.path.join(self.xml_dir, f"{chave_acesso}.xml"), xml_autorizado)
+
+    def carregar_xml_autorizado(self, chave_acesso):
+        try:
+            with open(os.path.join(self.xml_dir, f"{chave_acesso}.xml"), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def etag_for(xml_bytes):
+        return hashlib.sha256(xml_bytes).hexdigest()
+
+    def _cache_path(self, chave_acesso, xml_hash):
+        return os.path.join(self.cache_dir, f"{chave_acesso}_{xml_hash[:32]}.pdf")
+
+    def obter_pdf(self, chave_acesso, xml_bytes, timeout=DANFE_TIMEOUT_SECONDS):
+        """Returns the DANFE PDF for this XML, from the cache or rendered by the process pool."""
+        xml_hash = self.etag_for(xml_bytes)
+        path = self._cache_path(chave_acesso, xml_hash)
+        try:
+            with open(path, "rb") as f:
+                pdf_bytes = f.read()
+            os.utime(path) # mtime is the LRU clock
+            self.hits += 1
+            return pdf_bytes
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        future = self._submit(path, xml_bytes)
+        return future.result(timeout=timeout)
+
+    def prefetch(self, chave_acesso, xml_autorizado):
+        """Renders the DANFE in the background so the first download is a cache hit."""
+        if isinstance(xml_autorizado, str):
+            xml_autorizado = xml_autorizado.encode("utf-8")
+        path = self._cache_path(chave_acesso, self.etag_for(xml_autorizado))
+        if not os.path.exists(path):
+            self._submit(path, xml_autorizado)
+
+    def _submit(self, path, xml_bytes):
+        with self._lock:
+            future = self._in_flight.get(path)
+            if future is not None:
+                return future
+            future = self._pool().submit(_render_danfe, xml_bytes)
+            self._in_flight[path] = future
+        future.add_done_callback(lambda f: self._store(path, f))
+        return future
+
+    def _store(self, path, future):
+        try:
+            if future.exception() is None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                _write_atomic(path, future.result())
+                self._evict()
+            else:
+                logger.error(f"Error generating DANFE PDF: {future.exception()}")
+        except Exception:
+            logger.exception("Error caching DANFE PDF.")
+        finally:
+            with self._lock:
+                self._in_flight.pop(path, None)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(".pdf"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries): # least recently used first
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def encerrar(self):
+        """Shuts the render pool down; renders still queued are dropped (the next download re-renders)."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "in_flight": len(self._in_flight),
+                "max_bytes": self.max_bytes, "workers": self.workers}
+
+
+danfe_service = DanfeService()
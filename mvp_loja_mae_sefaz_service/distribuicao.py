@@ -0,0 +1,235 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/distribuicao.py
+# Incremental NFeDistribuicaoDFe sync engine (Ambiente Nacional).
+#
+# The last NSU received is persisted per CNPJ and ambiente, so each sync only pulls what is new.
+# A sync pages through distNSU responses until ultNSU reaches maxNSU, and docZip entries
+# (gzip + base64) are decoded one at a time while the SOAP response is streamed, so a page is never
+# held in memory as a whole. SEFAZ asks clients to wait one hour after catching up (cStat 137 or
+# ultNSU == maxNSU) and blocks the CNPJ for an hour on consumo indevido (cStat 656); both back-offs
+# are recorded in the cursor store and respected automatically.
+# Responses are parsed with extrator.IterparseSeguro: no entity expansion, and no DOCTYPE.
+import os
+import time
+import gzip
+import base64
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timezone
+
+from extrator import IterparseSeguro
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("SEFAZ_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+NSU_DB_PATH = os.environ.get("SEFAZ_NSU_DB", os.path.join(DATA_DIR, "distribuicao.sqlite3"))
+DISTRIBUICAO_URLS = {
+    "1": "https://www1.nfe.fazenda.gov.br/NFeDistribuicaoDFe/NFeDistribuicaoDFe.asmx",
+    "2": "https://hom1.nfe.fazenda.gov.br/NFeDistribuicaoDFe/NFeDistribuicaoDFe.asmx",
+}
+DISTRIBUICAO_URL_OVERRIDE = os.environ.get("SEFAZ_DISTRIBUICAO_URL") # e.g. a local stub replaying recorded responses
+DISTRIBUICAO_TIMEOUT_SECONDS = float(os.environ.get("SEFAZ_DISTRIBUICAO_TIMEOUT", 30))
+BACKOFF_SECONDS = 3600
+MAX_PAGINAS_POR_SYNC = int(os.environ.get("SEFAZ_DISTRIBUICAO_MAX_PAGINAS", 50))
+
+NFE_NS = "http://www.portalfiscal.inf.br/nfe"
+WSDL_NS = "http://www.portalfiscal.inf.br/nfe/wsdl/NFeDistribuicaoDFe"
+SOAP_ACTION = f"{WSDL_NS}/nfeDistDFeInteresse"
+
+CSTAT_DOCUMENTOS_LOCALIZADOS = "138"
+CSTAT_NENHUM_DOCUMENTO = "137"
+CSTAT_CONSUMO_INDEVIDO = "656"
+
+
+class DistribuicaoBloqueada(Exception):
+    """Raised when a sync is attempted while the CNPJ is inside a SEFAZ back-off window."""
+
+    def __init__(self, cnpj, bloqueado_ate, motivo):
+        self.cnpj = cnpj
+        self.bloqueado_ate = bloqueado_ate
+        self.motivo = motivo
+        super().__init__(f"Distribuição para {cnpj} em espera até {datetime.fromtimestamp(bloqueado_ate, tz=timezone.utc).isoformat()} ({motivo})")
+
+    @property
+    def retry_after(self):
+        return max(0, int(self.bloqueado_ate - time.time()))
+
+
+class NsuCursorStore:
+    def __init__(self, path=NSU_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS nsu_cursor (
+                    cnpj TEXT NOT NULL,
+                    ambiente TEXT NOT NULL,
+                    ult_nsu TEXT NOT NULL DEFAULT '000000000000000',
+                    max_nsu TEXT,
+                    bloqueado_ate REAL NOT NULL DEFAULT 0,
+                    ultimo_cstat TEXT,
+                    ultimo_motivo TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (cnpj, ambiente)
+                )""")
+
+    def get(self, cnpj, ambiente):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM nsu_cursor WHERE cnpj = ? AND ambiente = ?", (cnpj, ambiente)).fetchone()
+        if row:
+            return dict(row)
+        return {"cnpj": cnpj, "ambiente": ambiente, "ult_nsu": "0".zfill(15), "max_nsu": None, "bloqueado_ate": 0,
+                "ultimo_cstat": None, "ultimo_motivo": None, "updated_at": None}
+
+    def save(self, cnpj, ambiente, ult_nsu=None, max_nsu=None, bloqueado_ate=None, ultimo_cstat=None, ultimo_motivo=None):
+        atual = self.get(cnpj, ambiente)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO nsu_cursor (cnpj, ambiente, ult_nsu, max_nsu, bloqueado_ate, ultimo_cstat, ultimo_motivo, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (cnpj, ambiente,
+                 ult_nsu if ult_nsu is not None else atual["ult_nsu"],
+                 max_nsu if max_nsu is not None else atual["max_nsu"],
+                 bloqueado_ate if bloqueado_ate is not None else atual["bloqueado_ate"],
+                 ultimo_cstat if ultimo_cstat is not None else atual["ultimo_cstat"],
+                 ultimo_motivo if ultimo_motivo is not None else atual["ultimo_motivo"],
+                 time.time()))
+
+
+def montar_envelope_dist_nsu(cnpj, uf_codigo, ambiente, ult_nsu):
+    cpf_cnpj_tag = "CNPJ" if len(cnpj) == 14 else "CPF"
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<soap12:Envelope xmlns:soap12="http://www.w3.org/2003/05/soap-envelope">'
+        '<soap12:Body>'
+        f'<nfeDistDFeInteresse xmlns="{WSDL_NS}"><nfeDadosMsg>'
+        f'<distDFeInt xmlns="{NFE_NS}" versao="1.01">'
+        f'<tpAmb>{ambiente}</tpAmb><cUFAutor>{uf_codigo}</cUFAutor><{cpf_cnpj_tag}>{cnpj}</{cpf_cnpj_tag}>'
+        f'<distNSU><ultNSU>{str(ult_nsu).zfill(15)}</ultNSU></distNSU>'
+        '</distDFeInt></nfeDadosMsg></nfeDistDFeInteresse>'
+        '</soap12:Body></soap12:Envelope>'
+    ).encode("utf-8")
+
+
+def iterar_resposta(stream):
+    """
+    Incrementally parses a retDistDFeInt SOAP response.
+    Yields ("cabecalho", {cStat, xMotivo, ultNSU, maxNSU}) once the header fields are known, then
+    ("documento", {nsu, schema, xml}) for each docZip, decompressing one entry at a time.
+    """
+    cabecalho = {}
+    cabecalho_emitido = False
+    campos_cabecalho = {f"{{{NFE_NS}}}{tag}": tag for tag in ("cStat", "xMotivo", "dhResp", "ultNSU", "maxNSU")}
+    for event, elem in IterparseSeguro(stream, tag=[*campos_cabecalho, f"{{{NFE_NS}}}docZip"]):
+        if elem.tag in campos_cabecalho:
+            cabecalho[campos_cabecalho[elem.tag]] = (elem.text or "").strip()
+        elif elem.tag == f"{{{NFE_NS}}}docZip":
+            if not cabecalho_emitido:
+                cabecalho_emitido = True
+                yield "cabecalho", cabecalho
+            xml_bytes = gzip.decompress(base64.b64decode(elem.text or ""))
+            yield "documento", {"nsu": elem.get("NSU"), "schema": elem.get("schema"), "xml": xml_bytes.decode("utf-8")}
+            elem.clear()
+    if not cabecalho_emitido:
+        yield "cabecalho", cabecalho
+
+
+class DistribuicaoSyncEngine:
+    def __init__(self, store=None):
+        self._store = store
+        self._cnpj_locks = {}
+        self._locks_guard = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = NsuCursorStore()
+        return self._store
+
+    def _lock_for(self, cnpj, ambiente):
+        with self._locks_guard:
+            return self._cnpj_locks.setdefault((cnpj, ambiente), threading.Lock())
+
+    def url_for(self, ambiente):
+        return DISTRIBUICAO_URL_OVERRIDE or DISTRIBUICAO_URLS[str(ambiente)]
+
+    def sincronizar(self, session, cnpj, uf_codigo, ambiente, ult_nsu=None, max_paginas=MAX_PAGINAS_POR_SYNC, resumo=None,
+                    antes_da_pagina=None):
+        """
+        Generator that pages through distNSU from the persisted cursor (or ult_nsu, if given) and
+        yields each document as {"nsu", "schema", "xml"}. The cursor is advanced after every
+        fully consumed page. The final value returned (StopIteration.value) is a summary dict;
+        pass a dict as resumo to have it filled in as pages are consumed, so the progress is still
+        known when the sync fails halfway. antes_da_pagina, if given, is called before each page is
+        requested. Raises DistribuicaoBloqueada while the CNPJ is inside a back-off window.
+        """
+        resumo = {} if resumo is None else resumo
+        ambiente = str(ambiente)
+        lock = self._lock_for(cnpj, ambiente)
+        if not lock.acquire(blocking=False):
+            raise DistribuicaoBloqueada(cnpj, time.time() + 5, "sincronização já em andamento para este CNPJ")
+        try:
+            cursor = self.store.get(cnpj, ambiente)
+            if cursor["bloqueado_ate"] > time.time():
+                raise DistribuicaoBloqueada(cnpj, cursor["bloqueado_ate"], f"cStat {cursor['ultimo_cstat']} - {cursor['ultimo_motivo']}")
+
+            nsu_atual = str(ult_nsu).zfill(15) if ult_nsu is not None else cursor["ult_nsu"]
+            resumo.update({"cnpj": cnpj, "ambiente": ambiente, "ult_nsu_inicial": nsu_atual, "paginas": 0, "documentos": 0})
+            for _ in range(max_paginas):
+                if antes_da_pagina is not None:
+                    antes_da_pagina()
+                response = session.post(self.url_for(ambiente), data=montar_envelope_dist_nsu(cnpj, uf_codigo, ambiente, nsu_atual),
+                                        headers={"Content-Type": f'application/soap+xml; charset=utf-8; action="{SOAP_ACTION}"'},
+                                        timeout=DISTRIBUICAO_TIMEOUT_SECONDS, stream=True)
+                try:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    cabecalho = {}
+                    for tipo, conteudo in iterar_resposta(response.raw):
+                        if tipo == "cabecalho":
+                            cabecalho = conteudo
+                            self._verificar_cstat(cnpj, ambiente, cabecalho)
+                        else:
+                            resumo["documentos"] += 1
+                            yield conteudo
+                    if not cabecalho.get("cStat"):
+                        raise ValueError("Resposta de distribuição sem cStat")
+                finally:
+                    response.close()
+
+                resumo["paginas"] += 1
+                cstat = cabecalho.get("cStat")
+                ult_nsu_sefaz = cabecalho.get("ultNSU") or nsu_atual
+                max_nsu_sefaz = cabecalho.get("maxNSU") or ult_nsu_sefaz
+                alcancou_max = int(ult_nsu_sefaz) >= int(max_nsu_sefaz)
+                # Caught up (or nothing new): SEFAZ asks for a one-hour pause before the next query
+                bloqueado_ate = time.time() + BACKOFF_SECONDS if cstat == CSTAT_NENHUM_DOCUMENTO or alcancou_max else 0
+                self.store.save(cnpj, ambiente, ult_nsu=ult_nsu_sefaz, max_nsu=max_nsu_sefaz, bloqueado_ate=bloqueado_ate,
+                                ultimo_cstat=cstat, ultimo_motivo=cabecalho.get("xMotivo"))
+                resumo.update({"ult_nsu": ult_nsu_sefaz, "max_nsu": max_nsu_sefaz, "cStat": cstat, "xMotivo": cabecalho.get("xMotivo")})
+                nsu_atual = ult_nsu_sefaz
+                if cstat != CSTAT_DOCUMENTOS_LOCALIZADOS or alcancou_max:
+                    break
+            resumo["bloqueado_ate"] = self.store.get(cnpj, ambiente)["bloqueado_ate"]
+            return resumo
+        finally:
+            lock.release()
+
+    def _verificar_cstat(self, cnpj, ambiente, cabecalho):
+        cstat = cabecalho.get("cStat")
+        if cstat == CSTAT_CONSUMO_INDEVIDO:
+            bloqueado_ate = time.time() + BACKOFF_SECONDS
+            self.store.save(cnpj, ambiente, bloqueado_ate=bloqueado_ate, ultimo_cstat=cstat, ultimo_motivo=cabecalho.get("xMotivo"))
+            logger.warning(f"SEFAZ reported consumo indevido (656) for {cnpj}; backing off for one hour.")
+            raise DistribuicaoBloqueada(cnpj, bloqueado_ate, f"cStat 656 - {cabecalho.get('xMotivo')}")
+        if cstat not in (CSTAT_DOCUMENTOS_LOCALIZADOS, CSTAT_NENHUM_DOCUMENTO):
+            raise ValueError(f"SEFAZ rejeitou a consulta de distribuição: cStat {cstat} - {cabecalho.get('xMotivo')}")
+
+    def estado(self, cnpj, ambiente):
+        return self.store.get(cnpj, str(ambiente))
+
+
+sync_engine = DistribuicaoSyncEngine()
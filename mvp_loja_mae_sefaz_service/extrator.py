@@ -0,0 +1,244 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/extrator.py
+# Streaming extractor for inbound NF-e documents (procNFe / NFe, resNFe, resEvento, procEventoNFe).
+#
+# Documents are read with iterparse; each section (ide, emit, det/prod, dup, ICMSTot, ...) is read
+# when its end tag arrives and then cleared, so only the section being parsed is held in memory no
+# matter how many det items a nota has. The output follows the ExtractedNFeData shape used by the Node importer
+# (api/financeiro/notas-fiscais/nfe-compra/importar): chaveAcesso, emitente, destinatario,
+# produtos, faturas and totais. Decimal values are kept as the strings found in the XML.
+#
+# The XML comes from third parties (suppliers' notas, distribution results), so it is parsed with lxml
+# set never to expand entities, load a DTD or touch the network, and a document with a DOCTYPE (where
+# entities would be declared) is rejected: NF-e schemas never use one.
+#
+# CLI: python extrator.py nota.xml pasta_com_xmls/ ... (or "-" to read distribution NDJSON from
+# stdin); one JSON object per document is written to stdout.
+import io
+import os
+import sys
+import json
+import base64
+import logging
+
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+NFE_NS = "http://www.portalfiscal.inf.br/nfe"
+
+# leaf tag -> field, per section of the document
+CAMPOS_IDE = {"nNF": "numero", "serie": "serie", "dhEmi": "dataEmissao", "dEmi": "dataEmissao", "mod": "modelo", "tpNF": "tipoOperacao"}
+CAMPOS_PARTICIPANTE = {"CNPJ": "cnpj", "CPF": "cnpj", "xNome": "nome", "IE": "ie"}
+CAMPOS_PROD = {"cProd": "codigo", "xProd": "descricao", "NCM": "ncm", "CFOP": "cfop", "uCom": "unidade",
+               "qCom": "quantidade", "vUnCom": "valorUnitario", "vProd": "valorTotal", "cEAN": "ean"}
+CAMPOS_DUP = {"nDup": "numero", "dVenc": "vencimento", "vDup": "valor"}
+CAMPOS_PROT = {"cStat": "cStat", "xMotivo": "xMotivo", "dhRecbto": "dataAutorizacao"}
+CAMPOS_RESUMO_NFE = {"chNFe": "chaveAcesso", "dhEmi": "dataEmissao", "vNF": "valorTotal", "cSitNFe": "situacao",
+                     "tpNF": "tipoOperacao", "nProt": "protocolo", "dhRecbto": "dataAutorizacao"}
+CAMPOS_EVENTO = {"chNFe": "chaveAcesso", "tpEvento": "tpEvento", "xEvento": "descricao", "descEvento": "descricao",
+                 "nSeqEvento": "sequencia", "dhEvento": "dataEvento", "nProt": "protocolo", "dhRecbto": "dataRegistro",
+                 "dhRegEvento": "dataRegistro", "xCorrecao": "correcao", "xJust": "justificativa", "cStat": "cStat",
+                 "xMotivo": "xMotivo"}
+
+TIPOS_DOCUMENTO = {"nfeProc": "procNFe", "NFe": "procNFe", "resNFe": "resNFe", "resEvento": "resEvento",
+                   "procEventoNFe": "procEventoNFe"}
+
+# Elements read (and then cleared) when their end tag arrives; every other element is left for its
+# enclosing section to clear. Matched on the qualified tag so leaves cost a single set lookup.
+SECOES = ("ide", "emit", "dest", "prod", "det", "dup", "ICMSTot", "infNFe", "infProt", "infEvento", "detEvento")
+SECOES_QUALIFICADAS = {f"{{{NFE_NS}}}{tag}": tag for tag in SECOES} | {tag: tag for tag in SECOES}
+# What the parser reports: the sections and the document root, in or out of the NF-e namespace
+TAGS_LIDAS = [f"{{*}}{tag}" for tag in (*SECOES, *TIPOS_DOCUMENTO)]
+
+
+class IterparseSeguro:
+    """
+    lxml iterparse ("end" events) for untrusted XML: entities are never expanded, and a DOCTYPE raises
+    ValueError. tag limits the events to those elements, so the other ones never reach Python.
+    """
+
+    def __init__(self, fonte, tag=None):
+        self._contexto = etree.iterparse(fonte, events=("end",), tag=tag, resolve_entities=False, no_network=True,
+                                         load_dtd=False)
+
+    @property
+    def root(self):
+        return self._contexto.root
+
+    def __iter__(self):
+        verificado = False
+        for evento, elem in self._contexto:
+            if not verificado: # The prolog, DOCTYPE included, is parsed before the first event
+                self._verificar_doctype(elem)
+                verificado = True
+            yield evento, elem
+        if not verificado and self.root is not None:
+            self._verificar_doctype(self.root)
+
+    @staticmethod
+    def _verificar_doctype(elem):
+        if elem.getroottree().docinfo.doctype:
+            raise ValueError("XML inválido: DOCTYPE não é permitido em documentos NF-e")
+
+
+def _local(tag):
+    return tag.rpartition("}")[2]
+
+
+def _folhas(elem):
+    """Text of the direct children of elem, by local tag."""
+    return {_local(filho.tag): filho.text.strip() for filho in elem
+            if isinstance(filho.tag, str) and filho.text and filho.text.strip()} # Comments have a non-str tag
+
+
+def _mapear(folhas, campos, destino=None):
+    destino = {} if destino is None else destino
+    for tag, campo in campos.items():
+        if tag in folhas and destino.get(campo) is None:
+            destino[campo] = folhas[tag]
+    return destino
+
+
+def extrair_documento(fonte):
+    """
+    Extracts one NF-e document from a path, bytes, str or binary file-like object.
+    Raises ValueError for XML that is not one of the supported document types.
+    """
+    if isinstance(fonte, str) and fonte.lstrip().startswith("<"):
+        fonte = fonte.encode("utf-8")
+    if isinstance(fonte, (bytes, bytearray)):
+        fonte = io.BytesIO(fonte)
+
+    secoes = {}
+    produtos = []
+    faturas = []
+    produto = None
+    chave_acesso = None
+    documento_xml = IterparseSeguro(fonte, tag=TAGS_LIDAS)
+    try:
+        for _, elem in documento_xml:
+            secao = SECOES_QUALIFICADAS.get(elem.tag)
+            if secao is None: # The root
+                continue
+            if secao == "prod":
+                produto = _mapear(_folhas(elem), CAMPOS_PROD, dict.fromkeys(CAMPOS_PROD.values()))
+                if produto["quantidade"] is not None:
+                    produto["quantidade"] = float(produto["quantidade"])
+            elif secao == "det":
+                if produto is not None:
+                    produto["item"] = elem.get("nItem")
+                    produtos.append(produto)
+                produto = None
+            elif secao == "dup":
+                faturas.append(_mapear(_folhas(elem), CAMPOS_DUP, dict.fromkeys(CAMPOS_DUP.values())))
+            elif secao == "infNFe":
+                chave_acesso = (elem.get("Id") or "").replace("NFe", "", 1) or None
+            else:
+                # infEvento appears twice in procEventoNFe (evento and retEvento); the first value wins
+                for tag, texto in _folhas(elem).items():
+                    secoes.setdefault(secao, {}).setdefault(tag, texto)
+            elem.clear()
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"XML inválido: {e}") from e
+    raiz = documento_xml.root
+    if raiz is None:
+        raise ValueError("Documento vazio")
+
+    tipo = TIPOS_DOCUMENTO.get(_local(raiz.tag))
+    if tipo is None:
+        raise ValueError(f"Documento não suportado: <{_local(raiz.tag)}>")
+
+    if tipo == "procNFe":
+        documento = {"tipo": tipo, "chaveAcesso": chave_acesso, "numero": None, "serie": None, "dataEmissao": None,
+                     "valorTotal": None}
+        _mapear(secoes.get("ide", {}), CAMPOS_IDE, documento)
+        documento["emitente"] = _mapear(secoes.get("emit", {}), CAMPOS_PARTICIPANTE, {"cnpj": None, "nome": None})
+        documento["destinatario"] = _mapear(secoes.get("dest", {}), CAMPOS_PARTICIPANTE, {"cnpj": None, "nome": None})
+        documento["produtos"] = produtos
+        documento["faturas"] = faturas
+        documento["totais"] = secoes.get("ICMSTot", {})
+        documento["valorTotal"] = documento["totais"].get("vNF")
+        documento["protocolo"] = secoes.get("infProt", {}).get("nProt")
+        if "infProt" in secoes:
+            documento["autorizacao"] = _mapear(secoes["infProt"], CAMPOS_PROT)
+        return documento
+
+    folhas = _folhas(raiz)
+    if tipo == "resNFe":
+        documento = {"tipo": tipo, "chaveAcesso": None, "dataEmissao": None, "valorTotal": None, "situacao": None,
+                     "protocolo": None}
+        _mapear(folhas, CAMPOS_RESUMO_NFE, documento)
+        documento["emitente"] = _mapear(folhas, CAMPOS_PARTICIPANTE, {"cnpj": None, "nome": None})
+        return documento
+
+    documento = {"tipo": tipo, "chaveAcesso": None, "tpEvento": None, "descricao": None, "sequencia": None,
+                 "dataEvento": None, "protocolo": None}
+    evento = secoes.get("infEvento", folhas)
+    _mapear(evento, CAMPOS_EVENTO, documento)
+    _mapear(secoes.get("detEvento", {}), CAMPOS_EVENTO, documento)
+    documento["autor"] = {"cnpj": evento.get("CNPJ") or evento.get("CPF")}
+    return documento
+
+
+def iterar_documentos(fontes):
+    """
+    Extracts every (referencia, fonte) pair in turn.
+    Yields one dict per document; failures are yielded as {"referencia", "error"} instead of raised.
+    """
+    for referencia, fonte in fontes:
+        try:
+            documento = extrair_documento(fonte)
+        except Exception as e:
+            logger.warning(f"Could not extract NF-e document {referencia}: {e}")
+            yield {"referencia": referencia, "error": str(e)}
+            continue
+        documento["referencia"] = referencia
+        yield documento
+
+
+def fontes_de_distribuicao(documentos):
+    """Sources from distribution results: dicts with xml_base64 (or xml) and, optionally, nsu/schema."""
+    for indice, item in enumerate(documentos):
+        referencia = item.get("nsu") or str(indice)
+        if item.get("xml_base64"):
+            yield referencia, base64.b64decode(item["xml_base64"])
+        elif item.get("xml"):
+            yield referencia, item["xml"]
+        else:
+            yield referencia, b""
+
+
+def fontes_de_ndjson(linhas):
+    """Sources from the NDJSON stream of /api/nfe/distribuicao-dfe (the trailing summary line is skipped)."""
+    def documentos():
+        for linha in linhas:
+            linha = linha.strip()
+            if not linha:
+                continue
+            item = json.loads(linha)
+            if "resumo" not in item and "error" not in item:
+                yield item
+    return fontes_de_distribuicao(documentos())
+
+
+def fontes_de_caminhos(caminhos):
+    for caminho in caminhos:
+        if os.path.isdir(caminho):
+            for nome in sorted(os.listdir(caminho)):
+                if nome.lower().endswith(".xml"):
+                    yield os.path.join(caminho, nome), os.path.join(caminho, nome)
+        else:
+            yield caminho, caminho
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Extrai dados de NF-e (procNFe, resNFe, resEvento) em NDJSON.")
+    parser.add_argument("caminhos", nargs="+", help="Arquivos XML, diretórios, ou '-' para NDJSON de distribuição via stdin")
+    args = parser.parse_args()
+
+    fontes = fontes_de_ndjson(sys.stdin) if args.caminhos == ["-"] else fontes_de_caminhos(args.caminhos)
+    saida = sys.stdout
+    for documento in iterar_documentos(fontes):
+        saida.write(json.dumps(documento, ensure_ascii=False) + "\n")
@@ -0,0 +1,35 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/gunicorn.conf.py
+# Production entry point for the SEFAZ service (python main.py is the single-process dev server):
+#
+#   cd mvp_loja_mae_sefaz_service && gunicorn -c gunicorn.conf.py
+#
+# Prefork workers with threads and the app preloaded in the master; see servidor.py for the hooks.
+# Tunables: SEFAZ_BIND, SEFAZ_WORKERS, SEFAZ_THREADS, SEFAZ_GRACEFUL_TIMEOUT, SEFAZ_MAX_REQUESTS and the
+# per-route budgets in prazos.py (SEFAZ_ROUTE_TIMEOUTS).
+import os
+import multiprocessing
+
+import servidor
+
+servidor.configurar_ambiente()
+
+wsgi_app = "main:app"
+bind = os.environ.get("SEFAZ_BIND", f"{os.environ.get('FLASK_RUN_HOST', '0.0.0.0')}:{os.environ.get('FLASK_RUN_PORT', 5001)}")
+workers = int(os.environ.get("SEFAZ_WORKERS", multiprocessing.cpu_count()))
+# Most of a request is spent waiting on SEFAZ, so each worker keeps several requests in flight
+threads = int(os.environ.get("SEFAZ_THREADS", 8))
+worker_class = "gthread"
+preload_app = True
+# Worker heartbeat; gthread keeps beating while request threads wait, so this does not cap long routes
+timeout = int(os.environ.get("SEFAZ_WORKER_TIMEOUT", 60))
+graceful_timeout = int(servidor.GRACEFUL_TIMEOUT_SECONDS)
+keepalive = 5
+max_requests = int(os.environ.get("SEFAZ_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+on_starting = servidor.on_starting
+when_ready = servidor.when_ready
+post_fork = servidor.post_fork
+post_worker_init = servidor.post_worker_init
+worker_exit = servidor.worker_exit
+on_exit = servidor.on_exit
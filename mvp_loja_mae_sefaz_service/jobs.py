@@ -0,0 +1,455 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/jobs.py
+# Asynchronous emission jobs for the SEFAZ service.
+#
+# A route can hand its payload to JobManager.submit() and answer 202 right away; the emission runs
+# on a bounded thread pool with a concurrency limit per UF (so one slow state authorizer cannot take
+# every worker). Job state lives in a local SQLite database so it survives restarts, duplicate
+# submissions are collapsed by idempotency key (scoped to the job type, and only for the same payload),
+# and results can be polled or pushed to a callback URL on an allow-listed HTTPS host.
+# Several server processes may share the database: a job is claimed with a conditional UPDATE, so
+# only one of them ever runs it. Callbacks are delivered on a separate small pool, after the job has
+# given back its thread and UF slot.
+#
+# A claimed job holds a lease that the process running it renews every few seconds. A job whose lease
+# ran out belongs to a process that died: any live process puts it back to pendente (up to
+# JOB_MAX_ATTEMPTS claims), instead of leaving it executando until the next master restart. A number
+# the dead attempt reserved stays reservado in the numerador (numeracao.py), to be checked at SEFAZ.
+#
+# A job only carries its certificate_handle, so a job left pendente by a previous run can resume only
+# if the handle still resolves: that needs a fixed SEFAZ_CERT_HANDLE_SECRET and a SEFAZ_CERT_SHARED_DIR
+# kept across restarts (see certificados.py). At startup recover_interrupted() fails the ones that
+# cannot, with the reason, instead of letting them fail later on an unknown handle.
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import logging
+import threading
+import urllib.request
+from urllib.parse import urlsplit
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("SEFAZ_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+JOBS_DB_PATH = os.environ.get("SEFAZ_JOBS_DB", os.path.join(DATA_DIR, "jobs.sqlite3"))
+JOB_WORKERS = int(os.environ.get("SEFAZ_JOB_WORKERS", 8))
+JOB_CONCURRENCY_PER_UF = int(os.environ.get("SEFAZ_JOB_CONCURRENCY_PER_UF", 2))
+CALLBACK_TIMEOUT_SECONDS = float(os.environ.get("SEFAZ_JOB_CALLBACK_TIMEOUT", 10))
+CALLBACK_ATTEMPTS = 3
+CALLBACK_WORKERS = int(os.environ.get("SEFAZ_JOB_CALLBACK_WORKERS", 2))
+# Hosts (host or host:port) callbacks may be sent to, comma-separated; none configured means no callbacks
+CALLBACK_HOSTS = frozenset(host.strip().lower() for host in os.environ.get("SEFAZ_JOB_CALLBACK_HOSTS", "").split(",") if host.strip())
+JOB_LEASE_SECONDS = float(os.environ.get("SEFAZ_JOB_LEASE_SECONDS", 60))
+JOB_MAX_ATTEMPTS = int(os.environ.get("SEFAZ_JOB_MAX_ATTEMPTS", 3))
+
+STATUS_PENDENTE = "pendente"
+STATUS_EXECUTANDO = "executando"
+STATUS_CONCLUIDO = "concluido"
+STATUS_ERRO = "erro"
+
+
+class IdempotencyConflict(ValueError):
+    """Raised when an idempotency key is reused for the same job type with a different payload."""
+
+
+def concurrency_limit_for(uf):
+    # Per-UF override, e.g. SEFAZ_JOB_CONCURRENCY_UF_SP=4
+    return int(os.environ.get(f"SEFAZ_JOB_CONCURRENCY_UF_{uf}", JOB_CONCURRENCY_PER_UF))
+
+
+def callback_url_error(url):
+    """None if the service may POST job results to url, else why not."""
+    if not isinstance(url, str):
+        return "callback_url must be a string"
+    partes = urlsplit(url)
+    if partes.scheme != "https" or not partes.hostname:
+        return "callback_url must be an https URL"
+    if partes.username or partes.password:
+        return "callback_url must not carry credentials"
+    try:
+        porta = partes.port
+    except ValueError:
+        return "callback_url has an invalid port"
+    host = partes.hostname.lower()
+    if host not in CALLBACK_HOSTS and f"{host}:{porta}" not in CALLBACK_HOSTS:
+        return f"callback_url host {host} is not in SEFAZ_JOB_CALLBACK_HOSTS"
+    return None
+
+
+def payload_hash(payload):
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """A redirect could point the callback at a host outside the allow-list, so it is treated as a failure."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirect)
+
+
+class JobStore:
+    def __init__(self, path=JOBS_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    idempotency_key TEXT UNIQUE,
+                    tipo TEXT NOT NULL,
+                    uf TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    callback_url TEXT,
+                    callback_status TEXT,
+                    http_status INTEGER,
+                    resultado TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            # Columns added after the first release; databases created before get them here
+            colunas = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for coluna, tipo in (("payload_hash", "TEXT"), ("lease_until", "REAL"), ("attempts", "INTEGER NOT NULL DEFAULT 0")):
+                if coluna not in colunas:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {coluna} {tipo}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def create(self, tipo, uf, payload, idempotency_key=None, callback_url=None):
+        """
+        Inserts a new job, or returns the existing one for the same job type, idempotency key and payload.
+        Returns (job, created); raises IdempotencyConflict if the key was used for this type with another payload.
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        hash_ = payload_hash(payload)
+        # The unique column holds the key scoped to the job type, so an nfe and an nfe_lote may share a client key
+        chave = f"{tipo}:{idempotency_key}" if idempotency_key else None
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (id, idempotency_key, tipo, uf, status, payload, payload_hash, callback_url, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, chave, tipo, uf, STATUS_PENDENTE, json.dumps(payload), hash_, callback_url, now, now))
+            except sqlite3.IntegrityError:
+                row = self._conn.execute("SELECT * FROM jobs WHERE idempotency_key = ?", (chave,)).fetchone()
+                if row["payload_hash"] != hash_:
+                    raise IdempotencyConflict(f"Idempotency key {idempotency_key} was already used with a different payload")
+                return dict(row), False
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return dict(row), True
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock:
+            self._conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self, job_id, lease_seconds=JOB_LEASE_SECONDS):
+        """Moves a pending job to executando under a lease. False if it was already taken, possibly by another process."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = ?",
+                (STATUS_EXECUTANDO, now + lease_seconds, now, job_id, STATUS_PENDENTE))
+        return cursor.rowcount == 1
+
+    def renew(self, job_ids, lease_seconds=JOB_LEASE_SECONDS):
+        """Extends the lease of jobs this process is still executing."""
+        if not job_ids:
+            return
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET lease_until = ? WHERE status = ? AND id IN ({', '.join('?' * len(job_ids))})",
+                (time.time() + lease_seconds, STATUS_EXECUTANDO, *job_ids))
+
+    def expired(self, now=None):
+        """Jobs executando whose lease ran out (every job executando, with now=float('inf'))."""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs WHERE status = ? AND (lease_until IS NULL OR lease_until < ?) "
+                                      "ORDER BY created_at", (STATUS_EXECUTANDO, time.time() if now is None else now)).fetchall()
+        return [dict(row) for row in rows]
+
+    def requeue(self, job):
+        """Puts an executando job back to pendente, unless another process renewed or finished it meanwhile."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, lease_until = NULL, updated_at = ? WHERE id = ? AND status = ? AND lease_until IS ?",
+                (STATUS_PENDENTE, time.time(), job["id"], STATUS_EXECUTANDO, job["lease_until"]))
+        return cursor.rowcount == 1
+
+    def by_status(self, status):
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY created_at", (status,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def job_to_dict(job):
+    return {
+        "job_id": job["id"],
+        "tipo": job["tipo"],
+        "uf": job["uf"],
+        "status": job["status"],
+        "http_status": job["http_status"],
+        "resultado": json.loads(job["resultado"]) if job["resultado"] else None,
+        "callback_status": job["callback_status"],
+        "attempts": job.get("attempts"),
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
+class JobManager:
+    def __init__(self, store=None, max_workers=JOB_WORKERS):
+        self._store = store
+        self._max_workers = max_workers
+        self._executor = None
+        self._callbacks = None
+        self._handlers = {}
+        self._resume_check = None
+        self._lock = threading.Lock()
+        self._running = defaultdict(int) # uf -> jobs currently executing
+        self._waiting = defaultdict(deque) # uf -> job ids queued behind the UF's limit
+        self._executing = set() # ids of the jobs this process holds a lease on
+        self._heartbeat = None
+        self._stopping = threading.Event()
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = JobStore()
+        return self._store
+
+    def register_handler(self, tipo, handler):
+        """handler(payload) -> (response_body, http_status)"""
+        self._handlers[tipo] = handler
+
+    def register_resume_check(self, check):
+        """check(payload) -> None if a job left pendente by a previous run can still run, else the reason it cannot."""
+        self._resume_check = check
+
+    def start(self, recover=False):
+        """
+        Starts the worker pool and resumes pending jobs left over from a previous run.
+        recover also requeues the jobs that were executing when the service stopped, without waiting for
+        their leases to run out; only pass it when no other process can be running jobs (the dev server,
+        or the prefork master before forking).
+        """
+        if recover:
+            self.recover_interrupted()
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="nfe-job")
+            self._stopping.clear()
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="nfe-job-heartbeat", daemon=True)
+            self._heartbeat.start()
+        for job in self.store.by_status(STATUS_PENDENTE):
+            self._dispatch(job["id"], job["uf"])
+
+    def recover_interrupted(self):
+        # With no other process running jobs, every job executando was cut off by the stop: requeued at once
+        self.requeue_expired(now=float("inf"))
+        if self._resume_check is None:
+            return
+        # Pending jobs never reached SEFAZ, but they can only run if what they reference survived the restart
+        for job in self.store.by_status(STATUS_PENDENTE):
+            motivo = self._resume_check(json.loads(job["payload"]))
+            if motivo:
+                logger.warning(f"Job {job['id']} cannot be resumed after restart: {motivo}")
+                self._finish(job, {"error": "Job não pode ser retomado após o reinício; reenvie a emissão.", "details": motivo}, 500)
+
+    def requeue_expired(self, now=None):
+        """
+        Puts jobs whose lease ran out back to pendente, or fails them once they used JOB_MAX_ATTEMPTS claims.
+        Returns the requeued jobs; the caller dispatches them if it is running jobs.
+        """
+        requeued = []
+        for job in self.store.expired(now):
+            if job["attempts"] >= JOB_MAX_ATTEMPTS:
+                logger.warning(f"Job {job['id']} interrupted {job['attempts']} time(s); giving up.")
+                self._finish(job, {"error": "Job interrompido durante a execução; consulte a situação da NF-e na SEFAZ antes de reenviar."}, 500)
+            elif self.store.requeue(job):
+                logger.warning(f"Job {job['id']} lost its lease (attempt {job['attempts']}); queued again.")
+                requeued.append(job)
+        return requeued
+
+    def stop(self, timeout=None):
+        """
+        Graceful drain: waits up to timeout seconds for executing jobs to finish. Jobs still queued stay
+        pendente in the database and are picked up by the next start(), here or in another process.
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._waiting.clear()
+        if executor is None:
+            self._stopping.set()
+            return True
+        executor.shutdown(wait=False, cancel_futures=True) # Cancelled jobs give their UF slot back in _start
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try: # The heartbeat keeps renewing the leases of the jobs still draining
+            while True:
+                with self._lock:
+                    running = sum(self._running.values())
+                if not running:
+                    return True
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.warning(f"{running} job(s) still executing after {timeout}s drain.")
+                    return False
+                time.sleep(0.1)
+        finally:
+            self._stopping.set()
+
+    def close(self):
+        """Waits for queued callbacks and closes the database (the prefork master calls this before forking)."""
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, None
+        if callbacks is not None:
+            callbacks.shutdown(wait=True)
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def submit(self, tipo, uf, payload, idempotency_key=None, callback_url=None):
+        """
+        Queues a job and returns (job_dict, created).
+        Raises ValueError for an unknown type or a callback_url that is not allowed, IdempotencyConflict for a reused key.
+        """
+        if tipo not in self._handlers:
+            raise ValueError(f"Unknown job type: {tipo}")
+        if callback_url is not None:
+            erro = callback_url_error(callback_url)
+            if erro:
+                raise ValueError(erro)
+        self.start()
+        job, created = self.store.create(tipo, uf, payload, idempotency_key, callback_url)
+        if created:
+            logger.info(f"Job {job['id']} ({tipo}, UF {uf}) queued.")
+            self._dispatch(job["id"], uf)
+        else:
+            logger.info(f"Duplicate submission for idempotency key {idempotency_key}; returning job {job['id']}.")
+        return job_to_dict(job), created
+
+    def get(self, job_id):
+        job = self.store.get(job_id)
+        return job_to_dict(job) if job else None
+
+    def stats(self):
+        with self._lock:
+            return {"running": dict(self._running), "waiting": {uf: len(q) for uf, q in self._waiting.items() if q}}
+
+    def _dispatch(self, job_id, uf):
+        with self._lock:
+            executor = self._executor
+            if executor is None: # draining; the job stays pendente for the next start()
+                return
+            if self._running[uf] >= concurrency_limit_for(uf):
+                self._waiting[uf].append(job_id)
+                return
+            self._running[uf] += 1
+        self._start(executor, job_id, uf)
+
+    def _start(self, executor, job_id, uf):
+        """Submits a job whose UF slot is already counted; the slot is given back if the job never runs."""
+        try:
+            future = executor.submit(self._run, job_id, uf)
+        except RuntimeError: # stop() shut the pool down in between; the job stays pendente
+            self._release(uf)
+            return
+        future.add_done_callback(lambda f: self._release(uf) if f.cancelled() else None)
+
+    def _release(self, uf):
+        with self._lock:
+            self._running[uf] -= 1
+
+    def _executing_ids(self):
+        with self._lock:
+            return list(self._executing)
+
+    def _heartbeat_loop(self):
+        """Renews the leases of this process's jobs and requeues jobs whose process died, every third of a lease."""
+        while not self._stopping.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                self.store.renew(self._executing_ids())
+                for job in self.requeue_expired():
+                    self._dispatch(job["id"], job["uf"])
+            except Exception:
+                logger.exception("Job heartbeat failed.")
+
+    def _run(self, job_id, uf):
+        try:
+            job = self.store.get(job_id)
+            if job is None or not self.store.claim(job_id):
+                return
+            with self._lock:
+                self._executing.add(job_id)
+            try:
+                body, http_status = self._handlers[job["tipo"]](json.loads(job["payload"]))
+            except Exception as e:
+                logger.exception(f"Job {job_id} failed.")
+                body, http_status = {"error": "NFe processing error", "details": str(e)}, 500
+            self._finish(job, body, http_status)
+        finally:
+            with self._lock:
+                self._executing.discard(job_id)
+                self._running[uf] -= 1
+                executor = self._executor # None once stop() has begun draining
+                next_job_id = self._waiting[uf].popleft() if self._waiting[uf] and executor else None
+                if next_job_id is not None:
+                    self._running[uf] += 1
+            if next_job_id is not None:
+                self._start(executor, next_job_id, uf)
+
+    def _finish(self, job, body, http_status):
+        status = STATUS_CONCLUIDO if http_status < 500 else STATUS_ERRO
+        self.store.update(job["id"], status=status, http_status=http_status, resultado=json.dumps(body), lease_until=None)
+        logger.info(f"Job {job['id']} finished with HTTP status {http_status}.")
+        if job.get("callback_url"):
+            self.store.update(job["id"], callback_status="pendente")
+            with self._lock:
+                if self._callbacks is None:
+                    self._callbacks = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS, thread_name_prefix="nfe-job-callback")
+                callbacks = self._callbacks
+            callbacks.submit(self._send_callback, self.store.get(job["id"]))
+
+    def _send_callback(self, job):
+        # Checked again here: the allow-list may have changed since a job from a previous run was queued
+        erro = callback_url_error(job["callback_url"])
+        if erro:
+            logger.warning(f"Callback for job {job['id']} not sent: {erro}")
+            self.store.update(job["id"], callback_status=f"recusado ({erro})")
+            return
+        data = json.dumps(job_to_dict(job)).encode("utf-8")
+        for attempt in range(1, CALLBACK_ATTEMPTS + 1):
+            try:
+                req = urllib.request.Request(job["callback_url"], data=data, method="POST",
+                                             headers={"Content-Type": "application/json"})
+                with _callback_opener.open(req, timeout=CALLBACK_TIMEOUT_SECONDS) as resp:
+                    self.store.update(job["id"], callback_status=f"entregue ({resp.status})")
+                    return
+            except Exception as e:
+                logger.warning(f"Callback for job {job['id']} failed (attempt {attempt}): {e}")
+                if attempt < CALLBACK_ATTEMPTS:
+                    time.sleep(2 ** attempt)
+        self.store.update(job["id"], callback_status="falhou")
+
+
+job_manager = JobManager()
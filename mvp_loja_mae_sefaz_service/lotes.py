@@ -0,0 +1,56 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/lotes.py
+# Batch emission helpers: parallel signing and transmission of NF-e in lotes.
+# SEFAZ's enviNFe layout accepts up to 50 NF-e per lote, so a batch of notas costs one SEFAZ round
+# trip (plus the recibo queries) per 50 notas instead of one per nota. Signing and transmission are
+# the same calls the single-nota route makes (transmissao.py), over the same pooled session.
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from transmissao import assinar_nota, autorizar, chave_de
+
+logger = logging.getLogger(__name__)
+
+MAX_NOTAS_POR_LOTE = 50
+SIGNING_WORKERS = int(os.environ.get("SEFAZ_SIGNING_WORKERS", 4))
+
+
+def dividir_em_lotes(itens, tamanho=MAX_NOTAS_POR_LOTE):
+    return [itens[i:i + tamanho] for i in range(0, len(itens), tamanho)]
+
+
+def gerar_id_lote(sequencia=0):
+    # idLote is up to 15 digits; milliseconds since epoch plus the lote's position in this batch
+    return str(int(time.time() * 1000) * 100 + sequencia)[-15:]
+
+
+def assinar_notas(certificado, ambiente, notas_fiscais, max_workers=SIGNING_WORKERS):
+    """
+    Serializes and signs every NotaFiscal in parallel.
+    Returns a list, in input order, of (nfe_assinada, chave_acesso, error_message).
+    """
+    def assinar(nf):
+        try:
+            nfe_assinada = assinar_nota(nf, certificado, ambiente)
+            return nfe_assinada, chave_de(nfe_assinada), None
+        except Exception as e:
+            logger.exception(f"Error signing NFe number {nf.numero_nf}.")
+            return None, None, str(e)
+
+    if len(notas_fiscais) <= 1 or max_workers <= 1:
+        return [assinar(nf) for nf in notas_fiscais]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(notas_fiscais))) as pool:
+        return list(pool.map(assinar, notas_fiscais))
+
+
+def transmitir_lote(comunicacao, modelo, nfes_assinadas, id_lote):
+    """
+    Sends one enviNFe lote (at most MAX_NOTAS_POR_LOTE signed notas) and waits for its result.
+    Returns (retorno_lote, protocolos_por_chave, xmls_autorizados_por_chave), as transmissao.autorizar.
+    """
+    if len(nfes_assinadas) > MAX_NOTAS_POR_LOTE:
+        raise ValueError(f"Um lote aceita no máximo {MAX_NOTAS_POR_LOTE} NF-e.")
+    retorno_lote, protocolos, xmls_autorizados = autorizar(comunicacao, modelo, nfes_assinadas, id_lote)
+    logger.info(f"Lote {id_lote} processed by SEFAZ: cStat {retorno_lote.get('cStat')} - {retorno_lote.get('xMotivo')}")
+    return retorno_lote, protocolos, xmls_autorizados
@@ -1,233 +1,709 @@
 # /home/ubuntu/mvp_loja_mae_sefaz_service/main.py
 import os
+import io
+import json
 import base64
-from flask import Flask, request, jsonify
-from pynfe.processamento.nfe import ProcessarNFe
+from datetime import datetime
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from pynfe.entidades.cliente import Cliente
 from pynfe.entidades.emitente import Emitente
+from pynfe.entidades.fonte_dados import FonteDados
 from pynfe.entidades.notafiscal import NotaFiscal
-from pynfe.entidades.produto import Produto
-from pynfe.entidades.tributo import TributoICMS, TributoPIS, TributoCOFINS, TributoIPI
-from pynfe.entidades.pagamento import Pagamento
-from pynfe.config import Config
-from pynfe.utils.flags import UF_CODIGO
-from pynfe.utils.danfe import GerarDanfe
+from pynfe.utils import so_numeros
+from pynfe.utils.flags import CODIGOS_ESTADOS, CODIGO_BRASIL
 import logging
 import xml.etree.ElementTree as ET # For parsing XML responses
-
-# For NFeDistribuicaoDFe, PyNFe might not have direct high-level support.
-# We might need a SOAP client like zeep if direct calls are necessary.
-# For now, let's assume we can construct the request or find a utility within PyNFe or related libs.
+from certificados import (registry as certificate_registry, resolve_certificate, motivo_handle_nao_retomavel, CertificateError,
+                          certificados_reservados)
+from lotes import MAX_NOTAS_POR_LOTE, assinar_notas, dividir_em_lotes, gerar_id_lote, transmitir_lote
+from jobs import job_manager, callback_url_error, IdempotencyConflict
+from sessoes import session_pool
+from transmissao import ComunicacaoSessao, ErroSefaz, assinar_nota, autorizar, chave_de
+from danfe import danfe_service, CHAVE_ACESSO_RE, DANFE_TIMEOUT_SECONDS
+from distribuicao import sync_engine, DistribuicaoBloqueada
+from extrator import iterar_documentos, fontes_de_distribuicao, fontes_de_ndjson
+from numeracao import numerador, NumeracaoError, NUMERO_MAXIMO
+from compilador import compilar_produtos, ProdutosCompilados, ProdutosInvalidos, para_decimal, CASAS_VALOR
+from metricas import (metricas, ESTAGIO_CERTIFICADO, ESTAGIO_CONFIG, ESTAGIO_MAPEAMENTO, ESTAGIO_ASSINATURA,
+                      ESTAGIO_SEFAZ, ESTAGIO_DANFE)
+import prazos
+from prazos import PrazoExcedido
 
 app = Flask(__name__)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-CNPJ_SOFTWARE_HOUSE = "00000000000000"
-TOKEN_SOFTWARE_HOUSE = ""
+# Ambiente Nacional (AN) and exterior (EX) are in PyNFe's table but are not UFs an emitente can be in
+UF_CODIGO = {uf: codigo for uf, codigo in CODIGOS_ESTADOS.items() if uf not in ("AN", "EX")}
+MAX_NOTAS_POR_REQUISICAO = int(os.environ.get("SEFAZ_MAX_NOTAS_POR_REQUISICAO", 10 * MAX_NOTAS_POR_LOTE))
+DANFE_PREFETCH = os.environ.get("SEFAZ_DANFE_PREFETCH", "1") != "0"
+
+@app.before_request
+def iniciar_medicao():
+    rota = request.url_rule.rule if request.url_rule else "nao_encontrada"
+    g.medicao, g.medicao_token = metricas.iniciar(rota)
+    g.prazo_token = prazos.iniciar(rota)
+
+@app.after_request
+def adicionar_server_timing(response):
+    medicao = g.pop("medicao", None)
+    if medicao is not None:
+        total = metricas.finalizar(medicao, g.pop("medicao_token"), response.status_code)
+        response.headers["Server-Timing"] = medicao.server_timing(total)
+    if "prazo_token" in g:
+        prazos.encerrar(g.pop("prazo_token"))
+    return response
+
+@app.teardown_request
+def encerrar_medicao(exc):
+    # Only reached with a pending medição when after_request did not run
+    medicao = g.pop("medicao", None)
+    if medicao is not None:
+        metricas.finalizar(medicao, g.pop("medicao_token"), 500)
+    if "prazo_token" in g:
+        prazos.encerrar(g.pop("prazo_token"))
+
+@app.errorhandler(PrazoExcedido)
+def prazo_excedido(e):
+    logger.warning(f"{request.path}: {e}")
+    return jsonify({"error": "Tempo limite excedido", "details": str(e)}), 504
 
 @app.route("/health", methods=["GET"])
 def health_check():
     return jsonify({"status": "healthy", "message": "SEFAZ Service is running"}), 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics_route():
+    job_stats = job_manager.stats()
+    for uf in set(job_stats["running"]) | set(job_stats["waiting"]):
+        metricas.jobs_executando.set(job_stats["running"].get(uf, 0), uf=uf)
+        metricas.jobs_aguardando.set(job_stats["waiting"].get(uf, 0), uf=uf)
+    return Response(metricas.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/api/sefaz/pool", methods=["GET"])
+def sefaz_pool_stats_route():
+    return jsonify({"sessoes": session_pool.stats(), "certificados": certificate_registry.stats()}), 200
+
+@app.route("/api/certificados", methods=["POST"])
+def register_certificate_route():
+    payload = request.get_json(silent=True) or {}
+    cert_base64 = payload.get("certificate_base64")
+    cert_pass = payload.get("certificate_password")
+    if not cert_base64 or cert_pass is None:
+        return jsonify({"error": "Missing required fields: certificate_base64, certificate_password"}), 400
+    try:
+        entry = certificate_registry.register_base64(cert_base64, cert_pass)
+    except CertificateError as e:
+        logger.error(f"Certificate registration failed: {e}")
+        return jsonify({"error": "Certificate handling error", "details": str(e)}), 400
+    return jsonify(entry.to_dict()), 201
+
+@app.route("/api/certificados/<handle>", methods=["DELETE"])
+def remove_certificate_route(handle):
+    if not certificate_registry.remove(handle):
+        return jsonify({"error": "Certificado não encontrado"}), 404
+    return "", 204
+
+def criar_comunicacao(certificado, uf_sigla, uf_codigo, ambiente_nf):
+    """The SEFAZ client for this UF and ambiente, posting through the certificate's pooled keep-alive mTLS session."""
+    return ComunicacaoSessao(uf_sigla, certificado, ambiente_nf, session_pool.get(certificado, uf_codigo, ambiente_nf))
+
+def ler_data_emissao(valor):
+    """dhEmi from an ISO 8601 string (the Next.js routes send Date.toISOString()), or now when absent."""
+    if not valor:
+        return datetime.now().astimezone()
+    data_emissao = datetime.fromisoformat(str(valor))
+    return data_emissao if data_emissao.tzinfo else data_emissao.astimezone()
+
+def adicionar_produtos(nf, produtos):
+    """Adds compiled produtos to a PyNFe NotaFiscal, which accumulates its header totals from the same Decimal values."""
+    for item in produtos.itens():
+        nf.adicionar_produto_servico(
+            _fonte_dados=nf._fonte_dados,
+            codigo=item["codigo"], descricao=item["descricao"], ean="SEM GTIN", ean_tributavel="SEM GTIN",
+            ncm=item["ncm"], cfop=item["cfop"],
+            unidade_comercial=item["unidade_comercial"], quantidade_comercial=item["quantidade"],
+            valor_unitario_comercial=item["valor_unitario"],
+            unidade_tributavel=item["unidade_tributavel"], quantidade_tributavel=item["quantidade_tributavel"],
+            valor_unitario_tributavel=item["valor_unitario_tributavel"],
+            valor_total_bruto=item["valor_total_bruto"], ind_total=1,
+            total_frete=item["valor_frete"], total_seguro=item["valor_seguro"], desconto=item["valor_desconto"],
+            outras_despesas_acessorias=item["valor_outras_despesas"],
+            icms_modalidade=item["icms_cst"], icms_origem=int(item["icms_origem"]),
+            icms_modalidade_determinacao_bc=int(item["icms_mod_bc"]), icms_valor_base_calculo=item["icms_valor_bc"],
+            icms_aliquota=item["icms_aliquota"], icms_valor=item["icms_valor"],
+            pis_modalidade=item["pis_cst"], pis_valor_base_calculo=item["pis_valor_bc"],
+            pis_aliquota_percentual=item["pis_aliquota"], pis_valor=item["pis_valor"],
+            cofins_modalidade=item["cofins_cst"], cofins_valor_base_calculo=item["cofins_valor_bc"],
+            cofins_aliquota_percentual=item["cofins_aliquota"], cofins_valor=item["cofins_valor"],
+            ipi_codigo_enquadramento=item["ipi_cst"], ipi_classe_enquadramento=item["ipi_classe_enquadramento"],
+            ipi_valor_base_calculo=item["ipi_valor_bc"], ipi_aliquota=item["ipi_aliquota"], ipi_valor_ipi=item["ipi_valor"],
+            informacoes_adicionais=item["informacoes_adicionais"],
+            valor_tributos_aprox=None) # The serializer reads it unconditionally; vTotTrib is not sent
+
+def mapear_nota_fiscal(emitente_details, uf_emitente_sigla, destinatario_details, produtos_details, nf_info_details, serie, numero_nf):
+    """Maps the JSON payload of one nota onto PyNFe entities. Raises on invalid data."""
+    # Each nota gets its own fonte de dados: PyNFe's default one is a process-wide list every entity is appended to
+    fonte = FonteDados()
+    emit = Emitente(
+        _fonte_dados=fonte,
+        cnpj=so_numeros(emitente_details.get("cnpj") or ""),
+        razao_social=emitente_details.get("nome_razao"),
+        nome_fantasia=emitente_details.get("nome_fantasia") or emitente_details.get("nome_razao"),
+        inscricao_estadual=emitente_details.get("inscricao_estadual"),
+        codigo_de_regime_tributario=str(emitente_details.get("regime_tributario_codigo", "1")),
+        endereco_logradouro=emitente_details.get("logradouro"),
+        endereco_numero=emitente_details.get("numero"),
+        endereco_complemento=emitente_details.get("complemento", ""),
+        endereco_bairro=emitente_details.get("bairro"),
+        endereco_municipio=emitente_details.get("municipio_nome"),
+        endereco_cod_municipio=str(emitente_details.get("municipio_codigo_ibge")),
+        endereco_uf=uf_emitente_sigla,
+        endereco_cep=so_numeros(emitente_details.get("cep") or ""),
+        endereco_pais=CODIGO_BRASIL,
+        endereco_telefone=so_numeros(emitente_details.get("telefone") or ""),
+    )
+    documento = so_numeros(destinatario_details.get("cpf_cnpj") or "")
+    uf_destinatario_sigla = (destinatario_details.get("uf_sigla") or "").upper()
+    indicador_ie = int(destinatario_details.get("indicador_ie_codigo", 9))
+    dest = Cliente(
+        _fonte_dados=fonte,
+        razao_social=destinatario_details.get("nome_razao"),
+        tipo_documento="CPF" if len(documento) == 11 else "CNPJ",
+        numero_documento=documento,
+        indicador_ie=indicador_ie,
+        inscricao_estadual=destinatario_details.get("inscricao_estadual", ""),
+        email=destinatario_details.get("email", ""),
+        endereco_logradouro=destinatario_details.get("logradouro"),
+        endereco_numero=destinatario_details.get("numero"),
+        endereco_complemento=destinatario_details.get("complemento", ""),
+        endereco_bairro=destinatario_details.get("bairro"),
+        endereco_municipio=destinatario_details.get("municipio_nome"),
+        endereco_cod_municipio=str(destinatario_details.get("municipio_codigo_ibge")),
+        endereco_uf=uf_destinatario_sigla,
+        endereco_cep=so_numeros(destinatario_details.get("cep") or ""),
+        endereco_pais=CODIGO_BRASIL,
+        endereco_telefone=so_numeros(destinatario_details.get("telefone") or ""),
+    )
+    # Validated in one pass, with exact item values (see compilador.py)
+    produtos = produtos_details if isinstance(produtos_details, ProdutosCompilados) else compilar_produtos(produtos_details)
+    nf = NotaFiscal(
+        _fonte_dados=fonte,
+        emitente=emit,
+        cliente=dest,
+        uf=uf_emitente_sigla,
+        municipio=str(emitente_details.get("municipio_codigo_ibge")),
+        natureza_operacao=nf_info_details.get("natureza_operacao"),
+        modelo=int(nf_info_details.get("modelo_documento_fiscal", 55)),
+        serie=str(int(serie)),
+        numero_nf=str(numero_nf),
+        data_emissao=ler_data_emissao(nf_info_details.get("data_emissao")),
+        tipo_documento=int(nf_info_details.get("tipo_operacao_codigo", 1)),
+        finalidade_emissao=str(nf_info_details.get("finalidade_emissao_codigo", "1")),
+        indicador_presencial=int(nf_info_details.get("presenca_comprador_codigo", 1)),
+        # Não contribuintes (indIEDest 9) are always consumidor final
+        cliente_final=int(nf_info_details.get("consumidor_final_codigo", 1 if indicador_ie == 9 else 0)),
+        indicador_destino=1 if uf_destinatario_sigla in ("", uf_emitente_sigla) else 3 if uf_destinatario_sigla == "EX" else 2,
+        forma_emissao="1",
+        tipo_impressao_danfe=1,
+        transporte_modalidade_frete=int(nf_info_details.get("modalidade_frete_codigo", 9)),
+        informacoes_adicionais_interesse_fisco=nf_info_details.get("informacoes_fisco", ""),
+        informacoes_complementares_interesse_contribuinte=nf_info_details.get("informacoes_contribuinte", ""),
+    )
+    adicionar_produtos(nf, produtos)
+    for pag_data in nf_info_details.get("pagamentos") or []:
+        nf.adicionar_pagamento(_fonte_dados=fonte, t_pag=str(pag_data.get("forma_pagamento_codigo", "01")).zfill(2),
+                               v_pag=para_decimal(pag_data.get("valor_pagamento"), CASAS_VALOR),
+                               ind_pag=int(nf_info_details.get("forma_pagamento_nf_codigo", 0)))
+    if not nf.pagamentos:
+        nf.adicionar_pagamento(_fonte_dados=fonte, t_pag="01", v_pag=produtos.totais["valor_nota"], ind_pag=0)
+    return nf
+
+def campos_nao_objeto(payload, lote=False):
+    """Names of the fields that must be JSON objects but are not, checked before anything calls .get() on them."""
+    campos = ("emitente",) if lote else ("emitente", "destinatario", "nota_fiscal_info")
+    invalidos = [campo for campo in campos if payload.get(campo) is not None and not isinstance(payload.get(campo), dict)]
+    if lote and isinstance(payload.get("notas"), list):
+        for indice, nota in enumerate(payload["notas"]):
+            if not isinstance(nota, dict):
+                invalidos.append(f"notas[{indice}]")
+                continue
+            invalidos.extend(f"notas[{indice}].{campo}" for campo in ("emitente", "destinatario", "nota_fiscal_info")
+                             if nota.get(campo) is not None and not isinstance(nota.get(campo), dict))
+    return invalidos
+
+def erro_campos_nao_objeto(invalidos):
+    logger.error(f"Fields that must be JSON objects in payload: {invalidos}")
+    return {"error": f"Fields must be JSON objects: {", ".join(invalidos)}"}, 400
+
+def inteiro_ate(valor, maximo):
+    texto = str(valor).strip()
+    return texto.isascii() and texto.isdigit() and int(texto) <= maximo
+
+def erro_numeracao(serie, ultimo_numero):
+    """
+    The série and last_used_nfe_number are checked here, so a malformed one is a 400 rather than a
+    numbering conflict (409) from inside the reservation.
+    """
+    if not inteiro_ate(serie, 999):
+        return {"error": "Invalid current_nfe_series", "details": f"série deve ser um número de 0 a 999: {serie!r}"}, 400
+    if ultimo_numero is not None and not inteiro_ate(ultimo_numero, NUMERO_MAXIMO):
+        return {"error": "Invalid last_used_nfe_number",
+                "details": f"last_used_nfe_number deve ser um número de 0 a {NUMERO_MAXIMO}: {ultimo_numero!r}"}, 400
+    return None
+
+def erro_uf_emitente(emitente):
+    uf_sigla = (emitente.get("uf_sigla") or "SP").upper()
+    if uf_sigla in UF_CODIGO:
+        return None
+    logger.error(f"Invalid UF sigla for emitente: {uf_sigla}")
+    return {"error": f"UF inválida para emitente: {uf_sigla}"}, 400
+
+def validar_payload_nfe(payload):
+    """Checks what emitir_nfe needs before doing any work. Returns None, or (response_body, http_status)."""
+    if not payload:
+        logger.error("No JSON payload provided in request.")
+        return {"error": "No JSON payload provided"}, 400
+    if not isinstance(payload, dict):
+        return {"error": "JSON payload must be an object"}, 400
+    invalidos = campos_nao_objeto(payload)
+    if invalidos:
+        return erro_campos_nao_objeto(invalidos)
+    required_fields_check = {
+        "emitente": payload.get("emitente"),
+        "destinatario": payload.get("destinatario"),
+        "produtos": payload.get("produtos", []),
+        "nota_fiscal_info": payload.get("nota_fiscal_info"),
+        "current_nfe_series": payload.get("current_nfe_series") or (payload.get("nota_fiscal_info") or {}).get("serie_nf"),
+    }
+    missing_fields = [field for field, value in required_fields_check.items() if value is None]
+    if missing_fields:
+        logger.error(f"Missing required fields in payload: {missing_fields}")
+        return {"error": f"Missing required fields: {", ".join(missing_fields)}"}, 400
+    return (erro_numeracao(required_fields_check["current_nfe_series"], payload.get("last_used_nfe_number"))
+            or erro_uf_emitente(payload["emitente"]))
+
+def emitentes_do_lote(payload):
+    """The emitente of each nota of a batch: its own, or the batch's top-level one."""
+    return [nota.get("emitente") or payload.get("emitente") for nota in payload["notas"]]
+
+def validar_payload_lote(payload):
+    """Checks what emitir_lote_nfe needs before doing any work. Returns None, or (response_body, http_status)."""
+    if not payload:
+        logger.error("No JSON payload provided in request.")
+        return {"error": "No JSON payload provided"}, 400
+    if not isinstance(payload, dict):
+        return {"error": "JSON payload must be an object"}, 400
+    required_fields_check = {
+        "notas": payload.get("notas"),
+        "current_nfe_series": payload.get("current_nfe_series")
+    }
+    missing_fields = [field for field, value in required_fields_check.items() if value is None]
+    if missing_fields:
+        logger.error(f"Missing required fields in batch payload: {missing_fields}")
+        return {"error": f"Missing required fields: {", ".join(missing_fields)}"}, 400
+    notas_details = payload["notas"]
+    if not isinstance(notas_details, list) or not notas_details:
+        return {"error": "notas must be a non-empty list"}, 400
+    if len(notas_details) > MAX_NOTAS_POR_REQUISICAO:
+        return {"error": f"At most {MAX_NOTAS_POR_REQUISICAO} notas per request"}, 400
+    invalidos = campos_nao_objeto(payload, lote=True)
+    if invalidos:
+        return erro_campos_nao_objeto(invalidos)
+
+    # Every nota of a lote goes to the same authorizer with the same certificate, so they must share the emitente
+    emitentes = emitentes_do_lote(payload)
+    if any(not emitente for emitente in emitentes):
+        return {"error": "Every nota needs an emitente (per nota or at the top level)"}, 400
+    if len({(e.get("cnpj"), (e.get("uf_sigla") or "SP").upper()) for e in emitentes}) > 1:
+        return {"error": "All notas in a batch must have the same emitente CNPJ and UF"}, 400
+    modelos = {str((nota.get("nota_fiscal_info") or {}).get("modelo_documento_fiscal", "55")) for nota in notas_details}
+    if len(modelos) > 1:
+        return {"error": "All notas in a batch must have the same modelo_documento_fiscal"}, 400
+    return (erro_numeracao(payload["current_nfe_series"], payload.get("last_used_nfe_number"))
+            or erro_uf_emitente(emitentes[0]))
+
+def is_async_request(payload):
+    return isinstance(payload, dict) and bool(payload.get("async")) or "respond-async" in request.headers.get("Prefer", "")
+
+def submit_emission_job(tipo, payload, uf_sigla):
+    """Queues an emission and answers 202 with the job id (or the existing job for a repeated idempotency key)."""
+    callback_url = payload.get("callback_url")
+    if callback_url is not None:
+        erro = callback_url_error(callback_url)
+        if erro:
+            return jsonify({"error": "Invalid callback_url", "details": erro}), 400
+    try:
+        certificado, cert_error = resolve_certificate(payload)
+    except CertificateError as e:
+        logger.error(f"Certificate handling error: {e}")
+        return jsonify({"error": "Certificate handling error", "details": str(e)}), 400
+    if cert_error:
+        logger.error(cert_error)
+        return jsonify({"error": cert_error}), 400
+
+    # Only the handle is persisted with the job, never the PFX or its password
+    job_payload = {k: v for k, v in payload.items()
+                   if k not in ("certificate_base64", "certificate_password", "async", "callback_url", "idempotency_key")}
+    job_payload["certificate_handle"] = certificado.handle
+    idempotency_key = request.headers.get("Idempotency-Key") or payload.get("idempotency_key")
+    try:
+        job, created = job_manager.submit(tipo, (uf_sigla or "SP").upper(), job_payload,
+                                          idempotency_key=idempotency_key, callback_url=callback_url)
+    except IdempotencyConflict as e:
+        return jsonify({"error": "Idempotency key conflict", "details": str(e)}), 409
+    status_url = f"/api/nfe/jobs/{job['job_id']}"
+    response = jsonify({**job, "status_url": status_url})
+    response.headers["Location"] = status_url
+    return response, 202 if created or job["status"] not in ("concluido", "erro") else 200
+
 @app.route("/api/nfe/generate-transmit", methods=["POST"])
 def generate_transmit_nfe_route():
     logger.info("Received request to generate and transmit NFe.")
     payload = request.get_json()
+    if isinstance(payload, dict) and is_async_request(payload):
+        erro = validar_payload_nfe(payload)
+        if erro:
+            body, http_status = erro
+            return jsonify(body), http_status
+        return submit_emission_job("nfe", payload, payload["emitente"].get("uf_sigla"))
+    body, http_status = emitir_nfe(payload)
+    return jsonify(body), http_status
 
-    if not payload:
-        logger.error("No JSON payload provided in request.")
-        return jsonify({"error": "No JSON payload provided"}), 400
+@app.route("/api/nfe/generate-transmit-batch", methods=["POST"])
+def generate_transmit_batch_route():
+    logger.info("Received request to generate and transmit a batch of NFe.")
+    payload = request.get_json()
+    if isinstance(payload, dict) and is_async_request(payload):
+        erro = validar_payload_lote(payload)
+        if erro:
+            body, http_status = erro
+            return jsonify(body), http_status
+        return submit_emission_job("nfe_lote", payload, emitentes_do_lote(payload)[0].get("uf_sigla"))
+    body, http_status = emitir_lote_nfe(payload)
+    return jsonify(body), http_status
+
+@app.route("/api/nfe/jobs/<job_id>", methods=["GET"])
+def nfe_job_status_route(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job não encontrado"}), 404
+    return jsonify(job), 200
+
+@app.route("/api/nfe/numeracao/<cnpj>/<modelo>/<serie>", methods=["GET"])
+def numeracao_estado_route(cnpj, modelo, serie):
+    try:
+        return jsonify(numerador.estado(cnpj, modelo, serie)), 200
+    except ValueError:
+        return jsonify({"error": f"Série inválida: {serie}"}), 400
+
+@app.route("/api/nfe/numeracao/<cnpj>/<modelo>/<serie>/inutilizadas", methods=["POST"])
+def numeracao_inutilizadas_route(cnpj, modelo, serie):
+    """Records an inutilização already done at SEFAZ for numbers queued by the numerador."""
+    payload = request.get_json(silent=True) or {}
+    numero_inicial = payload.get("numero_inicial")
+    numero_final = payload.get("numero_final", numero_inicial)
+    if numero_inicial is None:
+        return jsonify({"error": "Missing required fields: numero_inicial"}), 400
+    try:
+        atualizados = numerador.marcar_inutilizados(cnpj, modelo, serie, numero_inicial, numero_final, payload.get("protocolo"))
+    except ValueError as e:
+        return jsonify({"error": "Numeração inválida", "details": str(e)}), 400
+    return jsonify({"atualizados": atualizados, **numerador.estado(cnpj, modelo, serie)}), 200
+
+def registrar_xml_autorizado(chave_acesso, xml_autorizado):
+    """Stores the authorized XML for later DANFE downloads and returns the DANFE URL (None if unavailable)."""
+    if not chave_acesso or not xml_autorizado:
+        logger.warning("No authorized XML available to generate DANFE.")
+        return None
+    try:
+        danfe_service.salvar_xml_autorizado(chave_acesso, xml_autorizado)
+        if DANFE_PREFETCH:
+            danfe_service.prefetch(chave_acesso, xml_autorizado)
+    except Exception:
+        logger.exception(f"Error storing authorized XML for {chave_acesso}.")
+        return None
+    return f"/api/nfe/{chave_acesso}/danfe"
+
+@app.route("/api/nfe/<chave_acesso>/danfe", methods=["GET"])
+def danfe_route(chave_acesso):
+    if not CHAVE_ACESSO_RE.match(chave_acesso):
+        return jsonify({"error": "Chave de acesso inválida"}), 400
+    xml_autorizado = danfe_service.carregar_xml_autorizado(chave_acesso)
+    if xml_autorizado is None:
+        return jsonify({"error": "XML autorizado não encontrado para esta chave de acesso"}), 404
+
+    etag = danfe_service.etag_for(xml_autorizado)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    try:
+        with metricas.estagio(ESTAGIO_DANFE):
+            pdf_bytes = danfe_service.obter_pdf(chave_acesso, xml_autorizado, timeout=prazos.limitar(DANFE_TIMEOUT_SECONDS))
+    except PrazoExcedido:
+        raise
+    except FuturesTimeoutError:
+        logger.error(f"DANFE rendering for {chave_acesso} did not finish in time.")
+        return jsonify({"error": "DANFE generation timed out"}), 504
+    except Exception as e:
+        logger.exception(f"Error generating DANFE PDF for {chave_acesso}.")
+        return jsonify({"error": "DANFE generation error", "details": str(e)}), 500
+    return Response(pdf_bytes, mimetype="application/pdf", headers={
+        "ETag": f'"{etag}"',
+        "Cache-Control": "private, max-age=86400",
+        "Content-Disposition": f'inline; filename="danfe_{chave_acesso}.pdf"',
+    })
+
+@certificados_reservados() # The certificate files stay on disk until the emission is done with them
+def emitir_nfe(payload):
+    """Maps, signs and transmits one NFe. Returns (response_body, http_status)."""
+
+    erro = validar_payload_nfe(payload)
+    if erro:
+        return erro
 
-    cert_base64 = payload.get("certificate_base64")
-    cert_pass = payload.get("certificate_password")
     emitente_details = payload.get("emitente")
     destinatario_details = payload.get("destinatario")
     produtos_details = payload.get("produtos", [])
     nf_info_details = payload.get("nota_fiscal_info")
     ambiente_nf = str(payload.get("ambiente", "2")) 
-    last_used_nfe_number = payload.get("last_used_nfe_number") 
-    current_nfe_series = payload.get("current_nfe_series")
-
-    required_fields_check = {
-        "certificate_base64": cert_base64,
-        "certificate_password": cert_pass,
-        "emitente": emitente_details,
-        "destinatario": destinatario_details,
-        "produtos": produtos_details,
-        "nota_fiscal_info": nf_info_details,
-        "last_used_nfe_number": last_used_nfe_number,
-        "current_nfe_series": current_nfe_series
-    }
-    missing_fields = [field for field, value in required_fields_check.items() if value is None] 
-    if missing_fields:
-        logger.error(f"Missing required fields in payload: {missing_fields}")
-        return jsonify({"error": f"Missing required fields: {", ".join(missing_fields)}"}), 400
+    last_used_nfe_number = payload.get("last_used_nfe_number") # Optional: the numerador owns the sequence, this only moves it forward
+    current_nfe_series = payload.get("current_nfe_series") or nf_info_details.get("serie_nf")
 
-    cert_path_temp = f"/tmp/temp_cert_{os.urandom(8).hex()}.pfx"
     try:
-        with open(cert_path_temp, "wb") as f_cert:
-            f_cert.write(base64.b64decode(cert_base64))
-        logger.info(f"Temporary certificate saved to {cert_path_temp}")
-    except Exception as e:
-        logger.exception("Failed to decode and save temporary certificate.")
-        return jsonify({"error": "Certificate handling error", "details": str(e)}), 500
+        with metricas.estagio(ESTAGIO_CERTIFICADO):
+            certificado, cert_error = resolve_certificate(payload)
+    except CertificateError as e:
+        logger.error(f"Certificate handling error: {e}")
+        return {"error": "Certificate handling error", "details": str(e)}, 400
+    if cert_error:
+        logger.error(cert_error)
+        return {"error": cert_error}, 400
 
     try:
-        uf_emitente_sigla = emitente_details.get("uf_sigla", "SP").upper()
-        uf_emitente_codigo = UF_CODIGO.get(uf_emitente_sigla)
-        if not uf_emitente_codigo:
-            logger.error(f"Invalid UF sigla for emitente: {uf_emitente_sigla}")
-            if os.path.exists(cert_path_temp): os.remove(cert_path_temp)
-            return jsonify({"error": f"UF inválida para emitente: {uf_emitente_sigla}"}), 400
+        uf_emitente_sigla = (emitente_details.get("uf_sigla") or "SP").upper()
+        uf_emitente_codigo = UF_CODIGO[uf_emitente_sigla]
+        metricas.rotular(uf=uf_emitente_sigla, ambiente=ambiente_nf)
         
         logger.info(f"Using environment: {"Homologação" if ambiente_nf == "2" else "Produção"} for UF: {uf_emitente_sigla} ({uf_emitente_codigo})")
-        config = Config(
-            cnpj_software_house=CNPJ_SOFTWARE_HOUSE,
-            token_software_house=TOKEN_SOFTWARE_HOUSE,
-            path_certificado=cert_path_temp,
-            senha_certificado=cert_pass,
-            uf=uf_emitente_codigo,
-            ambiente=int(ambiente_nf),
-        )
-        logger.info("PyNFe Config object created.")
+        with metricas.estagio(ESTAGIO_CONFIG):
+            comunicacao = criar_comunicacao(certificado, uf_emitente_sigla, uf_emitente_codigo, ambiente_nf)
     except Exception as e:
-        logger.exception("Failed to initialize PyNFe Config.")
-        if os.path.exists(cert_path_temp): os.remove(cert_path_temp)
-        return jsonify({"error": "PyNFe Configuration error", "details": str(e)}), 500
+        logger.exception("Failed to initialize the SEFAZ client.")
+        return {"error": "PyNFe Configuration error", "details": str(e)}, 500
+
+    try:
+        with metricas.estagio(ESTAGIO_MAPEAMENTO):
+            produtos_compilados = compilar_produtos(produtos_details) # Before the reservation, so bad items never burn a number
+    except ProdutosInvalidos as e:
+        logger.error(f"Invalid produtos: {e}")
+        return {"error": "Invalid produtos", "details": e.erros}, 400
+
+    serie_numeracao = (emitente_details.get("cnpj"), str(nf_info_details.get("modelo_documento_fiscal", "55")), current_nfe_series)
+    prazos.verificar("da reserva de numeração") # Out of time: better to fail now than to burn a number
+    try:
+        numero_nf = numerador.reservar(*serie_numeracao, quantidade=1, ultimo_numero_conhecido=last_used_nfe_number)[0]
+    except NumeracaoError as e:
+        logger.error(f"Could not reserve NFe number: {e}")
+        return {"error": "NFe numbering error", "details": str(e)}, 409
 
     try:
         logger.info("Mapping input data to PyNFe entities.")
-        emit = Emitente(
-            cnpj=emitente_details.get("cnpj"),
-            nome_razao=emitente_details.get("nome_razao"),
-            nome_fantasia=emitente_details.get("nome_fantasia", emitente_details.get("nome_razao")),
-            logradouro=emitente_details.get("logradouro"),
-            numero=emitente_details.get("numero"),
-            complemento=emitente_details.get("complemento", ""),
-            bairro=emitente_details.get("bairro"),
-            municipio=emitente_details.get("municipio_nome"),
-            codigo_municipio=emitente_details.get("municipio_codigo_ibge"),
-            uf=uf_emitente_sigla,
-            cep=emitente_details.get("cep"),
-            pais_codigo="1058",
-            pais_nome="BRASIL",
-            telefone=emitente_details.get("telefone", ""),
-            inscricao_estadual=emitente_details.get("inscricao_estadual"),
-            regime_tributario=str(emitente_details.get("regime_tributario_codigo", "1"))
-        )
-        dest = Cliente(
-            cpf_cnpj=destinatario_details.get("cpf_cnpj"),
-            nome_razao=destinatario_details.get("nome_razao"),
-            logradouro=destinatario_details.get("logradouro"),
-            numero=destinatario_details.get("numero"),
-            complemento=destinatario_details.get("complemento", ""),
-            bairro=destinatario_details.get("bairro"),
-            municipio=destinatario_details.get("municipio_nome"),
-            codigo_municipio=destinatario_details.get("municipio_codigo_ibge"),
-            uf=destinatario_details.get("uf_sigla", "").upper(),
-            cep=destinatario_details.get("cep"),
-            pais_codigo="1058",
-            pais_nome="BRASIL",
-            telefone=destinatario_details.get("telefone", ""),
-            email=destinatario_details.get("email", ""),
-            indicador_inscricao_estadual=str(destinatario_details.get("indicador_ie_codigo", "9"))
-        )
-        produtos_list_pynfe = []
-        for i, prod_data in enumerate(produtos_details):
-            icms_data = prod_data.get("tributos", {}).get("icms", {})
-            pis_data = prod_data.get("tributos", {}).get("pis", {})
-            cofins_data = prod_data.get("tributos", {}).get("cofins", {})
-            trib_icms = TributoICMS(origem=str(icms_data.get("origem", "0")),
-                                cst=str(icms_data.get("cst", "00")),
-                                modalidade_base_calculo=str(icms_data.get("mod_bc", "3")),
-                                valor_base_calculo=float(icms_data.get("valor_bc", 0.0)),
-                                aliquota=float(icms_data.get("aliquota", 0.0)),
-                                valor=float(icms_data.get("valor", 0.0)))
-            trib_pis = TributoPIS(cst=str(pis_data.get("cst", "01")), valor_base_calculo=float(pis_data.get("valor_bc", 0.0)), aliquota=float(pis_data.get("aliquota_percentual", 0.0)), valor=float(pis_data.get("valor", 0.0)))
-            trib_cofins = TributoCOFINS(cst=str(cofins_data.get("cst", "01")), valor_base_calculo=float(cofins_data.get("valor_bc", 0.0)), aliquota=float(cofins_data.get("aliquota_percentual", 0.0)), valor=float(cofins_data.get("valor", 0.0)))
-            produto_pynfe = Produto(item=str(i + 1), codigo=prod_data.get("codigo_produto", f"PROD{i+1}"), descricao=prod_data.get("descricao"), ncm=prod_data.get("ncm"), cfop=str(prod_data.get("cfop")), unidade_comercial=prod_data.get("unidade_comercial", "UN"), quantidade_comercial=float(prod_data.get("quantidade")),
-                                  valor_unitario_comercial=float(prod_data.get("valor_unitario")),
-                                  unidade_tributavel=prod_data.get("unidade_tributavel", prod_data.get("unidade_comercial", "UN")),
-                                  quantidade_tributavel=float(prod_data.get("quantidade_tributavel", prod_data.get("quantidade"))),
-                                  valor_unitario_tributavel=float(prod_data.get("valor_unitario_tributavel", prod_data.get("valor_unitario"))),
-                                  valor_total_bruto=float(prod_data.get("valor_total_bruto", float(prod_data.get("quantidade")) * float(prod_data.get("valor_unitario")) )),
-                                  icms=trib_icms, pis=trib_pis, cofins=trib_cofins, informacoes_adicionais=prod_data.get("informacoes_adicionais_produto", ""))
-            produtos_list_pynfe.append(produto_pynfe)
-        pagamentos_list_pynfe = []
-        for pag_data in nf_info_details.get("pagamentos", []):
-            pagamento_pynfe = Pagamento(forma_pagamento=str(pag_data.get("forma_pagamento_codigo", "01")),
-                                        valor_pagamento=float(pag_data.get("valor_pagamento")))
-            pagamentos_list_pynfe.append(pagamento_pynfe)
-        if not pagamentos_list_pynfe and produtos_list_pynfe:
-            total_nf = sum(p.valor_total_bruto for p in produtos_list_pynfe)
-            pagamentos_list_pynfe.append(Pagamento(forma_pagamento="01", valor_pagamento=total_nf))
-        next_nfe_number = int(last_used_nfe_number) + 1
-        nf = NotaFiscal(emitente=emit, destinatario=dest, produtos=produtos_list_pynfe, pagamentos=pagamentos_list_pynfe,
-                        natureza_operacao=nf_info_details.get("natureza_operacao"),
-                        modelo=str(nf_info_details.get("modelo_documento_fiscal", "55")),
-                        serie=str(current_nfe_series),
-                        numero_nf=str(next_nfe_number),
-                        data_emissao=nf_info_details.get("data_emissao"),
-                        finalidade_emissao=str(nf_info_details.get("finalidade_emissao_codigo", "1")),
-                        tipo_operacao=str(nf_info_details.get("tipo_operacao_codigo", "1")),
-                        forma_pagamento_nfe=str(nf_info_details.get("forma_pagamento_nf_codigo", "0")),
-                        presenca_comprador=str(nf_info_details.get("presenca_comprador_codigo", "1")),
-                        informacoes_adicionais_fisco=nf_info_details.get("informacoes_fisco", ""),
-                        informacoes_complementares_contribuinte=nf_info_details.get("informacoes_contribuinte", ""))
+        with metricas.estagio(ESTAGIO_MAPEAMENTO):
+            nf = mapear_nota_fiscal(emitente_details, uf_emitente_sigla, destinatario_details, produtos_compilados,
+                                    nf_info_details, current_nfe_series, numero_nf)
         logger.info(f"NotaFiscal object created for NFe number: {nf.numero_nf}, Serie: {nf.serie}")
     except Exception as e:
         logger.exception("Error mapping input data to PyNFe entities.")
-        if os.path.exists(cert_path_temp): os.remove(cert_path_temp)
-        return jsonify({"error": "Data mapping error", "details": str(e)}), 400
+        numerador.devolver(*serie_numeracao, numero_nf, motivo="erro de mapeamento")
+        return {"error": "Data mapping error", "details": str(e)}, 400
 
     try:
-        logger.info("Initializing ProcessarNFe.")
-        processador = ProcessarNFe(configuracoes=config, nota_fiscal=nf)
-        logger.info("ProcessarNFe initialized. Starting processing...")
-        retorno_sefaz = processador.processar_nota()
-        logger.info(f"SEFAZ processing completed. Raw response: {retorno_sefaz}")
-        status_code = str(retorno_sefaz.get("cStat", ""))
-        is_authorized = retorno_sefaz.get("bStat", False) and status_code == "100"
-        if is_authorized:
-            logger.info("NFe authorized successfully by SEFAZ.")
-            xml_autorizado_str = processador.xml_autorizado.decode("utf-8") if processador.xml_autorizado else None
-            danfe_pdf_base64 = None
-            try:
-                if processador.xml_autorizado:
-                    logger.info("Attempting to generate DANFE PDF.")
-                    gerador_danfe = GerarDanfe(xml=processador.xml_autorizado)
-                    pdf_bytes = gerador_danfe.gerar_danfe()
-                    danfe_pdf_base64 = base64.b64encode(pdf_bytes).decode("utf-8")
-                    logger.info("DANFE PDF generated and base64 encoded.")
-                else:
-                    logger.warning("No authorized XML available to generate DANFE.")
-            except Exception as danfe_exc:
-                logger.exception("Error generating DANFE PDF.")
-            response_data = {"status_sefaz": "autorizada", "codigo_status_sefaz": status_code, "motivo_sefaz": retorno_sefaz.get("xMotivo"),
-                             "chave_acesso": retorno_sefaz.get("protNFe", {}).get("infProt", {}).get("chNFe") or retorno_sefaz.get("chNFe"),
-                             "protocolo": retorno_sefaz.get("protNFe", {}).get("infProt", {}).get("nProt") or retorno_sefaz.get("nProt"),
-                             "xml_autorizado": xml_autorizado_str, "danfe_pdf_base64": danfe_pdf_base64,
-                             "numero_nf_emitido": nf.numero_nf}
-            return jsonify(response_data), 200
-        else:
-            logger.warning(f"NFe not authorized or error occurred. SEFAZ response: {retorno_sefaz}")
-            return jsonify({"status_sefaz": "rejeitada_ou_erro", "codigo_status_sefaz": status_code,
-                            "motivo_sefaz": retorno_sefaz.get("xMotivo", "Unknown error from SEFAZ"),
-                            "raw_response": retorno_sefaz}), 422
+        with metricas.estagio(ESTAGIO_ASSINATURA):
+            nfe_assinada = assinar_nota(nf, certificado, ambiente_nf)
+        chave_acesso = chave_de(nfe_assinada)
     except Exception as e:
-        logger.exception("Exception during NFe processing (PyNFe interaction).")
-        return jsonify({"error": "NFe processing error", "details": str(e)}), 500
-    finally:
-        if os.path.exists(cert_path_temp):
-            try:
-                os.remove(cert_path_temp)
-                logger.info(f"Temporary certificate {cert_path_temp} removed.")
-            except Exception as e_rm:
-                logger.error(f"Error removing temporary certificate {cert_path_temp}: {e_rm}")
+        logger.exception(f"Error signing NFe number {nf.numero_nf}.")
+        numerador.devolver(*serie_numeracao, numero_nf, motivo="erro de assinatura")
+        return {"error": "NFe signing error", "details": str(e)}, 500
+
+    try:
+        with metricas.estagio(ESTAGIO_SEFAZ):
+            retorno_lote, protocolos, xmls_autorizados = autorizar(comunicacao, nf.modelo, [nfe_assinada], gerar_id_lote())
+    except PrazoExcedido as e:
+        # The nota may or may not have reached SEFAZ, so its number cannot simply be reused
+        numerador.marcar_para_inutilizacao(*serie_numeracao, numero_nf, motivo=f"prazo excedido: {e}")
+        raise
+    except Exception as e:
+        logger.exception("Exception during NFe transmission.")
+        numerador.marcar_para_inutilizacao(*serie_numeracao, numero_nf, motivo=f"erro no processamento: {e}")
+        return {"error": "NFe processing error", "details": str(e)}, 502 if isinstance(e, ErroSefaz) else 500
+
+    # A lote rejected as a whole (e.g. schema errors) has no protNFe: its cStat is the nota's
+    inf_prot = protocolos.get(chave_acesso) or {"cStat": retorno_lote.get("cStat"), "xMotivo": retorno_lote.get("xMotivo")}
+    status_code = str(inf_prot.get("cStat") or "")
+    metricas.rotular(cstat=status_code)
+    logger.info(f"SEFAZ answered cStat {status_code} ({inf_prot.get('xMotivo')}) for NFe {chave_acesso}.")
+    xml_autorizado = xmls_autorizados.get(chave_acesso)
+    if xml_autorizado is not None:
+        danfe_url = registrar_xml_autorizado(chave_acesso, xml_autorizado)
+        numerador.registrar_retorno(*serie_numeracao, numero_nf, status_code, chave_acesso=chave_acesso)
+        return {"status_sefaz": "autorizada", "codigo_status_sefaz": status_code, "motivo_sefaz": inf_prot.get("xMotivo"),
+                "chave_acesso": chave_acesso, "protocolo": inf_prot.get("nProt"),
+                "xml_autorizado": xml_autorizado.decode("utf-8"), "danfe_url": danfe_url,
+                "numero_nf_emitido": nf.numero_nf, "serie_nf_emitida": nf.serie}, 200
+    logger.warning(f"NFe not authorized. SEFAZ response: {retorno_lote}, protocolo: {inf_prot}")
+    # With cStat 539 the numerador keeps the chave SEFAZ names in xMotivo, not the one sent
+    numerador.registrar_retorno(*serie_numeracao, numero_nf, status_code, chave_acesso=chave_acesso, motivo=inf_prot.get("xMotivo"))
+    return {"status_sefaz": "rejeitada_ou_erro", "codigo_status_sefaz": status_code,
+            "motivo_sefaz": inf_prot.get("xMotivo") or "Unknown error from SEFAZ",
+            "chave_acesso": chave_acesso, "numero_nf_emitido": nf.numero_nf, "serie_nf_emitida": nf.serie,
+            "raw_response": {**retorno_lote, "protNFe": inf_prot}}, 422
+
+@certificados_reservados()
+def emitir_lote_nfe(payload):
+    """Maps, signs and transmits a batch of NFe in lotes. Returns (response_body, http_status)."""
+
+    erro = validar_payload_lote(payload)
+    if erro:
+        return erro
+
+    notas_details = payload.get("notas")
+    ambiente_nf = str(payload.get("ambiente", "2"))
+    last_used_nfe_number = payload.get("last_used_nfe_number") # Optional, as in emitir_nfe
+    current_nfe_series = payload.get("current_nfe_series")
+
+    try:
+        with metricas.estagio(ESTAGIO_CERTIFICADO):
+            certificado, cert_error = resolve_certificate(payload)
+    except CertificateError as e:
+        logger.error(f"Certificate handling error: {e}")
+        return {"error": "Certificate handling error", "details": str(e)}, 400
+    if cert_error:
+        logger.error(cert_error)
+        return {"error": cert_error}, 400
+
+    emitentes = emitentes_do_lote(payload)
+    uf_emitente_sigla = (emitentes[0].get("uf_sigla") or "SP").upper()
+    uf_emitente_codigo = UF_CODIGO[uf_emitente_sigla]
+    metricas.rotular(uf=uf_emitente_sigla, ambiente=ambiente_nf)
+
+    try:
+        with metricas.estagio(ESTAGIO_CONFIG):
+            comunicacao = criar_comunicacao(certificado, uf_emitente_sigla, uf_emitente_codigo, ambiente_nf)
+    except Exception as e:
+        logger.exception("Failed to initialize the SEFAZ client.")
+        return {"error": "PyNFe Configuration error", "details": str(e)}, 500
+
+    # One reservation covers the whole batch; numbers go, in order, only to notas that mapped successfully.
+    # The numerador hands out freed numbers first (see numeracao.py), so they ascend but need not be consecutive.
+    modelo = str((notas_details[0].get("nota_fiscal_info") or {}).get("modelo_documento_fiscal", "55"))
+    serie_numeracao = (emitentes[0].get("cnpj"), modelo, current_nfe_series)
+    prazos.verificar("da reserva de numeração")
+    try:
+        numeros_reservados = numerador.reservar(*serie_numeracao, quantidade=len(notas_details),
+                                                ultimo_numero_conhecido=last_used_nfe_number)
+    except NumeracaoError as e:
+        logger.error(f"Could not reserve NFe numbers for batch: {e}")
+        return {"error": "NFe numbering error", "details": str(e)}, 409
+
+    resultados = [None] * len(notas_details)
+    notas_mapeadas = [] # (indice, NotaFiscal)
+    for indice, (nota_details, emitente_details) in enumerate(zip(notas_details, emitentes)):
+        try:
+            with metricas.estagio(ESTAGIO_MAPEAMENTO):
+                nf = mapear_nota_fiscal(emitente_details, uf_emitente_sigla, nota_details.get("destinatario") or {},
+                                        nota_details.get("produtos", []), nota_details.get("nota_fiscal_info") or {},
+                                        current_nfe_series, numeros_reservados[len(notas_mapeadas)])
+        except ProdutosInvalidos as e:
+            logger.error(f"Invalid produtos in nota {indice} of batch: {e}")
+            resultados[indice] = {"indice": indice, "status_sefaz": "erro_mapeamento", "error": "Invalid produtos", "details": e.erros}
+            continue
+        except Exception as e:
+            logger.exception(f"Error mapping nota {indice} of batch to PyNFe entities.")
+            resultados[indice] = {"indice": indice, "status_sefaz": "erro_mapeamento", "error": "Data mapping error", "details": str(e)}
+            continue
+        notas_mapeadas.append((indice, nf))
+    for numero_nao_usado in numeros_reservados[len(notas_mapeadas):]:
+        numerador.devolver(*serie_numeracao, numero_nao_usado, motivo="erro de mapeamento")
+
+    with metricas.estagio(ESTAGIO_ASSINATURA):
+        assinaturas = assinar_notas(certificado, ambiente_nf, [nf for _, nf in notas_mapeadas])
+    notas_assinadas = [] # (indice, NotaFiscal, nfe_assinada, chave_acesso)
+    for (indice, nf), (nfe_assinada, chave_acesso, erro) in zip(notas_mapeadas, assinaturas):
+        if erro:
+            numerador.devolver(*serie_numeracao, nf.numero_nf, motivo="erro de assinatura")
+            resultados[indice] = {"indice": indice, "status_sefaz": "erro_assinatura", "numero_nf_emitido": nf.numero_nf,
+                                  "error": "NFe signing error", "details": erro}
+        else:
+            notas_assinadas.append((indice, nf, nfe_assinada, chave_acesso))
+
+    lotes_info = []
+    for sequencia, lote in enumerate(dividir_em_lotes(notas_assinadas, MAX_NOTAS_POR_LOTE)):
+        id_lote = gerar_id_lote(sequencia)
+        try:
+            with metricas.estagio(ESTAGIO_SEFAZ):
+                retorno_lote, protocolos, xmls_autorizados = transmitir_lote(comunicacao, serie_numeracao[1],
+                                                                             [item[2] for item in lote], id_lote)
+        except Exception as e:
+            logger.exception(f"Exception transmitting lote {id_lote}.")
+            lotes_info.append({"id_lote": id_lote, "quantidade": len(lote), "error": "NFe processing error", "details": str(e)})
+            for indice, nf, _, chave_acesso in lote:
+                numerador.marcar_para_inutilizacao(*serie_numeracao, nf.numero_nf, motivo=f"erro no lote {id_lote}: {e}")
+                resultados[indice] = {"indice": indice, "status_sefaz": "rejeitada_ou_erro", "numero_nf_emitido": nf.numero_nf,
+                                      "chave_acesso": chave_acesso, "error": "NFe processing error", "details": str(e)}
+            continue
+
+        metricas.rotular(cstat=retorno_lote.get("cStat"))
+        lotes_info.append({"id_lote": id_lote, "quantidade": len(lote), "codigo_status_sefaz": str(retorno_lote.get("cStat", "")),
+                           "motivo_sefaz": retorno_lote.get("xMotivo"), "recibo": retorno_lote.get("nRec")})
+        for indice, nf, _, chave_acesso in lote:
+            # Notas without their own protNFe were rejected as part of the whole lote
+            inf_prot = protocolos.get(chave_acesso) or {"cStat": retorno_lote.get("cStat"), "xMotivo": retorno_lote.get("xMotivo")}
+            status_code = str(inf_prot.get("cStat", ""))
+            resultado = {"indice": indice, "numero_nf_emitido": nf.numero_nf, "chave_acesso": chave_acesso,
+                         "codigo_status_sefaz": status_code, "motivo_sefaz": inf_prot.get("xMotivo"), "id_lote": id_lote}
+            numerador.registrar_retorno(*serie_numeracao, nf.numero_nf, status_code, chave_acesso=chave_acesso,
+                                        motivo=inf_prot.get("xMotivo"))
+            xml_autorizado = xmls_autorizados.get(chave_acesso)
+            if xml_autorizado is not None:
+                resultado.update({"status_sefaz": "autorizada", "protocolo": inf_prot.get("nProt"),
+                                  "xml_autorizado": xml_autorizado.decode("utf-8"),
+                                  "danfe_url": registrar_xml_autorizado(chave_acesso, xml_autorizado)})
+            else:
+                resultado["status_sefaz"] = "rejeitada_ou_erro"
+            resultados[indice] = resultado
+
+    autorizadas = sum(1 for r in resultados if r.get("status_sefaz") == "autorizada")
+    logger.info(f"Batch processed: {autorizadas} of {len(resultados)} NFe authorized in {len(lotes_info)} lote(s).")
+    response_data = {"quantidade_notas": len(resultados), "quantidade_autorizadas": autorizadas,
+                     "ultimo_numero_utilizado": str(numerador.ultimo_numero(*serie_numeracao)), "lotes": lotes_info,
+                     "resultados": resultados}
+    return response_data, 200 if autorizadas else 422
+
+def medir_job(tipo, handler):
+    """Runs a job handler under its own medição and prazo, since jobs execute outside any Flask request."""
+    def executar(payload):
+        token = prazos.iniciar(f"job:{tipo}")
+        try:
+            with metricas.medir(f"job:{tipo}") as medicao:
+                try:
+                    body, http_status = handler(payload)
+                except PrazoExcedido as e:
+                    body, http_status = {"error": "Tempo limite excedido", "details": str(e)}, 504
+                medicao["status"] = http_status
+                return body, http_status
+        finally:
+            prazos.encerrar(token)
+    return executar
+
+job_manager.register_handler("nfe", medir_job("nfe", emitir_nfe))
+job_manager.register_handler("nfe_lote", medir_job("nfe_lote", emitir_lote_nfe))
+job_manager.register_resume_check(lambda payload: motivo_handle_nao_retomavel(payload.get("certificate_handle")))
 
 @app.route("/api/nfe/distribuicao-dfe", methods=["POST"])
+@certificados_reservados()
 def distribuicao_dfe_route():
     logger.info("Received request for NFeDistribuicaoDFe.")
     payload = request.get_json()
@@ -236,16 +712,13 @@ def distribuicao_dfe_route():
         logger.error("No JSON payload provided for NFeDistribuicaoDFe.")
         return jsonify({"error": "No JSON payload provided"}), 400
 
-    cert_base64 = payload.get("certificate_base64")
-    cert_pass = payload.get("certificate_password")
-    uf_sigla = payload.get("uf_sigla") # UF of the interested CNPJ (author of the query)
+    uf_sigla = payload.get("uf_sigla") # UF of the interested CNPJ (author of the query), sent as cUFAutor
     cnpj_interessado = payload.get("cnpj_interessado")
-    ambiente_nf = str(payload.get("ambiente", "1")) # AN uses "1" for production for this service
-    ult_nsu = payload.get("ult_nsu", "0") # Last NSU received, or 0 to start
+    ambiente_nf = str(payload.get("ambiente", "1"))
+    ult_nsu = payload.get("ult_nsu") # Optional: overrides the persisted cursor (e.g. "0" to resync from scratch)
+    stream = bool(payload.get("stream")) or "application/x-ndjson" in request.headers.get("Accept", "")
 
     required_fields_check = {
-        "certificate_base64": cert_base64,
-        "certificate_password": cert_pass,
         "uf_sigla": uf_sigla,
         "cnpj_interessado": cnpj_interessado
     }
@@ -254,86 +727,173 @@ def distribuicao_dfe_route():
         logger.error(f"Missing required fields for NFeDistribuicaoDFe: {missing_fields}")
         return jsonify({"error": f"Missing required fields: {", ".join(missing_fields)}"}), 400
 
-    cert_path_temp = f"/tmp/temp_cert_dist_{os.urandom(8).hex()}.pfx"
     try:
-        with open(cert_path_temp, "wb") as f_cert:
-            f_cert.write(base64.b64decode(cert_base64))
-    except Exception as e:
-        logger.exception("Failed to decode/save temp cert for NFeDistribuicaoDFe.")
-        return jsonify({"error": "Certificate handling error", "details": str(e)}), 500
+        with metricas.estagio(ESTAGIO_CERTIFICADO):
+            certificado, cert_error = resolve_certificate(payload)
+    except CertificateError as e:
+        logger.error(f"Certificate handling error for NFeDistribuicaoDFe: {e}")
+        return jsonify({"error": "Certificate handling error", "details": str(e)}), 400
+    if cert_error:
+        logger.error(cert_error)
+        return jsonify({"error": cert_error}), 400
 
-    try:
-        uf_codigo = UF_CODIGO.get(uf_sigla.upper())
-        if not uf_codigo:
-            logger.error(f"Invalid UF sigla for NFeDistribuicaoDFe: {uf_sigla}")
-            if os.path.exists(cert_path_temp): os.remove(cert_path_temp)
-            return jsonify({"error": f"UF inválida: {uf_sigla}"}), 400
-
-        # NFeDistribuicaoDFe typically uses Ambiente Nacional (AN), which might have specific config in PyNFe or require direct SOAP.
-        # PyNFe's `Config` is usually per-state for emission. For AN services, it might differ.
-        # For now, we'll try with the provided UF, but this might need adjustment for AN.
-        # The MOC states that for DistribuicaoDFe, cUFAutor should be the code for AN (91 for Ambiente Nacional)
-        # However, the `uf` parameter in PyNFe's Config is usually the UF of the *issuer* for state-level services.
-        # Let's assume for now PyNFe handles AN if the service URL points to it.
-        # We will use uf_codigo of the *author* of the request as per MOC for the <cUFAutor> in the SOAP body.
-        # The actual service endpoint for NFeDistribuicaoDFe is national.
-
-        config_dist = Config(
-            cnpj_software_house=CNPJ_SOFTWARE_HOUSE, # May not be needed for this service
-            token_software_house=TOKEN_SOFTWARE_HOUSE, # May not be needed
-            path_certificado=cert_path_temp,
-            senha_certificado=cert_pass,
-            uf=uf_codigo, # This might be ignored if PyNFe uses a hardcoded AN endpoint for this type of service
-            ambiente=int(ambiente_nf) # 1 = Produção, 2 = Homologação (MOC says AN is always prod-like)
-        )
-        logger.info(f"PyNFe Config for DistribuicaoDFe: UF {uf_sigla}, Ambiente {ambiente_nf}")
-
-        # Placeholder for actual NFeDistribuicaoDFe call
-        # PyNFe's high-level `ProcessarNFe` is for sending NFes, not querying distribution.
-        # We would need to use a lower-level SOAP call or a specific PyNFe utility if it exists.
-        # Example using a hypothetical `consultar_distribuicao_dfe` method:
-        # from pynfe.servicos.distribuicao_dfe import NFeDistribuicaoDFe (this class might not exist)
-        # servico = NFeDistribuicaoDFe(configuracoes=config_dist)
-        # resultado = servico.consultar(cnpj=cnpj_interessado, ultimo_nsu=ult_nsu)
-
-        # Since PyNFe might not directly support this, this is a MOCK RESPONSE:
-        logger.warning("NFeDistribuicaoDFe actual SEFAZ call is NOT IMPLEMENTED. Returning mock data.")
-        mock_docs = []
-        if ult_nsu == "0": # Simulate first call
-            mock_docs.append({
-                "schema": "procNFe_v4.00.xsd", 
-                "xml_base64": base64.b64encode(b"<xml_exemplo_nfe_compra1></xml_exemplo_nfe_compra1>").decode(),
-                "nsu": "100000000000001"
-            })
-            mock_docs.append({
-                "schema": "resEvento_v1.00.xsd", 
-                "xml_base64": base64.b64encode(b"<xml_exemplo_evento_cancelamento1></xml_exemplo_evento_cancelamento1>").decode(),
-                "nsu": "100000000000002"
-            })
-        
-        response_data = {
-            "status_sefaz": "sucesso", # cStat from SEFAZ (e.g., 138 for "Documento(s) localizado(s)")
-            "motivo_sefaz": "Documento(s) localizado(s) - MOCK", # xMotivo
-            "ult_nsu_recebido_pela_aplicacao": ult_nsu,
-            "ult_nsu_sefaz": "100000000000005", # ultNSU from SEFAZ
-            "max_nsu_sefaz": "100000000000002", # maxNSU from this batch
-            "documentos": mock_docs, # list of {schema, xml_base64, nsu}
-            "data_hora_consulta": datetime.now().isoformat()
-        }
-        return jsonify(response_data), 200
+    uf_codigo = UF_CODIGO.get(uf_sigla.upper())
+    if not uf_codigo:
+        logger.error(f"Invalid UF sigla for NFeDistribuicaoDFe: {uf_sigla}")
+        return jsonify({"error": f"UF inválida: {uf_sigla}"}), 400
+    metricas.rotular(uf=uf_sigla.upper(), ambiente=ambiente_nf)
+
+    # NFeDistribuicaoDFe is served by the Ambiente Nacional; the pooled session carries the client certificate
+    sessao = session_pool.get(certificado, uf_codigo, ambiente_nf)
+    resumo = {}
+    sync = sync_engine.sincronizar(sessao, cnpj_interessado, uf_codigo, ambiente_nf, ult_nsu=ult_nsu, resumo=resumo,
+                                   antes_da_pagina=prazos.renovar if stream else None)
+    data_hora_consulta = datetime.now().isoformat()
 
+    try:
+        # Pull the first item before answering, so a back-off or SEFAZ rejection still maps to a status code
+        with metricas.estagio(ESTAGIO_SEFAZ):
+            primeiro = next(sync)
+    except StopIteration as fim:
+        primeiro, resumo = None, fim.value
+    except DistribuicaoBloqueada as e:
+        logger.warning(str(e))
+        response = jsonify(erro_distribuicao(e))
+        response.headers["Retry-After"] = str(e.retry_after)
+        return response, 429
     except Exception as e:
         logger.exception("Exception during NFeDistribuicaoDFe processing.")
-        return jsonify({"error": "NFeDistribuicaoDFe processing error", "details": str(e)}), 500
+        return jsonify({"error": "NFeDistribuicaoDFe processing error", "details": str(e)}), 502
+
+    if primeiro is None:
+        documentos = []
+    elif stream:
+        # The body is produced after the view returns: the stream takes over the request's medição (and
+        # finishes it once the sync is over) and its deadline, which the sync renews for every page
+        medicao = g.pop("medicao")
+        metricas.suspender(g.pop("medicao_token"))
+        corpo = stream_distribuicao(sync, primeiro, resumo, ult_nsu, data_hora_consulta, medicao, prazos.atual())
+        return Response(stream_with_context(corpo), mimetype="application/x-ndjson")
+    else:
+        documentos = [primeiro]
+        try:
+            with metricas.estagio(ESTAGIO_SEFAZ):
+                while True:
+                    documentos.append(next(sync))
+        except StopIteration as fim:
+            resumo = fim.value
+        except Exception as e:
+            # The cursor already moved past the pages consumed so far, so their documents must go out with the error;
+            # documents of the failed page are sent again by the next call, which resumes from the cursor
+            logger.exception("Exception during NFeDistribuicaoDFe processing; answering with the documents received so far.")
+            response_data = resumo_distribuicao(resumo, ult_nsu, data_hora_consulta, [documento_para_json(d) for d in documentos])
+            response_data.update({"sincronizacao_completa": False, "erro": erro_distribuicao(e)})
+            response = jsonify(response_data)
+            if isinstance(e, DistribuicaoBloqueada):
+                response.headers["Retry-After"] = str(e.retry_after)
+            return response, 200
+
+    metricas.rotular(cstat=resumo.get("cStat"))
+    return jsonify(resumo_distribuicao(resumo, ult_nsu, data_hora_consulta, [documento_para_json(d) for d in documentos])), 200
+
+def documento_para_json(documento):
+    return {"schema": documento["schema"], "nsu": documento["nsu"],
+            "xml_base64": base64.b64encode(documento["xml"].encode("utf-8")).decode()}
+
+def resumo_distribuicao(resumo, ult_nsu, data_hora_consulta, documentos=None):
+    response_data = {
+        "status_sefaz": resumo.get("cStat"),
+        "motivo_sefaz": resumo.get("xMotivo"),
+        "ult_nsu_recebido_pela_aplicacao": ult_nsu if ult_nsu is not None else resumo.get("ult_nsu_inicial"),
+        "ult_nsu_sefaz": resumo.get("ult_nsu"),
+        "max_nsu_sefaz": resumo.get("max_nsu"),
+        "paginas": resumo.get("paginas"),
+        "total_documentos": resumo.get("documentos"),
+        "proxima_consulta_a_partir_de": datetime.fromtimestamp(resumo["bloqueado_ate"]).isoformat() if resumo.get("bloqueado_ate") else None,
+        "data_hora_consulta": data_hora_consulta,
+        "sincronizacao_completa": True,
+    }
+    if documentos is not None:
+        response_data["documentos"] = documentos
+    return response_data
+
+def erro_distribuicao(e):
+    if isinstance(e, DistribuicaoBloqueada):
+        return {"error": "Distribuição em espera", "details": e.motivo,
+                "bloqueado_ate": datetime.fromtimestamp(e.bloqueado_ate).isoformat()}
+    return {"error": "NFeDistribuicaoDFe processing error", "details": str(e)}
+
+def stream_distribuicao(sync, primeiro, resumo, ult_nsu, data_hora_consulta, medicao, prazo):
+    """
+    NDJSON body: one line per document as it is decoded, then a final line with the sync summary.
+    Runs after the view returned, under the request's medição (labelled with the last cStat and
+    finished here) and deadline (renewed by the sync for every page it requests).
+    """
+    def proximo_documento():
+        # Set and reset within this call: the generator may be resumed from another context between lines
+        medicao_token, prazo_token = metricas.retomar(medicao), prazos.retomar(prazo)
+        try:
+            return next(sync)
+        finally:
+            prazos.encerrar(prazo_token)
+            metricas.suspender(medicao_token)
+
+    yield json.dumps(documento_para_json(primeiro)) + "\n"
+    try:
+        while True:
+            yield json.dumps(documento_para_json(proximo_documento())) + "\n"
+    except StopIteration as fim:
+        yield json.dumps({"resumo": resumo_distribuicao(fim.value, ult_nsu, data_hora_consulta)}) + "\n"
+    except Exception as e:
+        logger.exception("Exception during streamed NFeDistribuicaoDFe processing.")
+        yield json.dumps({**erro_distribuicao(e), "resumo": {**resumo_distribuicao(resumo, ult_nsu, data_hora_consulta),
+                                                            "sincronizacao_completa": False}}) + "\n"
     finally:
-        if os.path.exists(cert_path_temp):
-            try: os.remove(cert_path_temp)
-            except Exception as e_rm: logger.error(f"Error removing temp cert for DistribuicaoDFe: {e_rm}")
+        sync.close()
+        medicao_token = metricas.retomar(medicao)
+        metricas.rotular(cstat=resumo.get("cStat"))
+        metricas.finalizar(medicao, medicao_token, 200)
+
+@app.route("/api/nfe/distribuicao-dfe/<cnpj>", methods=["GET"])
+def distribuicao_dfe_estado_route(cnpj):
+    estado = sync_engine.estado(cnpj, request.args.get("ambiente", "1"))
+    if estado.get("bloqueado_ate"):
+        estado["bloqueado_ate"] = datetime.fromtimestamp(estado["bloqueado_ate"]).isoformat()
+    return jsonify(estado), 200
+
+@app.route("/api/nfe/parse", methods=["POST"])
+def parse_nfe_route():
+    """
+    Extracts ExtractedNFeData from procNFe/resNFe/resEvento documents and streams one NDJSON line per document.
+    Accepts a raw XML body, multipart uploads (any number of files), the JSON output of distribuicao-dfe
+    ({"documentos": [{"xml_base64", "nsu"}]}) or its NDJSON stream.
+    """
+    content_type = request.mimetype or ""
+    if request.files:
+        # Uploaded files are closed when the request context is torn down, before the streamed body runs
+        fontes = [(arquivo.filename or campo, arquivo.read()) for campo, arquivo in request.files.items(multi=True)]
+    elif content_type == "application/json":
+        payload = request.get_json(silent=True) or {}
+        documentos = payload.get("documentos")
+        if not isinstance(documentos, list):
+            return jsonify({"error": "Missing required fields: documentos"}), 400
+        fontes = fontes_de_distribuicao(documentos)
+    elif content_type == "application/x-ndjson":
+        fontes = fontes_de_ndjson(io.TextIOWrapper(request.stream, encoding="utf-8"))
+    elif content_type in ("text/xml", "application/xml"):
+        fontes = [("0", request.stream)] # parsed straight off the socket
+    else:
+        return jsonify({"error": "Envie XML, multipart com arquivos XML, JSON ou NDJSON de distribuição."}), 415
+
+    def gerar():
+        for documento in iterar_documentos(fontes):
+            yield json.dumps(documento, ensure_ascii=False) + "\n"
+    return Response(stream_with_context(gerar()), mimetype="application/x-ndjson")
 
 if __name__ == "__main__":
-    from datetime import datetime # Add this import for the mock response
     host = os.environ.get("FLASK_RUN_HOST", "0.0.0.0")
     port = int(os.environ.get("FLASK_RUN_PORT", 5001))
     logger.info(f"Starting SEFAZ service for local development on {host}:{port}")
+    job_manager.start(recover=True) # Resume jobs queued before the last shutdown
     app.run(host=host, port=port, debug=False)
 
@@ -0,0 +1,341 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/metricas.py
+# Per-stage latency metrics for the SEFAZ service, exposed in Prometheus text format.
+#
+# Each request (or async job) gets a Medicao holding the duration of every stage it went through:
+# certificado, config, mapeamento, assinatura, sefaz (the round trip to the authorizer) and danfe.
+# When the request ends the stages are observed into histograms labelled by route, UF, ambiente and
+# SEFAZ cStat (labels are only known as the request progresses, so they are attached at the end),
+# and the same breakdown is returned in a Server-Timing header. In-flight gauges and error counters
+# are updated as things happen.
+#
+# Metrics live in the process that recorded them. Under the prefork server each worker also writes a
+# snapshot of its values to SEFAZ_METRICS_DIR every few seconds, and /metrics, whichever worker
+# answers it, reports the sum over all of them (gauges only from workers still alive).
+import os
+import json
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROTULOS_NOTA = ("uf", "ambiente", "cstat")
+
+ESTAGIO_CERTIFICADO = "certificado"
+ESTAGIO_CONFIG = "config"
+ESTAGIO_MAPEAMENTO = "mapeamento"
+ESTAGIO_ASSINATURA = "assinatura"
+ESTAGIO_SEFAZ = "sefaz"
+ESTAGIO_DANFE = "danfe"
+
+METRICS_DIR = os.environ.get("SEFAZ_METRICS_DIR")
+METRICS_INTERVAL_SECONDS = float(os.environ.get("SEFAZ_METRICS_INTERVAL", 5))
+
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _formatar_rotulos(nomes, valores, extra=None):
+    pares = [f'{nome}="{_escapar(valor)}"' for nome, valor in zip(nomes, valores)]
+    if extra:
+        pares.append(extra)
+    return "{" + ",".join(pares) + "}" if pares else ""
+
+
+def rss_bytes():
+    """Resident set size of this process, or None where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _processo_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Metrica:
+    tipo = None
+
+    def __init__(self, nome, ajuda, rotulos=()):
+        self.nome = nome
+        self.ajuda = ajuda
+        self.rotulos = tuple(rotulos)
+        self._valores = {}
+        self._lock = threading.Lock()
+
+    def _chave(self, rotulos):
+        return tuple(str(rotulos.get(nome, "")) for nome in self.rotulos)
+
+    def _copiar(self, valor):
+        return valor
+
+    def _somar(self, valor, outro):
+        return valor + outro
+
+    def exportar(self):
+        with self._lock:
+            return [[list(chave), self._copiar(valor)] for chave, valor in self._valores.items()]
+
+    def render(self, outros=()):
+        """Prometheus text lines; outros are exportar() results of other processes, added to this one's values."""
+        linhas = [f"# HELP {self.nome} {self.ajuda}", f"# TYPE {self.nome} {self.tipo}"]
+        with self._lock:
+            valores = {chave: self._copiar(valor) for chave, valor in self._valores.items()}
+        for series in outros:
+            for chave, valor in series:
+                chave = tuple(chave)
+                valores[chave] = self._somar(valores[chave], valor) if chave in valores else valor
+        for chave, valor in sorted(valores.items()):
+            linhas.extend(self._render_serie(chave, valor))
+        return linhas
+
+    def _render_serie(self, chave, valor):
+        return [f"{self.nome}{_formatar_rotulos(self.rotulos, chave)} {valor}"]
+
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, quantidade=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self._lock:
+            self._valores[chave] = self._valores.get(chave, 0) + quantidade
+
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def inc(self, quantidade=1, **rotulos):
+        chave = self._chave(rotulos)
+        with self._lock:
+            self._valores[chave] = self._valores.get(chave, 0) + quantidade
+
+    def dec(self, quantidade=1, **rotulos):
+        self.inc(-quantidade, **rotulos)
+
+    def set(self, valor, **rotulos):
+        with self._lock:
+            self._valores[self._chave(rotulos)] = valor
+
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nome, ajuda, rotulos=(), buckets=BUCKETS_SEGUNDOS):
+        super().__init__(nome, ajuda, rotulos)
+        self.buckets = tuple(buckets)
+
+    def observe(self, valor, **rotulos):
+        chave = self._chave(rotulos)
+        with self._lock:
+            serie = self._valores.get(chave)
+            if serie is None:
+                serie = self._valores[chave] = [[0] * len(self.buckets), 0, 0.0] # bucket counts, count, sum
+            for i, limite in enumerate(self.buckets):
+                if valor <= limite:
+                    serie[0][i] += 1
+                    break
+            serie[1] += 1
+            serie[2] += valor
+
+    def _copiar(self, serie):
+        return [list(serie[0]), serie[1], serie[2]]
+
+    def _somar(self, serie, outra):
+        return [[a + b for a, b in zip(serie[0], outra[0])], serie[1] + outra[1], serie[2] + outra[2]]
+
+    def _render_serie(self, chave, serie):
+        contagens, total, soma = serie
+        linhas = []
+        acumulado = 0
+        for limite, contagem in zip(self.buckets, contagens):
+            acumulado += contagem
+            le = 'le="%g"' % limite
+            linhas.append(f"{self.nome}_bucket{_formatar_rotulos(self.rotulos, chave, le)} {acumulado}")
+        le = 'le="+Inf"'
+        linhas.append(f"{self.nome}_bucket{_formatar_rotulos(self.rotulos, chave, le)} {total}")
+        linhas.append(f"{self.nome}_count{_formatar_rotulos(self.rotulos, chave)} {total}")
+        linhas.append(f"{self.nome}_sum{_formatar_rotulos(self.rotulos, chave)} {soma:.6f}")
+        return linhas
+
+
+class Medicao:
+    """Stage timings and labels of one request or job."""
+
+    def __init__(self, rota):
+        self.rota = rota
+        self.inicio = time.perf_counter()
+        self.rotulos = dict.fromkeys(ROTULOS_NOTA, "")
+        self.estagios = [] # (estagio, segundos), in order; a stage may repeat (e.g. one sefaz call per lote)
+
+    def server_timing(self, total=None):
+        somas = {}
+        for estagio, segundos in self.estagios:
+            somas[estagio] = somas.get(estagio, 0.0) + segundos
+        partes = [f"{estagio};dur={segundos * 1000:.1f}" for estagio, segundos in somas.items()]
+        partes.append(f"total;dur={(total if total is not None else time.perf_counter() - self.inicio) * 1000:.1f}")
+        return ", ".join(partes)
+
+
+_medicao_atual = contextvars.ContextVar("medicao_atual", default=None)
+
+
+class Metricas:
+    def __init__(self):
+        self.duracao_estagio = Histograma("sefaz_service_stage_duration_seconds",
+                                          "Duration of each processing stage.", ("route", "stage") + ROTULOS_NOTA)
+        self.duracao_requisicao = Histograma("sefaz_service_request_duration_seconds",
+                                             "Total duration of requests and async jobs.", ("route", "status") + ROTULOS_NOTA)
+        self.requisicoes_em_andamento = Medidor("sefaz_service_requests_in_flight", "Requests and jobs being processed.", ("route",))
+        self.sefaz_em_andamento = Medidor("sefaz_service_sefaz_calls_in_flight", "Calls to a SEFAZ authorizer waiting for an answer.",
+                                          ("uf", "ambiente"))
+        self.erros = Contador("sefaz_service_errors_total", "Exceptions raised inside a stage.", ("route", "stage", "error"))
+        self.cstat = Contador("sefaz_service_sefaz_responses_total", "SEFAZ answers by cStat.", ("route",) + ROTULOS_NOTA)
+        self.jobs_executando = Medidor("sefaz_service_jobs_running", "Async emission jobs executing, per UF.", ("uf",))
+        self.jobs_aguardando = Medidor("sefaz_service_jobs_waiting", "Async emission jobs queued behind the UF limit.", ("uf",))
+        self.memoria_worker = Medidor("sefaz_service_worker_resident_memory_bytes", "Resident memory of each server process.",
+                                      ("worker",))
+        self.inicializacao_worker = Medidor("sefaz_service_worker_startup_seconds",
+                                            "Time from server start until each worker was ready.", ("worker",))
+        self._todas = (self.duracao_estagio, self.duracao_requisicao, self.requisicoes_em_andamento,
+                       self.sefaz_em_andamento, self.erros, self.cstat, self.jobs_executando, self.jobs_aguardando,
+                       self.memoria_worker, self.inicializacao_worker)
+        self.diretorio = None
+        self._exportador = None
+
+    def iniciar(self, rota):
+        """Starts timing a request or job on the current context. Returns (medicao, token) for finalizar()."""
+        medicao = Medicao(rota)
+        self.requisicoes_em_andamento.inc(route=rota)
+        return medicao, _medicao_atual.set(medicao)
+
+    def finalizar(self, medicao, token, status):
+        _medicao_atual.reset(token)
+        total = time.perf_counter() - medicao.inicio
+        self.requisicoes_em_andamento.dec(route=medicao.rota)
+        for estagio, segundos in medicao.estagios:
+            self.duracao_estagio.observe(segundos, route=medicao.rota, stage=estagio, **medicao.rotulos)
+        self.duracao_requisicao.observe(total, route=medicao.rota, status=status, **medicao.rotulos)
+        return total
+
+    @contextmanager
+    def medir(self, rota):
+        """Context manager form of iniciar/finalizar, for work that runs outside a Flask request (async jobs)."""
+        medicao, token = self.iniciar(rota)
+        resultado = {"status": "erro"}
+        try:
+            yield resultado
+        finally:
+            self.finalizar(medicao, token, resultado["status"])
+
+    def suspender(self, token):
+        """Detaches the current medição from the context without finishing it; retomar() makes it current again."""
+        _medicao_atual.reset(token)
+
+    def retomar(self, medicao):
+        """Makes a suspended medição current again. Returns the token for suspender() or finalizar()."""
+        return _medicao_atual.set(medicao)
+
+    def rotular(self, **rotulos):
+        """Attaches uf/ambiente/cstat to the current request as soon as they are known."""
+        medicao = _medicao_atual.get()
+        if medicao is None:
+            return
+        for nome, valor in rotulos.items():
+            if valor is not None and nome in medicao.rotulos:
+                medicao.rotulos[nome] = str(valor)
+        if rotulos.get("cstat") is not None:
+            self.cstat.inc(route=medicao.rota, **medicao.rotulos)
+
+    @contextmanager
+    def estagio(self, nome):
+        """Times one stage of the current request; exceptions are counted and re-raised."""
+        medicao = _medicao_atual.get()
+        rota = medicao.rota if medicao else ""
+        chamada_sefaz = nome == ESTAGIO_SEFAZ and medicao is not None
+        if chamada_sefaz:
+            uf, ambiente = medicao.rotulos["uf"], medicao.rotulos["ambiente"]
+            self.sefaz_em_andamento.inc(uf=uf, ambiente=ambiente)
+        inicio = time.perf_counter()
+        try:
+            yield
+        except StopIteration: # end of a generator driven inside the stage, not a failure
+            raise
+        except Exception as e:
+            self.erros.inc(route=rota, stage=nome, error=type(e).__name__)
+            raise
+        finally:
+            if medicao is not None:
+                medicao.estagios.append((nome, time.perf_counter() - inicio))
+            if chamada_sefaz:
+                self.sefaz_em_andamento.dec(uf=uf, ambiente=ambiente)
+
+    def atualizar_processo(self):
+        rss = rss_bytes()
+        if rss is not None:
+            self.memoria_worker.set(rss, worker=os.getpid())
+
+    def iniciar_exportacao(self, diretorio=METRICS_DIR, intervalo=METRICS_INTERVAL_SECONDS):
+        """Starts writing this process's snapshot to diretorio every intervalo seconds (call it after fork)."""
+        if not diretorio or self._exportador is not None:
+            return
+        os.makedirs(diretorio, exist_ok=True)
+        self.diretorio = diretorio
+
+        def exportar():
+            while True:
+                time.sleep(intervalo)
+                try:
+                    self.salvar()
+                except Exception:
+                    logger.exception("Could not write metrics snapshot.")
+        self._exportador = threading.Thread(target=exportar, name="metricas", daemon=True)
+        self._exportador.start()
+        self.salvar()
+
+    def salvar(self):
+        if not self.diretorio:
+            return
+        self.atualizar_processo()
+        caminho = os.path.join(self.diretorio, f"{os.getpid()}.json")
+        with open(f"{caminho}.tmp", "w") as f:
+            json.dump({metrica.nome: metrica.exportar() for metrica in self._todas}, f)
+        os.replace(f"{caminho}.tmp", caminho)
+
+    def _snapshots_de_outros(self):
+        snapshots = []
+        for nome in os.listdir(self.diretorio):
+            pid, _, extensao = nome.partition(".")
+            if extensao != "json" or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.diretorio, nome)) as f:
+                    snapshots.append((_processo_vivo(int(pid)), json.load(f)))
+            except (OSError, ValueError):
+                continue # being replaced, or removed with its worker
+        return snapshots
+
+    def render(self):
+        self.atualizar_processo()
+        outros = self._snapshots_de_outros() if self.diretorio else []
+        linhas = []
+        for metrica in self._todas:
+            # Counters and histograms of dead workers still count; their gauges no longer mean anything
+            linhas.extend(metrica.render([snapshot.get(metrica.nome, []) for vivo, snapshot in outros
+                                          if vivo or metrica.tipo != "gauge"]))
+        return "\n".join(linhas) + "\n"
+
+
+metricas = Metricas()
@@ -0,0 +1,263 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/numeracao.py
+# NF-e number allocator per emitente CNPJ, modelo and série.
+#
+# Numbers are handed out inside a BEGIN IMMEDIATE transaction on a local SQLite (WAL) database, so
+# concurrent emissions (threads, async jobs, or several service processes sharing the file) never
+# take the same number. Every number handed out is tracked until its outcome is known:
+#   reservado  -> utilizado   authorized (or denied) by SEFAZ; the number is spent
+#   reservado  -> livre       never reached SEFAZ, or rejected; reused by the next reservation
+#   reservado  -> inutilizar  outcome unknown (transport error, expired reservation), or rejected
+#                             with SEFAZ_NUMERACAO_REUSAR_REJEITADAS=0; queued for inutilização
+#   inutilizar -> inutilizado after the caller has run the inutilização at SEFAZ
+#   reservado  -> conciliar   cStat 539: SEFAZ already has another NF-e with this number, and its
+#                             answer did not say which; spent, but the chave must be looked up
+# Free numbers are reused lowest first, so series stay without gaps.
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("SEFAZ_DATA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+NUMERACAO_DB_PATH = os.environ.get("SEFAZ_NUMERACAO_DB", os.path.join(DATA_DIR, "numeracao.sqlite3"))
+# A reservation still open after this long belongs to an emission that died mid-way
+RESERVA_TTL_SECONDS = int(os.environ.get("SEFAZ_NUMERACAO_RESERVA_TTL", 15 * 60))
+REUSAR_REJEITADAS = os.environ.get("SEFAZ_NUMERACAO_REUSAR_REJEITADAS", "1") != "0"
+NUMERO_MAXIMO = 999999999 # nNF has 9 digits
+
+STATUS_RESERVADO = "reservado"
+STATUS_UTILIZADO = "utilizado"
+STATUS_LIVRE = "livre"
+STATUS_INUTILIZAR = "inutilizar"
+STATUS_INUTILIZADO = "inutilizado"
+STATUS_CONCILIAR = "conciliar"
+
+# cStat values that spend the number even though the NF-e is not authorized
+CSTAT_DENEGADA = ("110", "301", "302", "303")
+CSTAT_DUPLICIDADE = ("204", "539")
+CSTAT_DUPLICIDADE_CHAVE_DIFERENTE = "539"
+# xMotivo of a 539 usually names the NF-e already authorized, e.g. "... Chave de Acesso [chNFe:3524...]"
+CHAVE_DUPLICADA_RE = re.compile(r"chNFe:\s*(\d{44})")
+
+
+class NumeracaoError(Exception):
+    pass
+
+
+def _chave_serie(cnpj, modelo, serie):
+    return str(cnpj), str(modelo), str(int(serie))
+
+
+def agrupar_faixas(numeros):
+    """[1, 2, 3, 7, 9, 10] -> [[1, 3], [7, 7], [9, 10]], the form used by inutilização requests."""
+    faixas = []
+    for numero in sorted(numeros):
+        if faixas and numero == faixas[-1][1] + 1:
+            faixas[-1][1] = numero
+        else:
+            faixas.append([numero, numero])
+    return faixas
+
+
+class NumeracaoStore:
+    def __init__(self, path=NUMERACAO_DB_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA busy_timeout=30000")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS numeracao_serie (
+                    cnpj TEXT NOT NULL,
+                    modelo TEXT NOT NULL,
+                    serie TEXT NOT NULL,
+                    ultimo_numero INTEGER NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (cnpj, modelo, serie)
+                )""")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS numeracao_numero (
+                    cnpj TEXT NOT NULL,
+                    modelo TEXT NOT NULL,
+                    serie TEXT NOT NULL,
+                    numero INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    chave_acesso TEXT,
+                    motivo TEXT,
+                    reservado_em REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (cnpj, modelo, serie, numero)
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS numeracao_numero_status ON numeracao_numero (status, cnpj, modelo, serie, numero)")
+
+    def transaction(self):
+        return _Transacao(self)
+
+
+class _Transacao:
+    """BEGIN IMMEDIATE takes SQLite's write lock up front, which serializes allocators across processes too."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __enter__(self):
+        self.store._lock.acquire()
+        try:
+            self.store._conn.execute("BEGIN IMMEDIATE")
+        except Exception:
+            self.store._lock.release()
+            raise
+        return self.store._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.store._conn.execute("COMMIT")
+            elif self.store._conn.in_transaction: # SQLite may have rolled back already (e.g. on an I/O error)
+                self.store._conn.execute("ROLLBACK")
+        finally:
+            self.store._lock.release()
+
+
+class NumeradorNFe:
+    def __init__(self, store=None, reserva_ttl=RESERVA_TTL_SECONDS, reusar_rejeitadas=REUSAR_REJEITADAS):
+        self._store = store
+        self.reserva_ttl = reserva_ttl
+        self.reusar_rejeitadas = reusar_rejeitadas
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = NumeracaoStore()
+        return self._store
+
+    def reservar(self, cnpj, modelo, serie, quantidade=1, ultimo_numero_conhecido=None):
+        """
+        Atomically reserves `quantidade` numbers for this CNPJ, modelo and série and returns them sorted.
+        Free numbers are reused first; the rest is a consecutive range above the highest number handed out.
+        ultimo_numero_conhecido (the caller's own counter, if any) only ever moves the series forward.
+        """
+        if quantidade < 1:
+            raise NumeracaoError("quantidade deve ser maior que zero")
+        chave = _chave_serie(cnpj, modelo, serie)
+        agora = time.time()
+        with self.store.transaction() as conn:
+            self._expirar_reservas(conn, chave, agora)
+            livres = [row["numero"] for row in conn.execute(
+                "SELECT numero FROM numeracao_numero WHERE status = ? AND cnpj = ? AND modelo = ? AND serie = ? "
+                "ORDER BY numero LIMIT ?", (STATUS_LIVRE, *chave, quantidade))]
+
+            row = conn.execute("SELECT ultimo_numero FROM numeracao_serie WHERE cnpj = ? AND modelo = ? AND serie = ?", chave).fetchone()
+            ultimo = row["ultimo_numero"] if row else 0
+            if ultimo_numero_conhecido is not None and int(ultimo_numero_conhecido) > ultimo:
+                ultimo = int(ultimo_numero_conhecido)
+            faltam = quantidade - len(livres)
+            if ultimo + faltam > NUMERO_MAXIMO:
+                raise NumeracaoError(f"Série {chave[2]} do modelo {chave[1]} esgotada para o CNPJ {chave[0]}")
+            novos = list(range(ultimo + 1, ultimo + faltam + 1))
+            conn.execute(
+                "INSERT INTO numeracao_serie (cnpj, modelo, serie, ultimo_numero, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (cnpj, modelo, serie) DO UPDATE SET ultimo_numero = excluded.ultimo_numero, updated_at = excluded.updated_at",
+                (*chave, ultimo + faltam, agora))
+            conn.executemany(
+                "INSERT OR REPLACE INTO numeracao_numero (cnpj, modelo, serie, numero, status, reservado_em, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*chave, numero, STATUS_RESERVADO, agora, agora) for numero in livres + novos])
+        numeros = sorted(livres + novos)
+        logger.info(f"Reserved NF-e number(s) {agrupar_faixas(numeros)} for CNPJ {chave[0]}, modelo {chave[1]}, série {chave[2]}.")
+        return numeros
+
+    def confirmar(self, cnpj, modelo, serie, numero, chave_acesso=None, motivo=None):
+        """The number reached SEFAZ and is spent (authorized, denied or already used)."""
+        # Also accepted from the inutilização queue (an expired reservation may still come back authorized)
+        # and from the reconciliation one, once the chave holding the number is known
+        self._atualizar(cnpj, modelo, serie, numero, STATUS_UTILIZADO, (STATUS_RESERVADO, STATUS_INUTILIZAR, STATUS_CONCILIAR),
+                        chave_acesso=chave_acesso, motivo=motivo)
+
+    def devolver(self, cnpj, modelo, serie, numero, motivo=None):
+        """The nota never reached SEFAZ (mapping or signing error); the number goes back to the pool."""
+        self._atualizar(cnpj, modelo, serie, numero, STATUS_LIVRE, (STATUS_RESERVADO,), motivo=motivo)
+
+    def marcar_para_inutilizacao(self, cnpj, modelo, serie, numero, motivo=None):
+        """The outcome at SEFAZ is unknown; the number must not be reused and is queued for inutilização."""
+        self._atualizar(cnpj, modelo, serie, numero, STATUS_INUTILIZAR, (STATUS_RESERVADO,), motivo=motivo)
+
+    def registrar_retorno(self, cnpj, modelo, serie, numero, cstat, chave_acesso=None, motivo=None):
+        """Settles a reserved number from the cStat SEFAZ returned for its nota."""
+        cstat = str(cstat or "")
+        if cstat == CSTAT_DUPLICIDADE_CHAVE_DIFERENTE:
+            # The number belongs to another NF-e, so the chave that was sent is not the one to keep
+            encontrada = CHAVE_DUPLICADA_RE.search(motivo or "")
+            if encontrada:
+                self.confirmar(cnpj, modelo, serie, numero, chave_acesso=encontrada.group(1), motivo=f"cStat {cstat}")
+            else:
+                logger.warning(f"NF-e number {numero} (CNPJ {cnpj}, série {serie}) is already used by an unknown chave; queued for reconciliation.")
+                self._atualizar(cnpj, modelo, serie, numero, STATUS_CONCILIAR, (STATUS_RESERVADO, STATUS_INUTILIZAR),
+                                motivo=f"cStat {cstat} - {motivo}")
+        elif cstat == "100" or cstat in CSTAT_DENEGADA or cstat in CSTAT_DUPLICIDADE:
+            self.confirmar(cnpj, modelo, serie, numero, chave_acesso=chave_acesso, motivo=f"cStat {cstat}")
+        elif self.reusar_rejeitadas:
+            # A rejected NF-e is not recorded by SEFAZ, so its number can go to the next nota
+            self.devolver(cnpj, modelo, serie, numero, motivo=f"cStat {cstat} - {motivo}")
+        else:
+            self.marcar_para_inutilizacao(cnpj, modelo, serie, numero, motivo=f"cStat {cstat} - {motivo}")
+
+    def marcar_inutilizados(self, cnpj, modelo, serie, numero_inicial, numero_final, protocolo=None):
+        """Records an inutilização done at SEFAZ for numbers queued in this store. Returns how many were updated."""
+        chave = _chave_serie(cnpj, modelo, serie)
+        with self.store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE numeracao_numero SET status = ?, motivo = ?, updated_at = ? WHERE status = ? AND cnpj = ? "
+                "AND modelo = ? AND serie = ? AND numero BETWEEN ? AND ?",
+                (STATUS_INUTILIZADO, f"protocolo {protocolo}" if protocolo else None, time.time(), STATUS_INUTILIZAR,
+                 *chave, int(numero_inicial), int(numero_final)))
+            return cursor.rowcount
+
+    def estado(self, cnpj, modelo, serie):
+        chave = _chave_serie(cnpj, modelo, serie)
+        with self.store.transaction() as conn:
+            self._expirar_reservas(conn, chave, time.time())
+            row = conn.execute("SELECT ultimo_numero FROM numeracao_serie WHERE cnpj = ? AND modelo = ? AND serie = ?", chave).fetchone()
+            por_status = {}
+            for r in conn.execute("SELECT status, numero FROM numeracao_numero WHERE cnpj = ? AND modelo = ? AND serie = ? "
+                                  "AND status != ? ORDER BY numero", (*chave, STATUS_UTILIZADO)):
+                por_status.setdefault(r["status"], []).append(r["numero"])
+        return {"cnpj": chave[0], "modelo": chave[1], "serie": chave[2],
+                "ultimo_numero": row["ultimo_numero"] if row else 0,
+                "reservados": agrupar_faixas(por_status.get(STATUS_RESERVADO, [])),
+                "livres": agrupar_faixas(por_status.get(STATUS_LIVRE, [])),
+                "a_inutilizar": agrupar_faixas(por_status.get(STATUS_INUTILIZAR, [])),
+                "inutilizados": agrupar_faixas(por_status.get(STATUS_INUTILIZADO, [])),
+                "a_conciliar": agrupar_faixas(por_status.get(STATUS_CONCILIAR, []))}
+
+    def ultimo_numero(self, cnpj, modelo, serie):
+        chave = _chave_serie(cnpj, modelo, serie)
+        with self.store._lock:
+            row = self.store._conn.execute("SELECT ultimo_numero FROM numeracao_serie WHERE cnpj = ? AND modelo = ? AND serie = ?", chave).fetchone()
+        return row["ultimo_numero"] if row else 0
+
+    def _atualizar(self, cnpj, modelo, serie, numero, status, de_status, chave_acesso=None, motivo=None):
+        chave = _chave_serie(cnpj, modelo, serie)
+        with self.store.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE numeracao_numero SET status = ?, chave_acesso = COALESCE(?, chave_acesso), motivo = ?, updated_at = ? "
+                f"WHERE cnpj = ? AND modelo = ? AND serie = ? AND numero = ? AND status IN ({', '.join('?' for _ in de_status)})",
+                (status, chave_acesso, motivo, time.time(), *chave, int(numero), *de_status))
+        if cursor.rowcount == 0:
+            logger.warning(f"NF-e number {numero} (CNPJ {chave[0]}, modelo {chave[1]}, série {chave[2]}) is not {' or '.join(de_status)}; status {status} ignored.")
+
+    def _expirar_reservas(self, conn, chave, agora):
+        cursor = conn.execute(
+            "UPDATE numeracao_numero SET status = ?, motivo = ?, updated_at = ? WHERE status = ? AND cnpj = ? AND modelo = ? "
+            "AND serie = ? AND reservado_em < ?",
+            (STATUS_INUTILIZAR, "reserva expirada", agora, STATUS_RESERVADO, *chave, agora - self.reserva_ttl))
+        if cursor.rowcount:
+            logger.warning(f"{cursor.rowcount} expired NF-e number reservation(s) for CNPJ {chave[0]}, série {chave[2]} queued for inutilização.")
+
+
+numerador = NumeradorNFe()
@@ -0,0 +1,95 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/prazos.py
+# Per-route time budgets for the SEFAZ service.
+#
+# Every request (and async job) gets a deadline from its route. Python cannot interrupt a thread,
+# so the deadline is enforced where the time is actually spent: the pooled SEFAZ sessions cap each
+# HTTP call at the time left, the DANFE wait is bounded by it, and PrazoExcedido is raised once
+# the budget is gone. A streamed distribution sync renews the budget for every page it requests
+# (renovar), so a long catch-up is bounded per SEFAZ call. Budgets can be overridden with SEFAZ_ROUTE_TIMEOUTS, e.g.
+# "/api/nfe/generate-transmit=60,job:nfe_lote=900".
+import os
+import time
+import contextvars
+
+ROUTE_TIMEOUT_DEFAULT = float(os.environ.get("SEFAZ_ROUTE_TIMEOUT", 30))
+ROUTE_TIMEOUTS = {
+    "/api/nfe/generate-transmit": 90,
+    "/api/nfe/generate-transmit-batch": 600,
+    "/api/nfe/<chave_acesso>/danfe": 60,
+    "/api/nfe/distribuicao-dfe": 120,
+    "/api/nfe/parse": 300,
+    "job:nfe": 90,
+    "job:nfe_lote": 600,
+}
+
+
+def _ler_overrides(valor):
+    overrides = {}
+    for item in (valor or "").split(","):
+        rota, _, segundos = item.strip().rpartition("=")
+        if rota and segundos:
+            overrides[rota] = float(segundos)
+    return overrides
+
+
+ROUTE_TIMEOUTS.update(_ler_overrides(os.environ.get("SEFAZ_ROUTE_TIMEOUTS")))
+
+
+class PrazoExcedido(TimeoutError):
+    """Raised when a request or job runs past its route's time budget."""
+
+
+_prazo_atual = contextvars.ContextVar("prazo_atual", default=None)
+
+
+def timeout_da_rota(rota):
+    return ROUTE_TIMEOUTS.get(rota, ROUTE_TIMEOUT_DEFAULT)
+
+
+def iniciar(rota):
+    """Starts the route's deadline on the current context. Returns the token for encerrar()."""
+    return _prazo_atual.set([rota, time.monotonic() + timeout_da_rota(rota)])
+
+
+def encerrar(token):
+    _prazo_atual.reset(token)
+
+
+def atual():
+    """The current deadline, for retomar() in code that runs after the request (a streamed body)."""
+    return _prazo_atual.get()
+
+
+def retomar(prazo):
+    """Makes a deadline from atual() current again. Returns the token for encerrar()."""
+    return _prazo_atual.set(prazo)
+
+
+def renovar():
+    """Restarts the current deadline with the route's full budget, from now."""
+    prazo = _prazo_atual.get()
+    if prazo is not None:
+        prazo[1] = time.monotonic() + timeout_da_rota(prazo[0])
+
+
+def restante():
+    """Seconds left before the current deadline, or None outside a request or job."""
+    prazo = _prazo_atual.get()
+    return None if prazo is None else prazo[1] - time.monotonic()
+
+
+def verificar(etapa=""):
+    """Raises PrazoExcedido if the current deadline has passed."""
+    prazo = _prazo_atual.get()
+    if prazo is not None and time.monotonic() >= prazo[1]:
+        raise PrazoExcedido(f"Tempo limite de {timeout_da_rota(prazo[0]):g}s da rota {prazo[0]} excedido"
+                            + (f" antes {etapa}" if etapa else ""))
+
+
+def limitar(timeout):
+    """The smaller of timeout and the time left (None means no limit); raises PrazoExcedido if none is left."""
+    segundos = restante()
+    if segundos is None:
+        return timeout
+    verificar()
+    return segundos if timeout is None else min(timeout, segundos)
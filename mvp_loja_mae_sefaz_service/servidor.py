@@ -0,0 +1,158 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/servidor.py
+# Production serving mode: prefork gunicorn workers with threads (see gunicorn.conf.py).
+#
+# The master imports the app, PyNFe, the signing stack and the UF tables once and freezes them out of
+# the garbage collector before forking, so workers share those pages copy-on-write instead of each
+# loading its own copy. Per-process state is set up after fork: the job pool (jobs are claimed
+# through SQLite, so workers never run the same one), the metrics snapshot thread, and the SEFAZ
+# sessions and DANFE pool, which are created lazily. Certificates registered in one worker are
+# shared with the others through an encrypted tmpfs spool. On SIGTERM gunicorn stops accepting,
+# lets in-flight requests finish within graceful_timeout, and each worker then drains its jobs.
+import os
+import gc
+import time
+import shutil
+import hashlib
+import logging
+import secrets
+import tempfile
+import importlib
+
+import prazos
+
+logger = logging.getLogger(__name__)
+
+INICIO = time.time()
+
+# The longest route budget, so a request that started before SIGTERM can still finish
+GRACEFUL_TIMEOUT_SECONDS = float(os.environ.get("SEFAZ_GRACEFUL_TIMEOUT", max(prazos.ROUTE_TIMEOUTS.values())))
+
+# Modules PyNFe loads lazily on the first emission or DANFE; missing ones (other PyNFe versions) are skipped
+MODULOS_PRECARREGADOS = (
+    "pynfe.processamento.assinatura",
+    "pynfe.processamento.serializacao",
+    "pynfe.processamento.comunicacao",
+    "pynfe.utils.danfe",
+    "signxml",
+    "lxml.etree",
+)
+
+
+# Directories configurar_ambiente() created for this run, removed on exit; configured ones are kept
+DIRETORIOS_DESTA_EXECUCAO = ["SEFAZ_METRICS_DIR"]
+
+
+def configurar_ambiente():
+    """
+    Environment shared by all workers; must run before main (and so certificados and metricas) is imported.
+    Without a configured SEFAZ_CERT_HANDLE_SECRET, one is generated for this server run so that every
+    worker derives the same handles; the spool it encrypts is then useless after exit and removed. With a
+    configured secret the spool is kept, so pending jobs can resume after a restart.
+    """
+    secret_gerado = not os.environ.get("SEFAZ_CERT_HANDLE_SECRET")
+    if secret_gerado:
+        os.environ["SEFAZ_CERT_HANDLE_SECRET"] = secrets.token_hex(32)
+    chave = hashlib.sha256(os.environ["SEFAZ_CERT_HANDLE_SECRET"].encode()).hexdigest()[:12]
+    base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    if not os.environ.get("SEFAZ_CERT_SHARED_DIR"):
+        os.environ["SEFAZ_CERT_SHARED_DIR"] = os.path.join(base, f"sefaz_certs_shared_{chave}")
+        if secret_gerado:
+            DIRETORIOS_DESTA_EXECUCAO.append("SEFAZ_CERT_SHARED_DIR")
+    if not os.environ.get("SEFAZ_METRICS_DIR"):
+        os.environ["SEFAZ_METRICS_DIR"] = tempfile.mkdtemp(prefix="sefaz_metricas_", dir=base)
+
+
+def memoria_do_processo(pid="self"):
+    """Rss, Pss and shared/private bytes of a process, from /proc/<pid>/smaps_rollup (empty where unavailable)."""
+    campos = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for linha in f:
+                nome, _, valor = linha.partition(":")
+                if valor.strip().endswith("kB"):
+                    campos[nome] = int(valor.split()[0]) * 1024
+    except OSError:
+        return {}
+    return {"rss": campos.get("Rss", 0), "pss": campos.get("Pss", 0),
+            "compartilhada": campos.get("Shared_Clean", 0) + campos.get("Shared_Dirty", 0),
+            "privada": campos.get("Private_Clean", 0) + campos.get("Private_Dirty", 0)}
+
+
+def _mib(valor):
+    return f"{valor / 1024 / 1024:.1f} MiB"
+
+
+def precarregar():
+    """Imports and warms everything the workers would otherwise load on their first request."""
+    inicio = time.perf_counter()
+    import main # noqa: F401 (already imported by preload_app; kept for a standalone call)
+    for nome in MODULOS_PRECARREGADOS:
+        try:
+            importlib.import_module(nome)
+        except ImportError as e:
+            logger.info(f"Preload skipped {nome}: {e}")
+    try:
+        import pynfe.utils as pynfe_utils
+        from pynfe.utils.flags import UF_CODIGO
+        carregar_municipios = getattr(pynfe_utils, "carregar_arquivo_municipios", None)
+        if carregar_municipios is not None:
+            for uf in UF_CODIGO:
+                carregar_municipios(uf)
+    except Exception as e:
+        logger.info(f"Preload of the UF/município tables skipped: {e}")
+    return time.perf_counter() - inicio
+
+
+# gunicorn server hooks
+
+def on_starting(server):
+    from jobs import job_manager
+    segundos = precarregar()
+    # No worker is running yet, so jobs left executando by the last shutdown can safely be requeued here;
+    # the SQLite connection is closed again so it is not inherited across fork.
+    job_manager.recover_interrupted()
+    job_manager.close()
+    server.log.info(f"Preloaded in {time.time() - INICIO:.2f}s ({segundos:.2f}s for PyNFe and tables)")
+
+
+def when_ready(server):
+    gc.collect()
+    gc.freeze() # Preloaded objects move to a permanent generation the children's GC never writes to
+    memoria = memoria_do_processo()
+    server.log.info(f"Master ready in {time.time() - INICIO:.2f}s, RSS {_mib(memoria.get('rss', 0))}")
+
+
+def post_fork(server, worker):
+    worker.fork_time = time.time()
+
+
+def post_worker_init(worker):
+    from jobs import job_manager
+    from metricas import metricas
+    job_manager.start()
+    metricas.inicializacao_worker.set(round(time.time() - INICIO, 3), worker=os.getpid())
+    metricas.iniciar_exportacao()
+    memoria = memoria_do_processo()
+    worker.log.info(f"Worker {os.getpid()} ready {time.time() - INICIO:.2f}s after server start "
+                    f"({time.time() - worker.fork_time:.3f}s after fork): RSS {_mib(memoria.get('rss', 0))}, "
+                    f"{_mib(memoria.get('compartilhada', 0))} shared, {_mib(memoria.get('privada', 0))} private")
+
+
+def worker_exit(server, worker):
+    from jobs import job_manager
+    from metricas import metricas
+    from sessoes import session_pool
+    from danfe import danfe_service
+    inicio = time.perf_counter()
+    drenado = job_manager.stop(timeout=GRACEFUL_TIMEOUT_SECONDS)
+    metricas.salvar()
+    session_pool.close_all()
+    danfe_service.encerrar()
+    server.log.info(f"Worker {os.getpid()} drained in {time.perf_counter() - inicio:.2f}s"
+                    + ("" if drenado else " (jobs still executing were interrupted)"))
+
+
+def on_exit(server):
+    for variavel in DIRETORIOS_DESTA_EXECUCAO:
+        if os.environ.get(variavel):
+            shutil.rmtree(os.environ[variavel], ignore_errors=True)
@@ -0,0 +1,139 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/sessoes.py
+# Pool of persistent HTTPS client-certificate sessions to the SEFAZ web services.
+#
+# Sessions are keyed by (UF code, ambiente, certificate fingerprint) and reused across requests,
+# so authorization, receipt and distribution calls ride on already-open keep-alive TLS connections
+# instead of doing a TCP connect and a full client-auth handshake every time. Idle sessions are
+# closed and evicted; hit/miss/eviction counters are exposed through stats(). Every call is capped
+# at the time left to the calling route (see prazos.py).
+import os
+import ssl
+import time
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import prazos
+
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_MAXSIZE = int(os.environ.get("SEFAZ_HTTP_POOL_MAXSIZE", 10)) # connections kept per host
+HTTP_IDLE_SECONDS = int(os.environ.get("SEFAZ_HTTP_IDLE_SECONDS", 300))
+# ICP-Brasil roots are not in the usual CA stores; point this at a bundle containing them (or a stub's CA)
+CA_BUNDLE = os.environ.get("SEFAZ_CA_BUNDLE")
+TLS_VERIFY = os.environ.get("SEFAZ_TLS_VERIFY", "1") != "0"
+
+
+class ClientCertAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools share one SSLContext with the client certificate loaded."""
+
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if isinstance(timeout, tuple): # (connect, read)
+            timeout = tuple(prazos.limitar(t) for t in timeout)
+        else:
+            timeout = prazos.limitar(timeout)
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def create_ssl_context(certificado):
+    context = ssl.create_default_context(cafile=CA_BUNDLE) if TLS_VERIFY else ssl._create_unverified_context()
+    context.load_cert_chain(certificado.cert_pem_path, certificado.key_pem_path)
+    return context
+
+
+class PooledSession:
+    def __init__(self, key, session):
+        self.key = key
+        self.session = session
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.uses = 0
+
+
+class SefazSessionPool:
+    def __init__(self, idle_seconds=HTTP_IDLE_SECONDS, pool_maxsize=HTTP_POOL_MAXSIZE):
+        self.idle_seconds = idle_seconds
+        self.pool_maxsize = pool_maxsize
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, certificado, uf_codigo, ambiente):
+        """Returns the pooled requests.Session for this UF, ambiente and certificate, creating it on a miss."""
+        key = (str(uf_codigo), str(ambiente), certificado.fingerprint_sha256)
+        with self._lock:
+            self._evict_idle_locked()
+            pooled = self._sessions.get(key)
+            if pooled is not None:
+                self.hits += 1
+                pooled.last_used = time.time()
+                pooled.uses += 1
+                return pooled.session
+            self.misses += 1
+
+        session = requests.Session()
+        adapter = ClientCertAdapter(create_ssl_context(certificado), pool_connections=4,
+                                    pool_maxsize=self.pool_maxsize, max_retries=0)
+        session.mount("https://", adapter)
+        session.verify = CA_BUNDLE or TLS_VERIFY
+        session.headers.update({"Content-Type": "application/soap+xml; charset=utf-8", "Connection": "keep-alive"})
+
+        with self._lock:
+            pooled = self._sessions.get(key)
+            if pooled is not None: # Another thread created it first
+                session.close()
+                pooled.uses += 1
+                return pooled.session
+            pooled = PooledSession(key, session)
+            pooled.uses = 1
+            self._sessions[key] = pooled
+        logger.info(f"New SEFAZ HTTPS session for UF {key[0]}, ambiente {key[1]}, certificate {key[2][:16]}...")
+        return session
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict_idle_locked()
+
+    def close_all(self):
+        with self._lock:
+            for pooled in self._sessions.values():
+                pooled.session.close()
+            self._sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle_seconds": self.idle_seconds,
+                "pool": [{"uf": p.key[0], "ambiente": p.key[1], "certificado": p.key[2][:16],
+                          "uses": p.uses, "idle_for": round(time.time() - p.last_used, 1)}
+                         for p in self._sessions.values()],
+            }
+
+    def _evict_idle_locked(self):
+        cutoff = time.time() - self.idle_seconds
+        for key in [k for k, p in self._sessions.items() if p.last_used < cutoff]:
+            self._sessions.pop(key).session.close()
+            self.evictions += 1
+
+
+session_pool = SefazSessionPool()
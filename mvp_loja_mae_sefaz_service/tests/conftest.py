@@ -0,0 +1,52 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/conftest.py
+# pytest setup for the SEFAZ service: the modules are flat, so the service directory (and benchmarks/,
+# for the SEFAZ stub) go on sys.path. Run from mvp_loja_mae_sefaz_service with: python -m pytest tests
+#
+# stub starts benchmarks/stub_sefaz.py for a test; sessao is an HTTPS session to it with the stub's
+# client certificate, mounted like the service's pooled sessions (sessoes.ClientCertAdapter).
+# main.py creates its stores (jobs, numeração, DANFE, distribuição) at import, so the tests point
+# SEFAZ_DATA_DIR at a temporary directory before anything imports it.
+import os
+import ssl
+import sys
+import tempfile
+
+import pytest
+import requests
+
+DIRETORIO_SERVICO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIRETORIO_SERVICO)
+sys.path.insert(0, os.path.join(DIRETORIO_SERVICO, "benchmarks"))
+os.environ.setdefault("SEFAZ_DATA_DIR", tempfile.mkdtemp(prefix="sefaz_testes_"))
+
+
+@pytest.fixture
+def stub(request):
+    from stub_sefaz import StubSefaz
+
+    marcador = request.node.get_closest_marker("stub")
+    stub = StubSefaz(atraso=0, **(marcador.kwargs if marcador else {})).iniciar()
+    yield stub
+    stub.parar()
+
+
+@pytest.fixture
+def sessao(stub):
+    from stub_sefaz import SENHA_PFX
+    from certificados import CertificateRegistry
+    from sessoes import ClientCertAdapter
+
+    registry = CertificateRegistry(shared_dir=None)
+    certificado = registry.register(stub.credenciais.pfx, SENHA_PFX)
+    contexto = ssl.create_default_context(cafile=stub.credenciais.ca_path)
+    contexto.load_cert_chain(certificado.cert_pem_path, certificado.key_pem_path)
+    sessao = requests.Session()
+    sessao.mount("https://", ClientCertAdapter(contexto, max_retries=0))
+    sessao.verify = stub.credenciais.ca_path
+    yield sessao
+    sessao.close()
+    registry.clear()
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "stub(**kwargs): StubSefaz options for the stub fixture")
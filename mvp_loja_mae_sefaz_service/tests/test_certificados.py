@@ -0,0 +1,62 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_certificados.py
+import os
+
+import pytest
+
+from certificados import CertificateRegistry, certificados_reservados
+from stub_sefaz import Credenciais, SENHA_PFX
+
+
+@pytest.fixture(scope="module")
+def pfx():
+    credenciais = Credenciais()
+    yield credenciais.pfx
+    credenciais.remover()
+
+
+@pytest.fixture
+def registry():
+    registry = CertificateRegistry(max_entries=1, shared_dir=None)
+    yield registry
+    registry.clear()
+
+
+def test_arquivos_reservados_sobrevivem_ao_descarte(registry, pfx):
+    with certificados_reservados():
+        entry = registry.register(pfx, SENHA_PFX)
+        assert registry.get(entry.handle) is entry
+        assert registry.remove(entry.handle)
+        assert registry.get(entry.handle) is None
+        assert os.path.exists(entry.key_pem_path) # Still reserved (twice) by this block
+    assert entry.reservas == 0
+    assert not os.path.exists(entry.directory)
+
+
+def test_reserva_por_bloco(registry, pfx):
+    entry = registry.register(pfx, SENHA_PFX) # Outside a block nothing is reserved
+    with certificados_reservados():
+        assert registry.get(entry.handle) is entry
+        with certificados_reservados():
+            registry.get(entry.handle)
+            assert entry.reservas == 2
+        assert entry.reservas == 1
+        registry.remove(entry.handle)
+        assert os.path.exists(entry.pfx_path)
+    assert not os.path.exists(entry.directory)
+
+    entry = registry.register(pfx, SENHA_PFX)
+    registry.remove(entry.handle)
+    assert not os.path.exists(entry.directory)
+
+
+def test_despejo_do_lru_espera_a_reserva(registry, pfx):
+    outra = Credenciais()
+    try:
+        with certificados_reservados():
+            entry = registry.register(pfx, SENHA_PFX)
+            registry.register(outra.pfx, SENHA_PFX) # max_entries=1: evicts entry
+            assert registry.stats()["entries"] == 1 and registry.get(entry.handle) is None
+            assert os.path.exists(entry.cert_pem_path)
+        assert not os.path.exists(entry.directory)
+    finally:
+        outra.remover()
@@ -0,0 +1,43 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_compilador.py
+from decimal import Decimal
+
+import pytest
+
+from compilador import ProdutosInvalidos, compilar_produtos
+
+
+def _produto(**campos):
+    return {"descricao": "Persiana", "ncm": "63039200", "cfop": "5102", "quantidade": 3, "valor_unitario": 10.1, **campos}
+
+
+def test_totais_exatos():
+    compilados = compilar_produtos([_produto(tributos={"icms": {"valor_bc": 30.3, "aliquota": 18}})] * 3)
+    assert [item["valor_total_bruto"] for item in compilados.itens()] == [Decimal("30.30")] * 3
+    assert compilados.totais["icms_valor"] == Decimal("16.35") # 3 x 5.454, each rounded to 5.45
+    assert compilados.totais["valor_nota"] == Decimal("90.90")
+
+
+def test_valor_nota_pela_formula_da_nfe():
+    compilados = compilar_produtos([
+        _produto(valor_frete=10, valor_desconto=5.3, tributos={"ipi": {"cst": "50", "valor_bc": 30.3, "aliquota": 5}}),
+        _produto(valor_seguro=1, valor_outras_despesas=0.5),
+    ])
+    totais = compilados.totais
+    assert (totais["valor_produtos"], totais["valor_frete"], totais["valor_seguro"], totais["valor_desconto"],
+            totais["valor_outras_despesas"], totais["ipi_valor"]) == tuple(
+        Decimal(v) for v in ("60.60", "10.00", "1.00", "5.30", "0.50", "1.52"))
+    assert totais["valor_nota"] == Decimal("68.32") # 60.60 - 5.30 + 10.00 + 1.00 + 0.50 + 1.52
+
+
+def test_todos_os_erros_de_uma_vez():
+    with pytest.raises(ProdutosInvalidos) as erro:
+        compilar_produtos([
+            _produto(ncm="123", valor_desconto=50),
+            _produto(tributos={"ipi": {"cst": "53", "valor": 2}}),
+            _produto(quantidade="abc"),
+        ])
+    assert [(e["item"], e["campo"]) for e in erro.value.erros] == [
+        (1, "ncm"), (2, "tributos.ipi.cst"), (3, "quantidade")]
+    with pytest.raises(ProdutosInvalidos) as erro:
+        compilar_produtos([_produto(valor_desconto=50)])
+    assert erro.value.erros[0]["campo"] == "valor_desconto"
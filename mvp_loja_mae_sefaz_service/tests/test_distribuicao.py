@@ -0,0 +1,119 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_distribuicao.py
+import json
+import time
+
+import pytest
+
+import distribuicao
+import main
+import prazos
+import sessoes
+from distribuicao import DistribuicaoSyncEngine, DistribuicaoBloqueada, NsuCursorStore
+from metricas import metricas
+from stub_sefaz import SENHA_PFX
+
+CNPJ = "00000000000191"
+
+
+@pytest.fixture
+def engine(tmp_path, stub, monkeypatch):
+    monkeypatch.setattr(distribuicao, "DISTRIBUICAO_URL_OVERRIDE", stub.url)
+    return DistribuicaoSyncEngine(NsuCursorStore(str(tmp_path / "distribuicao.sqlite3")))
+
+
+def _sincronizar(engine, sessao, **kwargs):
+    """Runs a sync to the end; returns (NSUs of the documents received, summary)."""
+    sync = engine.sincronizar(sessao, CNPJ, "35", "2", **kwargs)
+    nsus = []
+    while True:
+        try:
+            nsus.append(int(next(sync)["nsu"]))
+        except StopIteration as fim:
+            return nsus, fim.value
+
+
+@pytest.mark.stub(max_nsu=10)
+def test_retoma_do_cursor_salvo(engine, sessao, stub):
+    nsus, resumo = _sincronizar(engine, sessao, max_paginas=2)
+    assert nsus == [1, 2, 3, 4, 5, 6]
+    assert (resumo["paginas"], resumo["ult_nsu"], resumo["max_nsu"]) == (2, "000000000000006", "000000000000010")
+    assert resumo["bloqueado_ate"] == 0 # Not caught up yet: the next sync may run at once
+
+    nsus, resumo = _sincronizar(engine, sessao)
+    assert nsus == [7, 8, 9, 10]
+    assert stub.consultas_nsu == [0, 3, 6, 9]
+    assert resumo["ult_nsu_inicial"] == "000000000000006"
+    assert resumo["bloqueado_ate"] > time.time() # Caught up: SEFAZ asks for a one-hour pause
+
+    with pytest.raises(DistribuicaoBloqueada):
+        _sincronizar(engine, sessao)
+    assert len(stub.consultas_nsu) == 4
+
+
+@pytest.mark.stub(max_nsu=10, roteiro={"distribuicao": ["138", "656"]})
+def test_consumo_indevido_no_meio_da_sincronizacao(engine, sessao, stub):
+    resumo = {}
+    sync = engine.sincronizar(sessao, CNPJ, "35", "2", resumo=resumo)
+    recebidos = [int(next(sync)["nsu"]) for _ in range(3)]
+    with pytest.raises(DistribuicaoBloqueada) as erro:
+        next(sync)
+    assert recebidos == [1, 2, 3]
+    assert erro.value.retry_after > 3500
+    assert (resumo["documentos"], resumo["ult_nsu"]) == (3, "000000000000003")
+
+    cursor = engine.estado(CNPJ, "2")
+    assert (cursor["ult_nsu"], cursor["ultimo_cstat"]) == ("000000000000003", "656")
+    with pytest.raises(DistribuicaoBloqueada): # The block is respected without calling SEFAZ
+        _sincronizar(engine, sessao)
+    assert stub.consultas_nsu == [0, 3]
+
+    engine.store.save(CNPJ, "2", bloqueado_ate=0) # The hour is over
+    nsus, resumo = _sincronizar(engine, sessao)
+    assert nsus == [4, 5, 6, 7, 8, 9, 10]
+    assert stub.consultas_nsu == [0, 3, 3, 6, 9]
+    assert resumo["cStat"] == "138"
+
+
+@pytest.mark.stub(max_nsu=0)
+def test_nenhum_documento_bloqueia_por_uma_hora(engine, sessao):
+    nsus, resumo = _sincronizar(engine, sessao)
+    assert nsus == []
+    assert resumo["cStat"] == "137"
+    assert resumo["bloqueado_ate"] > time.time()
+
+
+@pytest.mark.stub(roteiro={"distribuicao": ["215"]})
+def test_rejeicao_nao_avanca_o_cursor(engine, sessao):
+    with pytest.raises(ValueError, match="cStat 215"):
+        _sincronizar(engine, sessao)
+    cursor = engine.estado(CNPJ, "2")
+    assert (cursor["ult_nsu"], cursor["bloqueado_ate"]) == ("000000000000000", 0)
+
+
+@pytest.mark.stub(max_nsu=10, atrasos={"distribuicao": 0.3})
+def test_stream_renova_o_prazo_a_cada_pagina(engine, stub, monkeypatch):
+    rota = "/api/nfe/distribuicao-dfe"
+    monkeypatch.setattr(sessoes, "CA_BUNDLE", stub.credenciais.ca_path)
+    monkeypatch.setattr(main, "sync_engine", engine)
+    monkeypatch.setitem(prazos.ROUTE_TIMEOUTS, rota, 0.5) # Less than two pages: only a per-page budget lets it finish
+    respostas_antes = metricas.cstat._valores.copy()
+
+    resposta = main.app.test_client().post(rota, json={
+        "certificate_base64": stub.credenciais.pfx_base64, "certificate_password": SENHA_PFX,
+        "uf_sigla": "SP", "cnpj_interessado": CNPJ, "ambiente": "2", "stream": True})
+    try:
+        linhas = [json.loads(linha) for linha in resposta.get_data(as_text=True).splitlines()]
+    finally:
+        main.session_pool.close_all()
+
+    assert resposta.mimetype == "application/x-ndjson"
+    assert [int(linha["nsu"]) for linha in linhas[:-1]] == list(range(1, 11))
+    assert "error" not in linhas[-1]
+    resumo = linhas[-1]["resumo"]
+    assert (resumo["paginas"], resumo["sincronizacao_completa"]) == (4, True)
+
+    # The medição is finished by the stream, labelled with the last cStat
+    assert metricas.requisicoes_em_andamento._valores[(rota,)] == 0
+    novas = {chave: total - respostas_antes.get(chave, 0) for chave, total in metricas.cstat._valores.items()}
+    assert [chave for chave, total in novas.items() if total] == [
+        metricas.cstat._chave({"route": rota, "uf": "SP", "ambiente": "2", "cstat": resumo["status_sefaz"]})]
@@ -0,0 +1,100 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_emissao.py
+import pytest
+from lxml import etree
+
+import main
+import sessoes
+import transmissao
+from geradores import gerar_payload_lote, gerar_payload_nfe
+from numeracao import NumeradorNFe, NumeracaoStore
+from stub_sefaz import SENHA_PFX
+from transmissao import NS
+
+
+@pytest.fixture
+def certificado(stub):
+    return {"certificate_base64": stub.credenciais.pfx_base64, "certificate_password": SENHA_PFX}
+
+
+@pytest.fixture(autouse=True)
+def servico(stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(sessoes, "CA_BUNDLE", stub.credenciais.ca_path)
+    monkeypatch.setattr(transmissao, "URL_OVERRIDE", stub.url_base)
+    monkeypatch.setattr(transmissao, "RECIBO_ESPERA_MAXIMA_SECONDS", 0)
+    monkeypatch.setattr(main, "numerador", NumeradorNFe(NumeracaoStore(str(tmp_path / "numeracao.sqlite3"))))
+    monkeypatch.setattr(main, "DANFE_PREFETCH", False)
+    yield
+    main.session_pool.close_all()
+
+
+def test_emite_nfe_pela_sessao(stub, certificado):
+    body, status = main.emitir_nfe(gerar_payload_nfe(3, certificado=certificado))
+    assert status == 200, body
+    assert (body["status_sefaz"], body["codigo_status_sefaz"], body["numero_nf_emitido"]) == ("autorizada", "100", "1")
+    assert len(body["chave_acesso"]) == 44
+    assert body["xml_autorizado"].count("<protNFe") == 1 and "<Signature" in body["xml_autorizado"]
+
+    body, status = main.emitir_nfe(gerar_payload_nfe(2, seed=7, certificado=certificado))
+    assert (status, body["numero_nf_emitido"]) == (200, "2")
+    assert stub.requisicoes_por_operacao["autorizacao"] == 2
+    assert stub.conexoes == 1 # The second nota reuses the pooled connection
+
+
+@pytest.mark.stub(cstats={"autorizacao": "225"})
+def test_nota_rejeitada_volta_422(certificado):
+    body, status = main.emitir_nfe(gerar_payload_nfe(1, certificado=certificado))
+    assert status == 422
+    assert (body["status_sefaz"], body["codigo_status_sefaz"]) == ("rejeitada_ou_erro", "225")
+    assert "xml_autorizado" not in body
+
+
+def test_lote_consulta_o_recibo(stub, certificado):
+    body, status = main.emitir_lote_nfe(gerar_payload_lote(3, 2, certificado=certificado))
+    assert status == 200, body
+    assert body["quantidade_autorizadas"] == 3
+    assert [r["numero_nf_emitido"] for r in body["resultados"]] == ["1", "2", "3"]
+    assert len({r["chave_acesso"] for r in body["resultados"]}) == 3
+    assert body["lotes"][0]["codigo_status_sefaz"] == "104" and body["lotes"][0]["recibo"]
+    assert (stub.requisicoes_por_operacao["autorizacao"], stub.requisicoes_por_operacao["retorno"]) == (1, 1)
+
+
+def test_uf_sigla_nula_usa_sp(certificado):
+    payload = gerar_payload_lote(2, 1, certificado=certificado)
+    payload["emitente"] = {**payload["emitente"], "uf_sigla": None}
+    body, status = main.emitir_lote_nfe(payload)
+    assert (status, body["quantidade_autorizadas"]) == (200, 2)
+    assert all(r["chave_acesso"].startswith("35") for r in body["resultados"])
+
+
+def test_vnf_inclui_frete_desconto_e_ipi(certificado):
+    payload = gerar_payload_nfe(1, certificado=certificado)
+    payload["produtos"] = [{"descricao": "Cortina", "ncm": "63039200", "cfop": "5102", "quantidade": 2,
+                            "valor_unitario": 150, "valor_frete": 20, "valor_seguro": 5, "valor_desconto": 30,
+                            "valor_outras_despesas": 2.5,
+                            "tributos": {"ipi": {"cst": "50", "valor_bc": 300, "aliquota": 10}}}]
+    body, status = main.emitir_nfe(payload)
+    assert status == 200, body
+    total = etree.fromstring(body["xml_autorizado"].encode()).find(f".//{NS}ICMSTot")
+    assert {campo: total.findtext(f"{NS}{campo}") for campo in ("vProd", "vFrete", "vSeg", "vDesc", "vOutro", "vIPI", "vNF")} == {
+        "vProd": "300.00", "vFrete": "20.00", "vSeg": "5.00", "vDesc": "30.00", "vOutro": "2.50", "vIPI": "30.00",
+        "vNF": "327.50"}
+    assert etree.fromstring(body["xml_autorizado"].encode()).findtext(f".//{NS}pag/{NS}detPag/{NS}vPag") == "327.50"
+
+
+@pytest.mark.parametrize("campo, valor", [("current_nfe_series", "A1"), ("current_nfe_series", "1000"),
+                                          ("last_used_nfe_number", "12a"), ("last_used_nfe_number", -1)])
+def test_numeracao_invalida_volta_400(stub, certificado, campo, valor):
+    body, status = main.emitir_nfe({**gerar_payload_nfe(1, certificado=certificado), campo: valor})
+    assert status == 400 and campo in body["error"]
+    body, status = main.emitir_lote_nfe({**gerar_payload_lote(2, 1, certificado=certificado), campo: valor})
+    assert status == 400 and campo in body["error"]
+    assert stub.requisicoes_por_operacao["autorizacao"] == 0
+
+
+@pytest.mark.stub(cstats={"autorizacao": "539"})
+def test_duplicidade_sem_chave_fica_para_conciliacao(certificado):
+    payload = gerar_payload_nfe(1, certificado=certificado)
+    body, status = main.emitir_nfe(payload)
+    assert (status, body["codigo_status_sefaz"]) == (422, "539")
+    estado = main.numerador.estado(payload["emitente"]["cnpj"], "55", payload["current_nfe_series"])
+    assert estado["a_conciliar"] == [[1, 1]]
@@ -0,0 +1,89 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_extrator.py
+import io
+import os
+
+import pytest
+
+import distribuicao
+from distribuicao import DistribuicaoSyncEngine, NsuCursorStore
+from extrator import extrair_documento, iterar_documentos, fontes_de_caminhos, fontes_de_distribuicao
+
+AMOSTRAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "amostras")
+CHAVE = "35240112345678000195550010000012341000012345"
+
+
+def _amostra(nome):
+    return os.path.join(AMOSTRAS, nome)
+
+
+def test_proc_nfe():
+    documento = extrair_documento(_amostra("procNFe.xml"))
+    assert {campo: documento[campo] for campo in ("tipo", "chaveAcesso", "numero", "serie", "modelo", "dataEmissao",
+                                                  "valorTotal", "protocolo")} == {
+        "tipo": "procNFe", "chaveAcesso": CHAVE, "numero": "1234", "serie": "1", "modelo": "55",
+        "dataEmissao": "2024-01-15T10:00:00-03:00", "valorTotal": "1500.00", "protocolo": "135240000000001"}
+    # Only direct children of emit: the address (enderEmit) does not leak into the emitente
+    assert documento["emitente"] == {"cnpj": "12345678000195", "nome": "Fornecedor Exemplo Ltda", "ie": "111111111111"}
+    assert documento["destinatario"] == {"cnpj": "98765432000198", "nome": "Loja Mae Ltda"}
+    assert documento["produtos"] == [
+        {"codigo": "P001", "descricao": "Cadeira de jantar", "ncm": "94016100", "cfop": "5102", "unidade": "UN",
+         "quantidade": 4.0, "valorUnitario": "250.0000000000", "valorTotal": "1000.00", "ean": "7891234567895", "item": "1"},
+        {"codigo": "P002", "descricao": "Mesa redonda", "ncm": "94036000", "cfop": "5102", "unidade": "UN",
+         "quantidade": 1.0, "valorUnitario": "500.0000000000", "valorTotal": "500.00", "ean": "SEM GTIN", "item": "2"},
+    ]
+    assert documento["faturas"] == [{"numero": "001", "vencimento": "2024-02-15", "valor": "750.00"},
+                                    {"numero": "002", "vencimento": "2024-03-15", "valor": "750.00"}]
+    assert documento["totais"] == {"vBC": "1500.00", "vICMS": "270.00", "vProd": "1500.00", "vDesc": "0.00", "vNF": "1500.00"}
+    assert documento["autorizacao"] == {"cStat": "100", "xMotivo": "Autorizado o uso da NF-e",
+                                        "dataAutorizacao": "2024-01-15T10:00:05-03:00"}
+
+
+def test_res_nfe():
+    assert extrair_documento(_amostra("resNFe.xml")) == {
+        "tipo": "resNFe", "chaveAcesso": CHAVE, "dataEmissao": "2024-01-15T10:00:00-03:00", "valorTotal": "1500.00",
+        "situacao": "1", "protocolo": "135240000000001", "tipoOperacao": "1", "dataAutorizacao": "2024-01-15T10:00:05-03:00",
+        "emitente": {"cnpj": "12345678000195", "nome": "Fornecedor Exemplo Ltda", "ie": "111111111111"}}
+
+
+def test_proc_evento_nfe():
+    documento = extrair_documento(_amostra("procEventoNFe.xml"))
+    assert documento == {
+        "tipo": "procEventoNFe", "chaveAcesso": CHAVE, "tpEvento": "110111", "descricao": "Cancelamento",
+        "sequencia": "1", "dataEvento": "2024-01-16T09:00:00-03:00", "protocolo": "135240000000002",
+        "dataRegistro": "2024-01-16T09:00:02-03:00", "cStat": "135", "xMotivo": "Evento registrado e vinculado a NF-e",
+        "justificativa": "Pedido cancelado pelo cliente", "autor": {"cnpj": "12345678000195"}}
+
+
+def test_documento_invalido_vira_erro_sem_interromper(tmp_path):
+    (tmp_path / "a.xml").write_bytes(open(_amostra("resNFe.xml"), "rb").read())
+    (tmp_path / "b.xml").write_text("<resNFe><chNFe>", encoding="utf-8")
+    (tmp_path / "c.xml").write_text("<outro/>", encoding="utf-8")
+    documentos = list(iterar_documentos(fontes_de_caminhos([str(tmp_path)])))
+    assert documentos[0]["chaveAcesso"] == CHAVE
+    assert documentos[1]["error"].startswith("XML inválido")
+    assert documentos[2]["error"] == "Documento não suportado: <outro>"
+
+
+@pytest.mark.parametrize("xml", [
+    b'<?xml version="1.0"?><!DOCTYPE r [<!ENTITY a "aa"><!ENTITY b "&a;&a;&a;">]><resNFe><chNFe>&b;</chNFe></resNFe>',
+    b'<?xml version="1.0"?><!DOCTYPE r [<!ENTITY x SYSTEM "file:///etc/passwd">]><resNFe><chNFe>&x;</chNFe></resNFe>',
+    b'<?xml version="1.0"?><!DOCTYPE resNFe SYSTEM "http://exemplo.invalid/nfe.dtd"><resNFe/>',
+])
+def test_doctype_e_entidades_sao_recusados(xml):
+    with pytest.raises(ValueError, match="XML inválido: DOCTYPE"):
+        extrair_documento(xml)
+    with pytest.raises(ValueError, match="DOCTYPE"):
+        list(distribuicao.iterar_resposta(io.BytesIO(xml)))
+
+
+@pytest.mark.stub(max_nsu=5)
+def test_documentos_da_distribuicao(tmp_path, stub, sessao, monkeypatch):
+    monkeypatch.setattr(distribuicao, "DISTRIBUICAO_URL_OVERRIDE", stub.url)
+    engine = DistribuicaoSyncEngine(NsuCursorStore(str(tmp_path / "distribuicao.sqlite3")))
+    recebidos = list(engine.sincronizar(sessao, "00000000000191", "35", "2"))
+    documentos = list(iterar_documentos(fontes_de_distribuicao(recebidos)))
+    assert [documento["referencia"] for documento in documentos] == [f"{nsu:015d}" for nsu in range(1, 6)]
+    assert {documento["tipo"] for documento in documentos} == {"resNFe"}
+    assert documentos[0]["chaveAcesso"] == "35240112345678000195550010000000000000000001"
+    assert documentos[0]["emitente"] == {"cnpj": "12345678000195", "nome": "Fornecedor Stub"}
+    assert (documentos[0]["valorTotal"], documentos[0]["situacao"]) == ("100.00", "1")
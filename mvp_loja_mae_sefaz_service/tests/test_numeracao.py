@@ -0,0 +1,144 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_numeracao.py
+import sqlite3
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from numeracao import NumeracaoStore, NumeradorNFe, STATUS_UTILIZADO, STATUS_LIVRE
+
+SERIE = ("00000000000191", "55", "1")
+
+
+def _numerador(path, **kwargs):
+    return NumeradorNFe(NumeracaoStore(str(path)), **kwargs)
+
+
+def _emitir(path, reservas, rejeitar_a_cada):
+    """One allocator (its own connection, like a separate process): reserves numbers and settles each one."""
+    numerador = _numerador(path)
+    for n in range(reservas):
+        quantidade = 3 if n % 5 == 0 else 1 # Batches and single notas mixed
+        for numero in numerador.reservar(*SERIE, quantidade=quantidade):
+            cstat = "225" if (numero + n) % rejeitar_a_cada == 0 else "100" # 225: rejeição, the number is reused
+            numerador.registrar_retorno(*SERIE, numero, cstat)
+
+
+def _numeros_por_status(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        por_status = {}
+        for status, numero in conn.execute("SELECT status, numero FROM numeracao_numero"):
+            por_status.setdefault(status, []).append(numero)
+        ultimo = conn.execute("SELECT ultimo_numero FROM numeracao_serie").fetchone()[0]
+    finally:
+        conn.close()
+    return por_status, ultimo
+
+
+def _conferir_sem_lacunas(path):
+    por_status, ultimo = _numeros_por_status(path)
+    utilizados = por_status.get(STATUS_UTILIZADO, [])
+    assert len(utilizados) == len(set(utilizados)), "número autorizado duas vezes"
+    assert sorted(utilizados + por_status.get(STATUS_LIVRE, [])) == list(range(1, ultimo + 1)), "lacuna na série"
+    assert set(por_status) <= {STATUS_UTILIZADO, STATUS_LIVRE}, f"números pendentes: {por_status.keys()}"
+    return utilizados
+
+
+def test_threads_sem_duplicidade_nem_lacunas(tmp_path):
+    path = tmp_path / "numeracao.sqlite3"
+    threads = [threading.Thread(target=_emitir, args=(path, 40, 7)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(_conferir_sem_lacunas(path)) > 8 * 40 * 0.8
+
+
+def test_processos_sem_duplicidade_nem_lacunas(tmp_path):
+    path = tmp_path / "numeracao.sqlite3"
+    _numerador(path) # Creates the schema before the processes race for it
+    with ProcessPoolExecutor(max_workers=3, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for futuro in [executor.submit(_emitir, str(path), 30, 5) for _ in range(3)]:
+            futuro.result()
+    _conferir_sem_lacunas(path)
+
+
+def test_numero_rejeitado_e_reutilizado(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3")
+    assert numerador.reservar(*SERIE) == [1]
+    numerador.registrar_retorno(*SERIE, 1, "225", motivo="Falha no Schema XML")
+    assert numerador.estado(*SERIE)["livres"] == [[1, 1]]
+
+    assert numerador.reservar(*SERIE) == [1]
+    numerador.registrar_retorno(*SERIE, 1, "100", chave_acesso="3" * 44)
+    assert numerador.reservar(*SERIE) == [2]
+
+
+def test_lote_usa_livres_antes_de_novos(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3")
+    numeros = numerador.reservar(*SERIE, quantidade=4)
+    assert numeros == [1, 2, 3, 4]
+    numerador.devolver(*SERIE, 2, motivo="erro de mapeamento")
+    numerador.registrar_retorno(*SERIE, 4, "225")
+    assert numerador.reservar(*SERIE, quantidade=3) == [2, 4, 5]
+
+
+def test_rejeitada_sem_reuso_vai_para_inutilizacao(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3", reusar_rejeitadas=False)
+    numerador.reservar(*SERIE)
+    numerador.registrar_retorno(*SERIE, 1, "225")
+    assert numerador.reservar(*SERIE) == [2]
+    assert numerador.estado(*SERIE)["a_inutilizar"] == [[1, 1]]
+    assert numerador.marcar_inutilizados(*SERIE, 1, 1, protocolo="135240000000001") == 1
+
+
+def test_denegada_e_resultado_incerto_nao_reutilizam(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3")
+    numerador.reservar(*SERIE, quantidade=2)
+    numerador.registrar_retorno(*SERIE, 1, "302")
+    numerador.marcar_para_inutilizacao(*SERIE, 2, motivo="timeout")
+    assert numerador.reservar(*SERIE) == [3]
+
+
+def test_duplicidade_539_guarda_a_chave_da_sefaz(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3")
+    enviada, existente = "3" * 44, "35240112345678000195550010000000011000000010"
+    numerador.reservar(*SERIE, quantidade=2)
+    numerador.registrar_retorno(*SERIE, 1, "539", chave_acesso=enviada,
+                                motivo=f"Rejeição: Duplicidade de NF-e com diferença na Chave de Acesso [chNFe: {existente}][nRec:351000000000001]")
+    numerador.registrar_retorno(*SERIE, 2, "539", chave_acesso=enviada,
+                                motivo="Rejeição: Duplicidade de NF-e com diferença na Chave de Acesso")
+    assert numerador.estado(*SERIE)["a_conciliar"] == [[2, 2]]
+    assert numerador.reservar(*SERIE) == [3] # Neither number is reused
+
+    chaves = dict(sqlite3.connect(str(tmp_path / "numeracao.sqlite3")).execute(
+        "SELECT numero, chave_acesso FROM numeracao_numero WHERE numero IN (1, 2)").fetchall())
+    assert chaves == {1: existente, 2: None}
+
+    numerador.confirmar(*SERIE, 2, chave_acesso=existente, motivo="conciliado") # Once the chave is found
+    assert numerador.estado(*SERIE)["a_conciliar"] == []
+
+
+def test_ultimo_numero_conhecido_so_avanca(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3")
+    assert numerador.reservar(*SERIE, ultimo_numero_conhecido=41) == [42]
+    assert numerador.reservar(*SERIE, ultimo_numero_conhecido=10) == [43]
+
+
+def test_reserva_expirada_vai_para_inutilizacao(tmp_path):
+    numerador = _numerador(tmp_path / "numeracao.sqlite3", reserva_ttl=-1)
+    numerador.reservar(*SERIE)
+    assert numerador.reservar(*SERIE) == [2]
+    assert numerador.estado(*SERIE)["a_inutilizar"] == [[1, 2]]
+
+
+def test_erro_apos_rollback_do_sqlite_nao_e_mascarado(tmp_path):
+    store = NumeracaoStore(str(tmp_path / "numeracao.sqlite3"))
+    with pytest.raises(ValueError, match="erro original"):
+        with store.transaction() as conn:
+            conn.execute("ROLLBACK") # As SQLite does by itself on SQLITE_IOERR/SQLITE_FULL
+            raise ValueError("erro original")
+    with store.transaction() as conn: # Lock released, connection usable
+        conn.execute("SELECT 1")
@@ -0,0 +1,80 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/tests/test_sessoes.py
+import pytest
+
+import sessoes
+import transmissao
+from certificados import CertificateRegistry
+from sessoes import SefazSessionPool
+from stub_sefaz import SENHA_PFX
+from transmissao import ComunicacaoSessao
+
+
+@pytest.fixture
+def certificado(stub):
+    registry = CertificateRegistry(shared_dir=None)
+    yield registry.register(stub.credenciais.pfx, SENHA_PFX)
+    registry.clear()
+
+
+@pytest.fixture
+def pool(stub, monkeypatch):
+    monkeypatch.setattr(sessoes, "CA_BUNDLE", stub.credenciais.ca_path)
+    monkeypatch.setattr(transmissao, "URL_OVERRIDE", stub.url_base)
+    pool = SefazSessionPool(idle_seconds=60)
+    yield pool
+    pool.close_all()
+
+
+def _status_servico(pool, certificado, uf_sigla="SP", uf_codigo="35", ambiente="2"):
+    comunicacao = ComunicacaoSessao(uf_sigla, certificado, ambiente, pool.get(certificado, uf_codigo, ambiente))
+    resposta = comunicacao.status_servico("nfe")
+    assert resposta.status_code == 200 and "<cStat>107</cStat>" in resposta.text
+    return resposta
+
+
+def test_reutiliza_sessao_e_conexao(pool, certificado, stub):
+    for _ in range(4):
+        _status_servico(pool, certificado)
+    assert (pool.hits, pool.misses, pool.evictions) == (3, 1, 0)
+    assert stub.requisicoes_por_operacao["status"] == 4
+    assert stub.conexoes == 1 # Keep-alive: one TLS client-auth handshake for every call
+    assert pool.stats()["pool"][0]["uses"] == 4
+
+
+def test_sessao_por_uf_e_ambiente(pool, certificado, stub):
+    _status_servico(pool, certificado)
+    _status_servico(pool, certificado, "RJ", "33")
+    producao = pool.get(certificado, "35", "1")
+    _status_servico(pool, certificado)
+    assert producao is not pool.get(certificado, "35", "2")
+    assert (pool.hits, pool.misses) == (2, 3)
+    assert pool.stats()["sessions"] == 3
+    assert stub.conexoes == 2
+
+
+def test_url_override_so_em_homologacao(pool, certificado, monkeypatch):
+    comunicacao = ComunicacaoSessao("SP", certificado, "2", pool.get(certificado, "35", "2"))
+    assert comunicacao._get_url("nfe", "AUTORIZACAO").startswith(transmissao.URL_OVERRIDE + "/")
+    with pytest.raises(ValueError, match="homologação"):
+        ComunicacaoSessao("SP", certificado, "1", pool.get(certificado, "35", "1"))
+
+    monkeypatch.setattr(transmissao, "URL_OVERRIDE", None)
+    producao = ComunicacaoSessao("SP", certificado, "1", pool.get(certificado, "35", "1"))
+    assert producao._get_url("nfe", "AUTORIZACAO").startswith("https://nfe.fazenda.sp.gov.br/")
+
+
+def test_sessao_ociosa_e_descartada(pool, certificado, stub):
+    _status_servico(pool, certificado)
+    pool.evict_idle()
+    assert pool.stats()["sessions"] == 1 # Still within idle_seconds
+
+    for pooled in pool._sessions.values():
+        pooled.last_used -= pool.idle_seconds + 1
+    _status_servico(pool, certificado) # Evicted on the way in, so a miss with a new connection
+    assert (pool.hits, pool.misses, pool.evictions) == (0, 2, 1)
+    assert stub.conexoes == 2
+
+    for pooled in pool._sessions.values():
+        pooled.last_used -= pool.idle_seconds + 1
+    pool.evict_idle()
+    assert (pool.stats()["sessions"], pool.evictions) == (0, 2)
@@ -0,0 +1,197 @@
+# /home/ubuntu/mvp_loja_mae_sefaz_service/transmissao.py
+# NF-e serialization, signing and transmission on top of PyNFe.
+#
+# PyNFe's ComunicacaoSefaz opens a new connection for every call: each requests.post splits the PFX
+# into temporary PEM files, connects and does a full client-auth TLS handshake. ComunicacaoSessao
+# keeps PyNFe's web service URLs and SOAP envelopes but posts through the pooled keep-alive session
+# of the certificate (sessoes.py), and sends enviNFe lotes of up to 50 NF-e, where PyNFe's autorizacao
+# takes a single one. Notas are serialized with SerializacaoXML and signed with the key the
+# certificate registry already decrypted, so the PFX is not read again for every nota.
+import os
+import time
+import logging
+from functools import lru_cache
+from urllib.parse import urlsplit, urlunsplit
+
+from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat
+from pynfe.processamento.assinatura import AssinaturaA1
+from pynfe.processamento.comunicacao import ComunicacaoSefaz
+from pynfe.processamento.serializacao import SerializacaoXML
+from pynfe.utils import etree
+from pynfe.utils.flags import NAMESPACE_NFE, VERSAO_PADRAO
+
+import prazos
+from certificados import CERT_CACHE_MAX_ENTRIES
+
+logger = logging.getLogger(__name__)
+
+AUTORIZACAO_TIMEOUT_SECONDS = float(os.environ.get("SEFAZ_AUTORIZACAO_TIMEOUT", 60))
+# A lote sent asynchronously is queried again every tMed seconds (as SEFAZ reports it), capped at this
+RECIBO_ESPERA_MAXIMA_SECONDS = float(os.environ.get("SEFAZ_RECIBO_ESPERA_MAXIMA", 5))
+RECIBO_MAX_CONSULTAS = int(os.environ.get("SEFAZ_RECIBO_MAX_CONSULTAS", 20))
+# Sends the web service calls to this scheme://host:port instead, keeping PyNFe's path (e.g. benchmarks/stub_sefaz.py).
+# Homologação only: a produção client refuses to start with it set
+URL_OVERRIDE = os.environ.get("SEFAZ_URL_OVERRIDE")
+
+MODELOS = {"55": "nfe", "65": "nfce"}
+CSTATS_AUTORIZADA = ("100", "150")
+CSTAT_LOTE_RECEBIDO = "103"
+CSTAT_LOTE_EM_PROCESSAMENTO = "105"
+
+NS = f"{{{NAMESPACE_NFE}}}"
+# SEFAZ answers are parsed without entity expansion or network access
+_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+class ErroSefaz(Exception):
+    """Raised when SEFAZ answers with an HTTP error or without the expected return message."""
+
+
+class ComunicacaoSessao(ComunicacaoSefaz):
+    """ComunicacaoSefaz posting through a pooled requests.Session instead of a one-off requests.post."""
+
+    def __init__(self, uf_sigla, certificado, ambiente, sessao):
+        if URL_OVERRIDE and str(ambiente) != "2":
+            raise ValueError("SEFAZ_URL_OVERRIDE só é aceito em homologação (ambiente 2)")
+        super().__init__(uf_sigla, certificado.pfx_path, certificado.senha, homologacao=str(ambiente) == "2")
+        self.sessao = sessao
+
+    def _get_url(self, modelo, consulta, contingencia=False):
+        return _redirecionar(super()._get_url(modelo, consulta, contingencia))
+
+    def _get_url_an(self, consulta):
+        return _redirecionar(super()._get_url_an(consulta))
+
+    def _post(self, url, xml, timeout=None):
+        corpo = '<?xml version="1.0" encoding="UTF-8"?>' + etree.tostring(xml, encoding="unicode").replace("\n", "")
+        resposta = self.sessao.post(url, data=corpo.encode("utf-8"), headers=self._post_header(),
+                                    timeout=timeout or AUTORIZACAO_TIMEOUT_SECONDS)
+        resposta.encoding = "utf-8"
+        return resposta
+
+    def enviar_lote(self, modelo, nfes_assinadas, id_lote, sincrono):
+        """Posts one enviNFe with the signed NFe elements. Returns the parsed retEnviNFe (see ler_retorno)."""
+        raiz = etree.Element("enviNFe", xmlns=NAMESPACE_NFE, versao=VERSAO_PADRAO)
+        etree.SubElement(raiz, "idLote").text = str(id_lote)
+        etree.SubElement(raiz, "indSinc").text = "1" if sincrono else "0"
+        raiz.extend(nfes_assinadas)
+        url = self._get_url(modelo=MODELOS[str(modelo)], consulta="AUTORIZACAO")
+        return ler_retorno(self._post(url, self._construir_xml_soap("NFeAutorizacao4", raiz)), "retEnviNFe")
+
+    def consultar_recibo(self, modelo, recibo):
+        """Posts one consReciNFe. Returns the parsed retConsReciNFe (see ler_retorno)."""
+        return ler_retorno(self.consulta_recibo(MODELOS[str(modelo)], recibo), "retConsReciNFe")
+
+
+def _redirecionar(url):
+    """The web service URL, moved to the URL_OVERRIDE host when one is set."""
+    if not URL_OVERRIDE:
+        return url
+    destino = urlsplit(URL_OVERRIDE)
+    return urlunsplit(urlsplit(url)._replace(scheme=destino.scheme, netloc=destino.netloc))
+
+
+class AssinaturaCertificado(AssinaturaA1):
+    """AssinaturaA1 with the key and certificate a CertificadoRegistrado already holds, instead of reading the PFX."""
+
+    def __init__(self, certificado):
+        self.key = certificado.private_key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+        self.cert = certificado.certificate.public_bytes(Encoding.PEM).decode("utf-8")
+
+
+@lru_cache(maxsize=CERT_CACHE_MAX_ENTRIES)
+def assinatura_de(certificado):
+    return AssinaturaCertificado(certificado)
+
+
+def serializar_nota(nf, ambiente):
+    """The unsigned NFe element of one NotaFiscal (what SerializacaoXML.exportar builds, for this nota only)."""
+    raiz = etree.Element("NFe", xmlns=NAMESPACE_NFE)
+    serializador = SerializacaoXML(nf._fonte_dados, homologacao=str(ambiente) == "2")
+    raiz.append(serializador._serializar_nota_fiscal(nf, retorna_string=False))
+    return raiz
+
+
+def assinar_nota(nf, certificado, ambiente):
+    """Serializes and signs one NotaFiscal. Returns the signed NFe element."""
+    return assinatura_de(certificado).assinar(serializar_nota(nf, ambiente))
+
+
+def chave_de(nfe):
+    """The 44-digit chave de acesso from the Id of a signed NFe element's infNFe."""
+    inf_nfe = nfe.find(f"{NS}infNFe")
+    return (inf_nfe.get("Id") or "")[3:] if inf_nfe is not None else None
+
+
+def ler_retorno(resposta, tag):
+    """
+    Parses a SEFAZ answer down to its tag element (retEnviNFe, retConsReciNFe).
+    Returns {"cStat", "xMotivo", "nRec", "tMed", "protNFe": {chave: protNFe element}}.
+    """
+    if resposta.status_code != 200:
+        raise ErroSefaz(f"SEFAZ respondeu HTTP {resposta.status_code}: {resposta.text[:200]}")
+    try:
+        retorno = etree.fromstring(resposta.content, _PARSER).find(f".//{NS}{tag}")
+    except etree.XMLSyntaxError as e:
+        raise ErroSefaz(f"Resposta da SEFAZ não é XML válido: {e}") from e
+    if retorno is None:
+        raise ErroSefaz(f"Resposta da SEFAZ sem {tag}")
+    return {
+        "cStat": retorno.findtext(f"{NS}cStat"),
+        "xMotivo": retorno.findtext(f"{NS}xMotivo"),
+        "nRec": retorno.findtext(f"{NS}infRec/{NS}nRec") or retorno.findtext(f"{NS}nRec"),
+        "tMed": retorno.findtext(f"{NS}infRec/{NS}tMed"),
+        "protNFe": {prot.findtext(f"{NS}infProt/{NS}chNFe"): prot for prot in retorno.iter(f"{NS}protNFe")},
+    }
+
+
+def _campos(elemento):
+    return {etree.QName(campo).localname: campo.text for campo in elemento if isinstance(campo.tag, str)}
+
+
+def nfe_proc(nfe, prot_nfe):
+    """The nfeProc (signed NFe plus its protNFe) of an authorized nota, as UTF-8 bytes."""
+    # A namespaced root (not PyNFe's xmlns attribute), so the protNFe parsed from SEFAZ keeps the default namespace
+    raiz = etree.Element(f"{NS}nfeProc", nsmap={None: NAMESPACE_NFE}, versao=VERSAO_PADRAO)
+    raiz.append(nfe)
+    raiz.append(prot_nfe)
+    return etree.tostring(raiz, encoding="UTF-8", xml_declaration=True)
+
+
+def aguardar_recibo(comunicacao, modelo, retorno_envio):
+    """Queries the recibo of a lote sent asynchronously until SEFAZ has processed it. Returns the retConsReciNFe."""
+    recibo = retorno_envio["nRec"]
+    try:
+        espera = min(float(retorno_envio.get("tMed") or 1), RECIBO_ESPERA_MAXIMA_SECONDS)
+    except ValueError:
+        espera = RECIBO_ESPERA_MAXIMA_SECONDS
+    for _ in range(RECIBO_MAX_CONSULTAS):
+        time.sleep(prazos.limitar(espera))
+        retorno = comunicacao.consultar_recibo(modelo, recibo)
+        if retorno["cStat"] != CSTAT_LOTE_EM_PROCESSAMENTO:
+            retorno["nRec"] = recibo
+            return retorno
+    raise ErroSefaz(f"Lote do recibo {recibo} ainda em processamento após {RECIBO_MAX_CONSULTAS} consultas")
+
+
+def autorizar(comunicacao, modelo, nfes_assinadas, id_lote):
+    """
+    Sends signed NFe elements as one lote and waits for their protocols: at once for a single NF-e, through
+    the recibo otherwise (SEFAZ only answers lotes of one NF-e synchronously).
+    Returns (retorno_lote, protocolos_por_chave, xmls_autorizados_por_chave): protocolos are the infProt
+    fields of each nota SEFAZ answered for, xmls_autorizados the nfeProc bytes of the authorized ones.
+    """
+    nfes_por_chave = {chave_de(nfe): nfe for nfe in nfes_assinadas}
+    retorno = comunicacao.enviar_lote(modelo, nfes_assinadas, id_lote, sincrono=len(nfes_assinadas) == 1)
+    if retorno["cStat"] == CSTAT_LOTE_RECEBIDO:
+        logger.info(f"Lote {id_lote} received by SEFAZ, recibo {retorno['nRec']}.")
+        retorno = aguardar_recibo(comunicacao, modelo, retorno)
+
+    protocolos = {}
+    xmls_autorizados = {}
+    for chave, prot_nfe in retorno.pop("protNFe").items():
+        inf_prot = _campos(prot_nfe.find(f"{NS}infProt"))
+        protocolos[chave] = inf_prot
+        if inf_prot.get("cStat") in CSTATS_AUTORIZADA and chave in nfes_por_chave:
+            xmls_autorizados[chave] = nfe_proc(nfes_por_chave[chave], prot_nfe)
+    return retorno, protocolos, xmls_autorizados
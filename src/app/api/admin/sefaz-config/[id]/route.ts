@@ -4,7 +4,6 @@ import { auth } from "@/lib/auth";
 import { z } from "zod";
 import fs from "fs/promises";
 import crypto from "crypto";
-import { v4 as uuidv4 } from "uuid";
 
 // Encryption/Decryption constants - should match admin/sefaz-config/route.ts
 const ENCRYPTION_KEY = process.env.CERTIFICATE_ENCRYPTION_KEY;
@@ -173,7 +172,6 @@ export async function POST(request: Request, { params }: { params: { id: string
         natureza_operacao: "VENDA DE MERCADORIA",
         modelo_documento_fiscal: notaFiscal.tipo === "NFE" ? "55" : (notaFiscal.tipo === "NFCE" ? "65" : "55"),
         serie_nf: notaFiscal.serie || "1",
-        numero_nf: notaFiscal.numero || uuidv4().substring(0,8).replace(/-/g, ""),
         data_emissao: new Date().toISOString(),
         finalidade_emissao_codigo: "1",
         tipo_operacao_codigo: "1",
@@ -233,8 +231,9 @@ export async function POST(request: Request, { params }: { params: { id: string
         updatedNotaData.protocolo = sefazResponseData.protocolo;
         updatedNotaData.xml = sefazResponseData.xml_autorizado;
         updatedNotaData.dataAutorizacao = new Date();
-        updatedNotaData.numero = notaFiscalInfoPayload.numero_nf;
-        updatedNotaData.serie = notaFiscalInfoPayload.serie_nf;
+        // The SEFAZ service allocates the number (atomically per CNPJ, modelo and série), so it is taken from its response
+        updatedNotaData.numero = String(sefazResponseData.numero_nf_emitido);
+        updatedNotaData.serie = String(sefazResponseData.serie_nf_emitida ?? notaFiscalInfoPayload.serie_nf);
     } else if (sefazResponseData.status_sefaz === "rejeitada_ou_erro") {
         updatedNotaData.status = sefazResponseData.codigo_status_sefaz === "204" ? "CANCELADA" : "REJEITADA";
         updatedNotaData.motivoRejeicao = `(${sefazResponseData.codigo_status_sefaz}) ${sefazResponseData.motivo_sefaz}`;
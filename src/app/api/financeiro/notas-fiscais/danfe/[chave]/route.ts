@@ -0,0 +1,45 @@
+import { NextResponse } from "next/server";
+import { auth } from "@/lib/auth";
+
+// Proxies the DANFE PDF rendered and cached by the Python SEFAZ service (GET /api/nfe/<chave>/danfe)
+export async function GET(request: Request, { params }: { params: { chave: string } }) {
+  const session = await auth();
+  if (!session?.user?.id || (session.user.role !== "ADMIN" && session.user.role !== "FINANCEIRO")) {
+    return NextResponse.json({ error: "Forbidden" }, { status: 403 });
+  }
+
+  const { chave } = params;
+  if (!/^\d{44}$/.test(chave)) {
+    return NextResponse.json({ error: "Chave de acesso inválida" }, { status: 400 });
+  }
+
+  const sefazServiceOrigin = new URL(process.env.SEFAZ_SERVICE_URL || "http://localhost:5001/api/nfe/generate-transmit").origin;
+
+  try {
+    const ifNoneMatch = request.headers.get("if-none-match");
+    const danfeResponse = await fetch(`${sefazServiceOrigin}/api/nfe/${chave}/danfe`, {
+      headers: ifNoneMatch ? { "If-None-Match": ifNoneMatch } : {},
+    });
+
+    if (danfeResponse.status === 304) {
+      return new NextResponse(null, { status: 304, headers: { ETag: danfeResponse.headers.get("etag") || "" } });
+    }
+    if (!danfeResponse.ok) {
+      const details = await danfeResponse.json().catch(() => ({}));
+      return NextResponse.json({ error: "Erro ao obter DANFE do serviço SEFAZ", details }, { status: danfeResponse.status });
+    }
+
+    return new NextResponse(danfeResponse.body, {
+      status: 200,
+      headers: {
+        "Content-Type": "application/pdf",
+        "Content-Disposition": `inline; filename="DANFE_NFe_${chave}.pdf"`,
+        ETag: danfeResponse.headers.get("etag") || "",
+        "Cache-Control": "private, max-age=86400",
+      },
+    });
+  } catch (error: any) {
+    console.error("Falha de comunicação com serviço SEFAZ ao obter DANFE:", error);
+    return NextResponse.json({ error: "Falha de comunicação com serviço SEFAZ", details: error.message }, { status: 503 });
+  }
+}
@@ -28,54 +28,33 @@ interface ExtractedNFeData {
     vencimento: string;
     valor: string;
   }>;
+  totais: Record<string, string>;
   xmlCompleto: string;
 }
 
-// Placeholder for XML parsing and processing logic
+// Extraction runs in the Python SEFAZ service (POST /api/nfe/parse), which streams the ExtractedNFeData
+// shape as NDJSON (one line per document; a single upload yields a single line).
 async function processNFeXML(xmlContent: string): Promise<ExtractedNFeData> {
-  // This is a very simplified placeholder.
-  // A real implementation would use a robust XML parser (like xml2js),
-  // validate the NFe structure, extract all relevant fields (emitente, destinatario,
-  // produtos, totais, transporte, cobranca, etc.), and handle various NFe layouts.
-  console.warn("[NFe Import API] XML parsing and processing is currently a placeholder.");
-  
-  // Mock extraction
-  const mockExtractedData = {
-    chaveAcesso: `mock_chave_${Date.now()}`,
-    numero: String(Math.floor(Math.random() * 100000)),
-    serie: "1",
-    dataEmissao: new Date().toISOString(),
-    valorTotal: (Math.random() * 1000).toFixed(2),
-    emitente: {
-      cnpj: "00.000.000/0001-00",
-      nome: "Fornecedor Mock S.A.",
-    },
-    destinatario: {
-        cnpj: process.env.EMPRESA_CNPJ || "11.111.111/0001-11", // Should be the app user's company CNPJ
-        nome: process.env.EMPRESA_NOME || "Empresa Destinataria Mock Ltda",
-    },
-    produtos: [
-      {
-        codigo: "PROD001",
-        descricao: "Produto Mock 1",
-        ncm: "00000000",
-        cfop: "5102",
-        unidade: "UN",
-        quantidade: Math.floor(Math.random() * 10) + 1,
-        valorUnitario: (Math.random() * 100).toFixed(2),
-        valorTotal: (Math.random() * 1000).toFixed(2),
-      },
-    ],
-    faturas: [
-        {
-            numero: `FAT${Math.floor(Math.random() * 1000)}`,
-            vencimento: new Date(Date.now() + 30 * 24 * 60 * 60 * 1000).toISOString(), // 30 days from now
-            valor: (Math.random() * 1000).toFixed(2)
-        }
-    ],
-    xmlCompleto: xmlContent.substring(0, 500) + "... (truncated for mock)", // Store or reference the full XML
-  };
-  return mockExtractedData;
+  const sefazServiceOrigin = new URL(process.env.SEFAZ_SERVICE_URL || "http://localhost:5001/api/nfe/generate-transmit").origin;
+  const parseResponse = await fetch(`${sefazServiceOrigin}/api/nfe/parse`, {
+    method: "POST",
+    headers: { "Content-Type": "application/xml" },
+    body: xmlContent,
+  });
+  if (!parseResponse.ok) {
+    const details = await parseResponse.json().catch(() => ({}));
+    throw new Error(`Serviço SEFAZ não conseguiu ler o XML: ${details.error || parseResponse.statusText}`);
+  }
+
+  const [firstLine] = (await parseResponse.text()).split("\n");
+  const extracted = JSON.parse(firstLine);
+  if (extracted.error) {
+    throw new Error(`XML de NF-e inválido: ${extracted.error}`);
+  }
+  if (extracted.tipo !== "procNFe") {
+    throw new Error(`Documento ${extracted.tipo} não contém os itens da nota; importe o XML completo (procNFe).`);
+  }
+  return { ...extracted, xmlCompleto: xmlContent };
 }
 
 export async function POST(request: NextRequest) {
@@ -4,7 +4,6 @@ import { auth } from "@/lib/auth";
 import { z } from "zod";
 import fs from "fs/promises";
 import path from "path";
-import { v4 as uuidv4 } from "uuid";
 
 // Helper to get company/emitente details (assuming a single company for now or from user settings)
 // This should be more robust in a multi-tenant app or if company details are stored per user/org
@@ -125,7 +124,6 @@ export async function POST(request: Request, { params }: { params: { id: string
         natureza_operacao: "VENDA DE MERCADORIA", // Example
         modelo_documento_fiscal: notaFiscal.tipo === "NFE" ? "55" : (notaFiscal.tipo === "NFCE" ? "65" : "55"),
         serie_nf: notaFiscal.serie || "1", // Get from NF or generate next
-        numero_nf: notaFiscal.numero || uuidv4().replace(/-/g, "").substring(0, 8),
         data_emissao: new Date().toISOString(), // Current date-time
         finalidade_emissao_codigo: "1", // 1=NF-e normal
         tipo_operacao_codigo: "1", // 1=Saída
@@ -199,14 +197,8 @@ export async function POST(request: Request, { params }: { params: { id: string
         updatedNotaData.protocolo = sefazResponseData.protocolo;
         updatedNotaData.xml = sefazResponseData.xml_autorizado; // Store the authorized XML
         updatedNotaData.dataAutorizacao = new Date();
-        // updatedNotaData.pdfUrl = ? // If DANFE PDF is returned as URL or needs to be stored/linked
-        if (sefazResponseData.danfe_pdf_base64) {
-            // Handle storing/linking the PDF. For now, maybe store as a large string or save to a file and link.
-            // This is a placeholder for PDF handling.
-            // For simplicity, we might not store it directly in DB if too large.
-            // Could save to a file and store path, or just allow re-generation on demand.
-            // For now, let's assume we might store a path or a flag that it's available.
-        }
+        // The DANFE PDF is not part of the response anymore: the SEFAZ service renders and caches it on demand,
+        // served to the browser through /api/financeiro/notas-fiscais/danfe/[chave].
     } else if (sefazResponseData.status_sefaz === "rejeitada_ou_erro") {
         updatedNotaData.status = sefazResponseData.codigo_status_sefaz === "204" ? "CANCELADA" : "REJEITADA"; // Example: 204 Duplicidade de NF-e
         updatedNotaData.motivoRejeicao = `(${sefazResponseData.codigo_status_sefaz}) ${sefazResponseData.motivo_sefaz}`;
@@ -216,14 +208,10 @@ export async function POST(request: Request, { params }: { params: { id: string
         updatedNotaData.motivoRejeicao = `Resposta inesperada do serviço SEFAZ: ${JSON.stringify(sefazResponseData)}`;
     }
     
-    // Update numero_nf and serie_nf if they were generated and are now confirmed by SEFAZ (or part of the authorized XML)
-    // This depends on how PyNFe and your sequential control work.
-    // If PyNFe uses the numero_nf and serie_nf you provided, and they are in the authorized XML, they are confirmed.
-    // If the service generates them, you need to get them back.
-    // For now, assume they are confirmed if authorized.
+    // The SEFAZ service allocates the number (atomically per CNPJ, modelo and série), so it is taken from its response
     if (updatedNotaData.status === "AUTORIZADA") {
-        updatedNotaData.numero = notaFiscalInfoPayload.numero_nf;
-        updatedNotaData.serie = notaFiscalInfoPayload.serie_nf;
+        updatedNotaData.numero = String(sefazResponseData.numero_nf_emitido);
+        updatedNotaData.serie = String(sefazResponseData.serie_nf_emitida ?? notaFiscalInfoPayload.serie_nf);
     }
 
     const finalUpdatedNota = await prisma.notaFiscal.update({
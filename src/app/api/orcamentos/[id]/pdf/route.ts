@@ -4,22 +4,7 @@ import { prisma } from "@/lib/db";
 import { auth } from "@/lib/auth"; // Adjusted path
 import { WeasyPrint } from "weasyprint"; // Correct import for WeasyPrint
 import path from "path";
-import { execSync } from "child_process"; // For calling Python script
-
-// Helper function to render Jinja2 template using Python
-function renderTemplateWithJinja(templatePath: string, data: object): string {
-  const scriptPath = path.resolve(process.cwd(), "src/scripts/render_jinja_template.py");
-  const dataJsonString = JSON.stringify(data).replace(/'/g, "'\\''"); // Escape single quotes for shell
-  const command = `python3 "${scriptPath}" "${templatePath}" '${dataJsonString}'`;
-  
-  try {
-    const output = execSync(command, { encoding: "utf-8" });
-    return output;
-  } catch (error: any) {
-    console.error("Error rendering Jinja template:", error.stderr || error.message);
-    throw new Error("Failed to render PDF template with Jinja.");
-  }
-}
+import { renderTemplateWithJinja } from "@/lib/jinjaRenderer"; // Long-lived Python render worker
 
 export async function GET(
   request: NextRequest,
@@ -69,7 +54,7 @@ export async function GET(
     };
 
     const templatePath = path.resolve(process.cwd(), "src/templates/orcamento_pdf_template.html");
-    const htmlContent = renderTemplateWithJinja(templatePath, templateData);
+    const htmlContent = await renderTemplateWithJinja(templatePath, templateData);
 
     // Generate PDF using WeasyPrint
     const pdfBuffer = await new WeasyPrint({ html: htmlContent }).writePdf();
@@ -5,32 +5,7 @@ import { auth } from "@/lib/auth"; // Adjusted path
 import { WeasyPrint } from "weasyprint"; // Using WeasyPrint for HTML to PDF
 import fs from "fs/promises";
 import path from "path";
-import { execSync } from "child_process"; // For calling Python script
-
-// Helper function to render Jinja-like template using Python script
-function renderTemplateWithJinja(templatePath: string, data: object): string {
-  const dataString = JSON.stringify(data).replace(/"/g, "\"");
-  const scriptPath = path.resolve(process.cwd(), "src/scripts/render_jinja_template.py");
-  const templateDir = path.dirname(templatePath);
-  const templateFile = path.basename(templatePath);
-  
-  // Ensure the script has execute permissions
-  try {
-    execSync(`chmod +x ${scriptPath}`);
-  } catch (e) {
-    console.warn("Could not chmod +x python script, assuming it has permissions.")
-  }
-
-  const command = `python3 ${scriptPath} "${templateDir}" "${templateFile}" "${dataString}"`;
-  
-  try {
-    const output = execSync(command, { encoding: "utf-8" });
-    return output;
-  } catch (error: any) {
-    console.error("Error rendering Jinja template:", error.stderr || error.message);
-    throw new Error("Failed to render Jinja template: " + (error.stderr || error.message));
-  }
-}
+import { renderTemplateWithJinja } from "@/lib/jinjaRenderer"; // Long-lived Python render worker
 
 export async function GET(
   request: Request,
@@ -94,7 +69,7 @@ export async function GET(
         return NextResponse.json({ error: "Ordem de Produção PDF template not found." }, { status: 500 });
     }
 
-    const htmlContent = renderTemplateWithJinja(templatePath, templateData);
+    const htmlContent = await renderTemplateWithJinja(templatePath, templateData);
 
     // Generate PDF using WeasyPrint
     const pdfBuffer = await new WeasyPrint({ html: htmlContent }).writePdf();
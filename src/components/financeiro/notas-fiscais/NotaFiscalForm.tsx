@@ -228,10 +228,10 @@ export function NotaFiscalForm() {
             link.click();
             document.body.removeChild(link);
           }
-          if (result.sefaz_response?.danfe_pdf_base64) {
-            const blob = new Blob([Uint8Array.from(atob(result.sefaz_response.danfe_pdf_base64), c => c.charCodeAt(0))], { type: "application/pdf" });
+          if (result.sefaz_response?.danfe_url && result.sefaz_response?.chave_acesso) {
+            // DANFE is rendered and cached by the SEFAZ service; download it through our proxy route
             const link = document.createElement("a");
-            link.href = URL.createObjectURL(blob);
+            link.href = `/api/financeiro/notas-fiscais/danfe/${result.sefaz_response.chave_acesso}`;
             link.download = `DANFE_NFe_${result.updated_nota_fiscal.chaveAcesso || notaFiscalId}.pdf`;
             document.body.appendChild(link);
             link.click();
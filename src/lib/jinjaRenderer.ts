@@ -0,0 +1,111 @@
+import { spawn, ChildProcessWithoutNullStreams } from "child_process";
+import path from "path";
+import readline from "readline";
+
+// Long-lived render worker (render_jinja_template.py --serve). One Python process keeps the
+// Jinja Environment and compiled templates in memory, so PDF routes no longer spawn an
+// interpreter per request or block the event loop with execSync.
+//
+// The worker, its pending renders and the request counter all live on `global`, so a hot reload
+// of this module keeps talking to the same process instead of orphaning its pending renders.
+// Any worker failure (spawn error, broken stdin, exit, a render past its timeout) rejects every
+// render still pending on it and clears it, and the next render starts a fresh one.
+
+const RENDER_TIMEOUT_MS = Number(process.env.JINJA_RENDER_TIMEOUT_MS) || 30000;
+
+type PendingRender = {
+  resolve: (html: string) => void;
+  reject: (error: Error) => void;
+  timer: NodeJS.Timeout;
+};
+
+type RenderWorker = {
+  process: ChildProcessWithoutNullStreams;
+  pending: Map<number, PendingRender>;
+};
+
+declare global {
+  // eslint-disable-next-line no-var
+  var jinjaRenderWorker: RenderWorker | undefined;
+  // eslint-disable-next-line no-var
+  var jinjaRenderNextId: number | undefined;
+}
+
+function failWorker(worker: RenderWorker, error: Error) {
+  if (global.jinjaRenderWorker === worker) global.jinjaRenderWorker = undefined;
+  for (const [id, request] of worker.pending) {
+    clearTimeout(request.timer);
+    worker.pending.delete(id);
+    request.reject(error);
+  }
+  if (worker.process.exitCode === null && !worker.process.killed) worker.process.kill();
+}
+
+function getWorker(): RenderWorker {
+  const current = global.jinjaRenderWorker;
+  if (current && current.process.exitCode === null && !current.process.killed) {
+    return current;
+  }
+
+  const scriptPath = path.resolve(process.cwd(), "src/scripts/render_jinja_template.py");
+  const child = spawn(process.env.PYTHON_BIN || "python3", [scriptPath, "--serve"], {
+    stdio: ["pipe", "pipe", "pipe"],
+  });
+  const worker: RenderWorker = { process: child, pending: new Map() };
+
+  readline.createInterface({ input: child.stdout }).on("line", (line) => {
+    let response: { id: number; html?: string; error?: string };
+    try {
+      response = JSON.parse(line);
+    } catch (e) {
+      console.error("Invalid response from Jinja render worker:", line);
+      return;
+    }
+    const request = worker.pending.get(response.id);
+    if (!request) return;
+    worker.pending.delete(response.id);
+    clearTimeout(request.timer);
+    if (response.error !== undefined) {
+      request.reject(new Error("Failed to render PDF template with Jinja: " + response.error));
+    } else {
+      request.resolve(response.html ?? "");
+    }
+  });
+
+  child.stderr.on("data", (chunk) => {
+    console.error("Jinja render worker:", chunk.toString());
+  });
+
+  // Spawn failures (e.g. ENOENT for PYTHON_BIN) and writes to a dead worker (EPIPE) are emitted as
+  // "error" events, which would otherwise crash the Next.js process
+  child.on("error", (error) => {
+    console.error("Jinja render worker error:", error);
+    failWorker(worker, new Error("Jinja render worker failed: " + error.message));
+  });
+  child.stdin.on("error", (error) => {
+    console.error("Jinja render worker stdin error:", error);
+    failWorker(worker, new Error("Jinja render worker failed: " + error.message));
+  });
+
+  child.on("exit", (code, signal) => {
+    console.warn(`Jinja render worker exited with code ${code}${signal ? ` (${signal})` : ""}`);
+    failWorker(worker, new Error("Jinja render worker exited before responding."));
+  });
+
+  global.jinjaRenderWorker = worker;
+  return worker;
+}
+
+export function renderTemplateWithJinja(templatePath: string, data: object): Promise<string> {
+  const worker = getWorker();
+  const id = global.jinjaRenderNextId ?? 1;
+  global.jinjaRenderNextId = id + 1;
+  return new Promise((resolve, reject) => {
+    // A render stuck past the timeout means the worker is wedged: kill it, failing everything pending on it
+    const timer = setTimeout(() => {
+      failWorker(worker, new Error(`Jinja render timed out after ${RENDER_TIMEOUT_MS} ms.`));
+    }, RENDER_TIMEOUT_MS);
+    worker.pending.set(id, { resolve, reject, timer });
+    worker.process.stdin.write(JSON.stringify({ id, template: templatePath, data }) + "\n");
+  });
+}
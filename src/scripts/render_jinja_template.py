@@ -1,17 +1,47 @@
-// src/scripts/render_jinja_template.py
+# src/scripts/render_jinja_template.py
+#
+# Usage:
+#   python3 render_jinja_template.py <template_path> '<json_data>'   # one-shot render
+#   python3 render_jinja_template.py --serve                           # NDJSON over stdin/stdout
+#   python3 render_jinja_template.py --serve --socket /tmp/jinja.sock  # NDJSON over a Unix socket
+#   python3 render_jinja_template.py --batch [--workers N] [--template-dir DIR] < jobs.ndjson
+#   python3 render_jinja_template.py --compile [--template-dir DIR]     # build the precompiled bundle
+#
+# --compile writes every template in DIR as a Python module into DIR/.compiled, together with a
+# manifest of the source mtimes. All modes load from that bundle by default and fall back to the
+# source file for any template that changed after the bundle was built.
+#
+# In --serve mode each request is one JSON line: {"id": ..., "template": "<path>", "data": {...}}
+# and each response is one JSON line: {"id": ..., "html": "..."} or {"id": ..., "error": "..."}.
+#
+# In --batch mode each job is one JSON line: {"id": ..., "template": "orcamento_pdf_template.html", "data": {...}}
+# (relative template names resolve against --template-dir, default src/templates). For every job, as soon
+# as it finishes, a JSON header line {"id": ..., "status": "ok"|"error", "length": N} is written to stdout,
+# followed by exactly N bytes of UTF-8 (the rendered HTML, or the error message).
 import sys
 import json
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+from jinja2 import Environment, BaseLoader, FileSystemLoader, ModuleLoader, select_autoescape
 from datetime import datetime
-from dateutil import parser as date_parser # For robust date parsing
 import os
+import threading
+
+DEFAULT_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "templates")
+BUNDLE_DIRNAME = ".compiled" # Ahead-of-time compiled templates, built with --compile
+BUNDLE_MANIFEST = "manifest.json"
+
+def parse_datetime_string(value):
+    try:
+        return datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+    except ValueError:
+        from dateutil import parser as date_parser # Only imported for strings that are not ISO-8601
+        return date_parser.parse(value)
 
 def format_datetime(value, format="%d/%m/%Y %H:%M"):
     if isinstance(value, str):
         try:
-            dt_object = date_parser.parse(value)
+            dt_object = parse_datetime_string(value)
             return dt_object.strftime(format)
-        except ValueError:
+        except (ValueError, OverflowError):
             return value # Return original if parsing fails
     elif isinstance(value, datetime):
         return value.strftime(format)
@@ -24,23 +54,219 @@ def format_currency(value):
     except (ValueError, TypeError):
         return value
 
-if __name__ == "__main__":
-    template_file_path = sys.argv[1]
-    data_json_string = sys.argv[2]
+def read_bundle_manifest(bundle_dir):
+    try:
+        with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def source_signature(template_dir, template_name):
+    try:
+        st = os.stat(os.path.join(template_dir, template_name))
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+class PrecompiledLoader(BaseLoader):
+    """Loads templates from the --compile bundle, or from source when the bundle is stale."""
+
+    def __init__(self, template_dir):
+        self.template_dir = template_dir
+        self.source_loader = FileSystemLoader(template_dir)
+        bundle_dir = os.path.join(template_dir, BUNDLE_DIRNAME)
+        self.manifest = read_bundle_manifest(bundle_dir)
+        self.module_loader = ModuleLoader(bundle_dir) if self.manifest else None
+
+    def get_source(self, environment, template):
+        return self.source_loader.get_source(environment, template)
 
-    template_dir = os.path.dirname(template_file_path)
-    template_file = os.path.basename(template_file_path)
+    def list_templates(self):
+        return self.source_loader.list_templates()
 
+    def load(self, environment, name, globals=None):
+        signature = source_signature(self.template_dir, name)
+        if self.module_loader is not None and signature is not None and self.manifest.get(name) == signature:
+            template = self.module_loader.load(environment, name, globals)
+            # Compiled modules carry no up-to-date check of their own; tie them to the source mtime
+            template._uptodate = lambda: source_signature(self.template_dir, name) == signature
+            return template
+        return self.source_loader.load(environment, name, globals)
+
+def create_environment(template_dir, loader=None):
     env = Environment(
-        loader=FileSystemLoader(template_dir),
-        autoescape=select_autoescape(['html', 'xml'])
+        loader=loader or PrecompiledLoader(template_dir),
+        autoescape=select_autoescape(['html', 'xml']),
+        auto_reload=True, # Recompile a cached template only when its mtime changes
     )
     env.filters['date'] = format_datetime
     env.filters['currency'] = format_currency # Add currency filter
+    return env
+
+_environments = {}
+_environments_lock = threading.Lock()
+
+def get_environment(template_dir):
+    # One Environment per template directory, so compiled templates are cached across renders
+    template_dir = os.path.abspath(template_dir)
+    with _environments_lock:
+        env = _environments.get(template_dir)
+        if env is None:
+            env = create_environment(template_dir)
+            _environments[template_dir] = env
+        return env
+
+def render_template(template_file_path, data):
+    env = get_environment(os.path.dirname(template_file_path))
+    template = env.get_template(os.path.basename(template_file_path))
+    return template.render(data)
+
+def handle_request_line(line):
+    request_id = None
+    try:
+        request = json.loads(line)
+        request_id = request.get("id")
+        html_output = render_template(request["template"], request.get("data") or {})
+        response = {"id": request_id, "html": html_output}
+    except Exception as e:
+        response = {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+    return json.dumps(response, ensure_ascii=False) + "\n"
+
+def serve_stdio():
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        sys.stdout.write(handle_request_line(line))
+        sys.stdout.flush()
+
+def serve_socket(socket_path):
+    import socketserver
+
+    class RenderRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for raw_line in self.rfile:
+                line = raw_line.decode("utf-8")
+                if not line.strip():
+                    continue
+                self.wfile.write(handle_request_line(line).encode("utf-8"))
+                self.wfile.flush()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.ThreadingUnixStreamServer(socket_path, RenderRequestHandler) as server:
+        os.chmod(socket_path, 0o600)
+        try:
+            server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+_batch_template_dir = DEFAULT_TEMPLATE_DIR
+
+def init_batch_worker(template_dir):
+    global _batch_template_dir
+    _batch_template_dir = template_dir
+
+def render_batch_job(job_id, template_name, data):
+    try:
+        template_path = template_name if os.path.isabs(template_name) else os.path.join(_batch_template_dir, template_name)
+        return job_id, "ok", render_template(template_path, data)
+    except Exception as e:
+        return job_id, "error", f"{type(e).__name__}: {e}"
+
+def write_batch_result(out, job_id, status, body):
+    body_bytes = body.encode("utf-8")
+    header = json.dumps({"id": job_id, "status": status, "length": len(body_bytes)}, ensure_ascii=False)
+    out.write(header.encode("utf-8") + b"\n")
+    out.write(body_bytes)
+    out.flush()
+
+def read_batch_jobs(stream):
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            yield job.get("id", line_number), job["template"], job.get("data") or {}, None
+        except Exception as e:
+            yield line_number, None, None, f"Invalid job on line {line_number}: {type(e).__name__}: {e}"
+
+def run_batch(template_dir=DEFAULT_TEMPLATE_DIR, workers=0, stream=None, out=None):
+    stream = stream if stream is not None else sys.stdin
+    out = out if out is not None else sys.stdout.buffer
+    template_dir = os.path.abspath(template_dir)
+
+    if workers <= 1:
+        init_batch_worker(template_dir)
+        for job_id, template_name, data, error in read_batch_jobs(stream):
+            if error:
+                write_batch_result(out, job_id, "error", error)
+            else:
+                write_batch_result(out, *render_batch_job(job_id, template_name, data))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    max_in_flight = workers * 4 # Keeps memory bounded on very large batches
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker, initargs=(template_dir,)) as pool:
+        in_flight = set()
+        for job_id, template_name, data, error in read_batch_jobs(stream):
+            if error:
+                write_batch_result(out, job_id, "error", error)
+                continue
+            in_flight.add(pool.submit(render_batch_job, job_id, template_name, data))
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_batch_result(out, *future.result())
+        while in_flight:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                write_batch_result(out, *future.result())
+
+def compile_bundle(template_dir=DEFAULT_TEMPLATE_DIR):
+    template_dir = os.path.abspath(template_dir)
+    bundle_dir = os.path.join(template_dir, BUNDLE_DIRNAME)
+    env = create_environment(template_dir, loader=FileSystemLoader(template_dir))
+    template_names = [name for name in env.list_templates() if name.endswith((".html", ".xml"))]
+    # Signatures are taken before compiling, so an edit made mid-compile marks the entry stale
+    manifest = {name: source_signature(template_dir, name) for name in template_names}
+    env.compile_templates(bundle_dir, zip=None, filter_func=lambda name: name in manifest, ignore_errors=False)
+    with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return template_names
+
+def parse_option(args, name, default=None):
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            return args[index + 1]
+    return default
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--compile":
+        for compiled_name in compile_bundle(parse_option(sys.argv, "--template-dir", DEFAULT_TEMPLATE_DIR)):
+            print(f"compiled {compiled_name}")
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        run_batch(
+            template_dir=parse_option(sys.argv, "--template-dir", DEFAULT_TEMPLATE_DIR),
+            workers=int(parse_option(sys.argv, "--workers", "0")),
+        )
+        sys.exit(0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        if len(sys.argv) > 3 and sys.argv[2] == "--socket":
+            serve_socket(sys.argv[3])
+        else:
+            serve_stdio()
+        sys.exit(0)
+
+    template_file_path = sys.argv[1]
+    data_json_string = sys.argv[2]
 
-    template = env.get_template(template_file)
     data = json.loads(data_json_string)
-    
-    html_output = template.render(data)
-    print(html_output)
 
+    html_output = render_template(template_file_path, data)
+    print(html_output)